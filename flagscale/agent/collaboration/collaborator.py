@@ -2,10 +2,10 @@ import datetime
 import threading
 import time
 
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
 from redis import ConnectionPool, Redis
-from redis.exceptions import ConnectionError, RedisError, TimeoutError
+from redis.exceptions import ConnectionError, RedisError, ResponseError, TimeoutError
 
 
 class Collaborator:
@@ -16,6 +16,9 @@ class Collaborator:
         db: int = 0,
         clear: bool = False,
         password: Optional[str] = None,
+        status_maxlen: Optional[int] = 1000,
+        status_ttl: Optional[float] = None,
+        registry_cache: bool = True,
     ):
         """
         Initialize Redis with individual parameters.
@@ -26,12 +29,28 @@ class Collaborator:
             db (int): Redis database index. Default: 0.
             clear (bool): If True, flushes the database on initialization. Default: False.
             password (Optional[str]): Redis authentication password. Default: None.
+            status_maxlen (Optional[int]): Approximate number of entries kept in each
+                agent status stream. None disables length-based trimming. Default: 1000.
+            status_ttl (Optional[float]): If set, status entries older than this many
+                seconds are trimmed instead of trimming by length. Default: None.
+            registry_cache (bool): If True, keeps a local copy of the agent registry that
+                is invalidated by the AGENT_REGISTRATION channel. Default: True.
         """
         self.host = host
         self.port = port
         self.db = db
         self.clear = clear
         self.password = password
+        self.status_maxlen = status_maxlen
+        self.status_ttl = status_ttl
+        self.registry_cache = registry_cache
+
+        # Local agent registry: name -> (agent data, local expiry deadline)
+        self._registry: Dict[str, Tuple[str, float]] = {}
+        self._registry_dirty: Set[str] = set()
+        self._registry_loaded = False
+        self._registry_lock = threading.Lock()
+        self._registry_thread = None
 
         # Log connection details (mask password for security)
         print(f"Connecting to Redis at {host}:{port}, db: {db}")
@@ -62,6 +81,9 @@ class Collaborator:
                     - db (int)
                     - password (Optional[str])
                     - clear (bool)
+                    - status_maxlen (Optional[int])
+                    - status_ttl (Optional[float])
+                    - registry_cache (bool)
 
         Returns:
             Collaborator: New instance configured with the provided settings.
@@ -82,6 +104,9 @@ class Collaborator:
             db=config.get("db", 0),
             password=config.get("password"),  # None if not provided
             clear=config.get("clear", False),
+            status_maxlen=config.get("status_maxlen", 1000),
+            status_ttl=config.get("status_ttl"),
+            registry_cache=config.get("registry_cache", True),
         )
 
     def _clear_db(self) -> None:
@@ -130,43 +155,173 @@ class Collaborator:
 
     # ----------------- data -----------------
     def record_agent_status(self, name: str, value: str, _: Optional[float] = None) -> bool:
-        """Append a member to short-term status list (score parameter is ignored)."""
+        """Append an entry to the agent's short-term status stream (score parameter is ignored).
+
+        The stream is trimmed on write, either to about `status_maxlen` entries or, if
+        `status_ttl` is set, to the entries of the last `status_ttl` seconds.
+        """
         try:
             redis_client = self._get_conn()
-            return redis_client.rpush(f"SHORT_STATUS:{name}", value) > 0
+            if self.status_ttl is not None:
+                minid = int((time.time() - self.status_ttl) * 1000)
+                entry_id = redis_client.xadd(
+                    f"SHORT_STATUS:{name}", {"value": value}, minid=minid, approximate=True
+                )
+            else:
+                entry_id = redis_client.xadd(
+                    f"SHORT_STATUS:{name}",
+                    {"value": value},
+                    maxlen=self.status_maxlen,
+                    approximate=True,
+                )
+            return entry_id is not None
         except (ConnectionError, TimeoutError, RedisError) as e:
-            print(f"Error while appending to short-term status list: {e}")
+            print(f"Error while appending to short-term status stream: {e}")
             return False
 
     def read_agent_status(self, name: str) -> List[str]:
-        """Get all members from short-term status list."""
+        """Get all retained entries from the short-term status stream."""
+        try:
+            redis_client = self._get_conn()
+            entries = redis_client.xrange(f"SHORT_STATUS:{name}")
+            return [fields["value"] for _, fields in entries]
+        except (ConnectionError, TimeoutError, RedisError) as e:
+            print(f"Error while reading short-term status stream: {e}")
+            return []
+
+    def read_agent_status_since(
+        self,
+        name: str,
+        last_id: str = "0-0",
+        count: Optional[int] = None,
+        block: Optional[int] = None,
+    ) -> Tuple[str, List[str]]:
+        """Incrementally read status entries added after a cursor.
+
+        Args:
+            name (str): Agent name
+            last_id (str): Cursor returned by the previous call ("0-0" reads from the
+                beginning, "$" reads only entries added from now on)
+            count (Optional[int]): Maximum number of entries to return
+            block (Optional[int]): Milliseconds to block waiting for new entries
+
+        Returns:
+            Tuple[str, List[str]]: The new cursor and the values read after `last_id`.
+            On error, the cursor is returned unchanged with an empty list.
+
+        Example:
+            >>> cursor = "0-0"
+            >>> cursor, values = coll.read_agent_status_since("robot_1", cursor)
+        """
+        try:
+            redis_client = self._get_conn()
+            response = redis_client.xread(
+                {f"SHORT_STATUS:{name}": last_id}, count=count, block=block
+            )
+            if not response:
+                return last_id, []
+            _, entries = response[0]
+            return entries[-1][0], [fields["value"] for _, fields in entries]
+        except (ConnectionError, TimeoutError, RedisError) as e:
+            print(f"Error while reading short-term status stream: {e}")
+            return last_id, []
+
+    def create_agent_status_group(self, name: str, group: str, start_id: str = "$") -> bool:
+        """Create a consumer group on the agent's status stream.
+
+        The stream is created if it does not exist yet. Creating an existing group is
+        not an error.
+
+        Args:
+            name (str): Agent name
+            group (str): Consumer group name
+            start_id (str): First entry delivered to the group ("$" = only new entries)
+
+        Returns:
+            bool: True if the group exists after the call, False on failure
+        """
+        try:
+            redis_client = self._get_conn()
+            return bool(
+                redis_client.xgroup_create(f"SHORT_STATUS:{name}", group, start_id, mkstream=True)
+            )
+        except ResponseError as e:
+            if str(e).startswith("BUSYGROUP"):
+                return True
+            print(f"Error while creating status consumer group {group}: {e}")
+            return False
+        except (ConnectionError, TimeoutError, RedisError) as e:
+            print(f"Error while creating status consumer group {group}: {e}")
+            return False
+
+    def read_agent_status_group(
+        self,
+        name: str,
+        group: str,
+        consumer: str,
+        count: Optional[int] = None,
+        block: Optional[int] = None,
+    ) -> List[Tuple[str, str]]:
+        """Read new status entries on behalf of a consumer in a consumer group.
+
+        Returned entries stay pending until acknowledged with `ack_agent_status`.
+
+        Args:
+            name (str): Agent name
+            group (str): Consumer group name
+            consumer (str): Consumer name inside the group
+            count (Optional[int]): Maximum number of entries to return
+            block (Optional[int]): Milliseconds to block waiting for new entries
+
+        Returns:
+            List[Tuple[str, str]]: (entry id, value) pairs, empty on error or timeout
+        """
         try:
             redis_client = self._get_conn()
-            return redis_client.lrange(f"SHORT_STATUS:{name}", 0, -1)
+            response = redis_client.xreadgroup(
+                group, consumer, {f"SHORT_STATUS:{name}": ">"}, count=count, block=block
+            )
+            if not response:
+                return []
+            _, entries = response[0]
+            return [(entry_id, fields["value"]) for entry_id, fields in entries]
         except (ConnectionError, TimeoutError, RedisError) as e:
-            print(f"Error while reading short-term status list: {e}")
+            print(f"Error while reading status consumer group {group}: {e}")
             return []
 
+    def ack_agent_status(self, name: str, group: str, *entry_ids: str) -> int:
+        """Acknowledge status entries processed by a consumer group.
+
+        Returns:
+            int: Number of entries acknowledged, 0 on error
+        """
+        try:
+            redis_client = self._get_conn()
+            return redis_client.xack(f"SHORT_STATUS:{name}", group, *entry_ids)
+        except (ConnectionError, TimeoutError, RedisError) as e:
+            print(f"Error while acknowledging status entries: {e}")
+            return 0
+
     def clear_agent_status(self, name: str) -> bool:
-        """Delete short-term status list."""
+        """Delete short-term status stream."""
         try:
             redis_client = self._get_conn()
             return redis_client.delete(f"SHORT_STATUS:{name}") == 1
         except (ConnectionError, TimeoutError, RedisError) as e:
-            print(f"Error while clearing short-term status list: {e}")
+            print(f"Error while clearing short-term status stream: {e}")
             return False
 
     def register_agent(
         self, agent_name: str, agent_data: Dict[str, str], expire_second: Optional[int] = None
     ) -> bool:
-        """Register agent in Redis under AGENT_INFO hash.
+        """Register agent in Redis under its own AGENT_INFO:{agent_name} key.
 
-        Creates AGENT_INFO hash if not exists.
+        The agent name is also added to the AGENT_NAMES set used to enumerate agents.
 
         Args:
             agent_name (str): Key identifier for the agent
             agent_data (Dict[str, str]): Agent attributes
-            expire_second (Optional[int]): TTL in seconds for the AGENT_INFO hash
+            expire_second (Optional[int]): TTL in seconds for this agent's registration
 
         Returns:
             bool: True if successful, False on failure
@@ -176,12 +331,11 @@ class Collaborator:
 
             # Pipeline both operations atomically
             with redis_client.pipeline() as pipe:
-                # 1. Store agent data in AGENT_INFO hash
-                pipe.hset("AGENT_INFO", key=agent_name, value=agent_data)
+                # 1. Store agent data with its own TTL
+                pipe.set(f"AGENT_INFO:{agent_name}", agent_data, ex=expire_second)
 
-                # 2. Set expiration if specified
-                if expire_second is not None:
-                    pipe.expire("AGENT_INFO", expire_second)
+                # 2. Index the agent name
+                pipe.sadd("AGENT_NAMES", agent_name)
 
                 pipe.execute()
 
@@ -193,41 +347,155 @@ class Collaborator:
             print(f"Failed to register agent {agent_name}: {e}")
             return False
 
+    def _start_registry_listener(self) -> bool:
+        """Subscribe to AGENT_REGISTRATION to invalidate the local agent registry.
+
+        Returns:
+            bool: True if the local registry can be used, False otherwise
+        """
+        if not self.registry_cache:
+            return False
+        if self._registry_thread is not None:
+            return True
+
+        def on_registration(message: Dict[str, Any]) -> None:
+            with self._registry_lock:
+                self._registry_dirty.add(message["data"])
+
+        def on_error(e: Exception, pubsub: Any, thread: Any) -> None:
+            print(f"Agent registry listener stopped: {e}")
+            pubsub.close()
+            thread.stop()
+            with self._registry_lock:
+                self._registry.clear()
+                self._registry_loaded = False
+                self._registry_thread = None
+
+        try:
+            pubsub = self._get_conn().pubsub()
+            pubsub.subscribe(**{"AGENT_REGISTRATION": on_registration})
+            # Registrations published before the subscription is active would be lost
+            while pubsub.get_message(timeout=1.0) is None:
+                pass
+            self._registry_thread = pubsub.run_in_thread(
+                sleep_time=1.0, daemon=True, exception_handler=on_error
+            )
+            return True
+        except (ConnectionError, TimeoutError, RedisError) as e:
+            print(f"Failed to start agent registry listener: {e}")
+            return False
+
+    def _fetch_agents(self, redis_client: Redis, agents_name: List[str]) -> Dict[str, str]:
+        """Read agents from Redis and refresh their local registry entries."""
+        with redis_client.pipeline(transaction=False) as pipe:
+            for name in agents_name:
+                pipe.get(f"AGENT_INFO:{name}")
+                pipe.pttl(f"AGENT_INFO:{name}")
+            results = pipe.execute()
+
+        now = time.monotonic()
+        agents = {}
+        with self._registry_lock:
+            for name, data, pttl in zip(agents_name, results[0::2], results[1::2]):
+                self._registry_dirty.discard(name)
+                if data is None:
+                    self._registry.pop(name, None)
+                    continue
+                deadline = float("inf") if pttl < 0 else now + pttl / 1000
+                self._registry[name] = (data, deadline)
+                agents[name] = data
+        return agents
+
+    def _lookup_registry(self, agent_name: str) -> Tuple[bool, Optional[str]]:
+        """Look up an agent in the local registry.
+
+        Returns:
+            Tuple[bool, Optional[str]]: Whether the local answer is valid, and the agent data
+        """
+        with self._registry_lock:
+            if not self._registry_loaded or agent_name in self._registry_dirty:
+                return False, None
+            entry = self._registry.get(agent_name)
+            if entry is None:
+                return True, None
+            data, deadline = entry
+            if deadline <= time.monotonic():
+                return False, None
+            return True, data
+
     def retrieve_agent(self, agent_name: str) -> Optional[Dict[str, str]]:
-        """Retrieve agent data from AGENT_INFO hash."""
+        """Retrieve agent data, from the local registry when it is up to date."""
+        valid, data = self._lookup_registry(agent_name)
+        if valid:
+            return data
+        if self.registry_cache and not self._registry_loaded:
+            return self.retrieve_all_agents().get(agent_name)
         try:
             redis_client = self._get_conn()
-            return redis_client.hget("AGENT_INFO", agent_name)
+            return self._fetch_agents(redis_client, [agent_name]).get(agent_name)
         except (ConnectionError, TimeoutError, RedisError) as e:
             print(f"Error retrieving agent {agent_name}: {e}")
             return None
 
     def retrieve_all_agents(self) -> Dict[str, Dict[str, str]]:
-        """Retrieve all agents from AGENT_INFO hash."""
+        """Retrieve all live agents.
+
+        The first call loads the whole registry from Redis. Later calls only re-read
+        agents that re-registered or whose local TTL deadline has passed.
+        """
         try:
             redis_client = self._get_conn()
-            return redis_client.hgetall("AGENT_INFO")
+            use_cache = self._start_registry_listener()
+
+            with self._registry_lock:
+                if use_cache and self._registry_loaded:
+                    now = time.monotonic()
+                    stale = set(self._registry_dirty)
+                    stale.update(
+                        name for name, (_, deadline) in self._registry.items() if deadline <= now
+                    )
+                    agents = {
+                        name: data
+                        for name, (data, _) in self._registry.items()
+                        if name not in stale
+                    }
+                else:
+                    stale = None
+                    self._registry_dirty.clear()
+
+            if stale is not None:
+                if stale:
+                    agents.update(self._fetch_agents(redis_client, sorted(stale)))
+                return agents
+
+            names = sorted(redis_client.smembers("AGENT_NAMES"))
+            agents = self._fetch_agents(redis_client, names)
+
+            # Drop names whose registration has expired
+            expired = [name for name in names if name not in agents]
+            if expired:
+                redis_client.srem("AGENT_NAMES", *expired)
+
+            with self._registry_lock:
+                self._registry_loaded = use_cache
+            return agents
         except (ConnectionError, TimeoutError, RedisError) as e:
             print(f"Error retrieving agent registry: {e}")
             return {}
 
     def retrieve_all_agents_name(self) -> List[str]:
-        """Retrieve all agent names (keys) from AGENT_INFO hash.
+        """Retrieve all live agent names.
 
         Returns:
             List[str]: List of all agent names/keys.
             Returns empty list if no agents exist or error occurs.
         """
-        try:
-            redis_client = self._get_conn()
-            return list(redis_client.hkeys("AGENT_INFO"))
-
-        except (ConnectionError, TimeoutError, RedisError) as e:
-            print(f"Error retrieving agent names: {e}")
-            return []
+        return list(self.retrieve_all_agents())
 
     def agent_heartbeat(self, agent_name: str, seconds: int) -> bool:
-        """Set TTL for the agent's registration in AGENT_INFO hash.
+        """Set TTL for the agent's registration.
+
+        Only this agent's AGENT_INFO:{agent_name} key is affected.
 
         Args:
             agent_name: Name of the registered agent
@@ -239,12 +507,8 @@ class Collaborator:
         try:
             redis_client = self._get_conn()
 
-            # Verify agent exists
-            if not redis_client.hexists("AGENT_INFO", agent_name):
-                return False
-
-            # Set TTL for the entire hash
-            return bool(redis_client.expire("AGENT_INFO", seconds))
+            # EXPIRE returns 0 if the agent is not registered
+            return bool(redis_client.expire(f"AGENT_INFO:{agent_name}", seconds))
 
         except (ConnectionError, TimeoutError, RedisError):
             return False
@@ -265,7 +529,15 @@ class Collaborator:
         """
         try:
             redis_client = self._get_conn()
-            return redis_client.hset("AGENT_BUSY", agent_name, int(busy)) >= 0
+
+            # Update the status and notify waiters atomically, so that the order of
+            # notifications always matches the order of writes to AGENT_BUSY
+            with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset("AGENT_BUSY", agent_name, int(busy))
+                pipe.publish("AGENT_BUSY_UPDATE", f"{agent_name}:{int(busy)}")
+                result, _ = pipe.execute()
+
+            return result >= 0
         except (ConnectionError, TimeoutError, RedisError) as e:
             print(f"Error updating busy status for {agent_name}: {e}")
             return False
@@ -295,9 +567,15 @@ class Collaborator:
     ) -> bool:
         """Wait until all specified agents become free (busy=False).
 
+        Instead of polling AGENT_BUSY, the waiter subscribes to the AGENT_BUSY_UPDATE
+        channel published by `update_agent_busy`, reads the current statuses once to
+        reconcile with updates that happened before the subscription, and then blocks
+        on notifications only.
+
         Args:
             agents_name: List of agent names to monitor
-            check_interval: Seconds between status checks (default: 0.5)
+            check_interval: Maximum seconds to block on a single notification read
+                before re-checking the timeout (default: 0.5)
             timeout: Maximum wait time in seconds (None = no timeout)
 
         Returns:
@@ -307,42 +585,69 @@ class Collaborator:
 
         Example:
             >>> # Wait for robot1 and robot2 to become free
-            >>> success = coll.wait_agent_free(["robot1", "robot2"])
+            >>> success = coll.wait_agents_free(["robot1", "robot2"])
             >>> if success:
             >>>     print("All agents are now available")
         """
         start_time = time.time()
+        pubsub = None
 
         try:
             redis_client = self._get_conn()
 
+            # Subscribe before reading the statuses so that no update can be missed
+            pubsub = redis_client.pubsub()
+            pubsub.subscribe("AGENT_BUSY_UPDATE")
             while True:
-                # Check timeout
                 if timeout is not None and (time.time() - start_time) > timeout:
                     return False
+                message = pubsub.get_message(timeout=check_interval)
+                if message is not None and message["type"] == "subscribe":
+                    break
+
+            # Reconciling read (None means no record = considered free)
+            statuses = redis_client.hmget("AGENT_BUSY", agents_name)
+            busy_agents = {
+                name
+                for name, status in zip(agents_name, statuses)
+                if status is not None and bool(int(status))
+            }
+
+            watched = set(agents_name)
+            while busy_agents:
+                wait_time = check_interval
+                if timeout is not None:
+                    remaining = timeout - (time.time() - start_time)
+                    if remaining <= 0:
+                        return False
+                    wait_time = min(wait_time, remaining)
+
+                message = pubsub.get_message(timeout=wait_time)
+                if message is None or message["type"] != "message":
+                    continue
+
+                name, _, status = message["data"].rpartition(":")
+                if name not in watched:
+                    continue
+                if bool(int(status)):
+                    busy_agents.add(name)
+                else:
+                    busy_agents.discard(name)
 
-                # Get all statuses in one atomic operation
-                statuses = redis_client.hmget("AGENT_BUSY", agents_name)
-
-                # Check if all are free (None means no record = considered free)
-                all_free = True
-                for status in statuses:
-                    if status is not None and bool(int(status)):
-                        all_free = False
-                        break
-
-                if all_free:
-                    return True
-
-                # Wait before next check
-                time.sleep(check_interval)
+            return True
 
         except (ConnectionError, TimeoutError, RedisError) as e:
             print(f"Error while waiting for agent status: {e}")
             return False
+        finally:
+            if pubsub is not None:
+                pubsub.close()
 
     # ----------------- Close Connection -----------------
     def _close_db(self) -> None:
         """Close the Redis connection pool."""
+        if self._registry_thread is not None:
+            self._registry_thread.stop()
+            self._registry_thread = None
         self.pool.disconnect()
         print("Redis connection pool closed.")
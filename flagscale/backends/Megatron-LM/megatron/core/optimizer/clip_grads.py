@@ -2,7 +2,7 @@
 
 """Gradient clipping."""
 
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 from torch import inf
@@ -47,7 +47,10 @@ from ..tensor_parallel import param_is_not_tensor_parallel_duplicate
 from ..transformer.module import param_is_not_shared
 from ..utils import get_data_parallel_group_if_dtensor, to_local_if_dtensor
 
-from flagscale.train.hetero.p2p_communication import get_device_type_for_comm
+from flagscale.train.hetero.p2p_communication import (
+    all_reduce_across_global_groups,
+    get_device_type_for_comm,
+)
 
 def get_grad_norm_fp32(
     grads_for_norm: Union[List[torch.Tensor], torch.Tensor],
@@ -98,12 +101,12 @@ def get_grad_norm_fp32(
         # Take max across all model-parallel GPUs.
         # For cpu comminication
         tensor_device = get_device_type_for_comm(grad_stats_parallel_group)
-        total_norm_cuda.to(tensor_device)
+        total_norm_cuda = total_norm_cuda.to(tensor_device)
         if isinstance(grad_stats_parallel_group, list):
-            for group in grad_stats_parallel_group:
-                torch.distributed.all_reduce(
-                    total_norm_cuda, op=torch.distributed.ReduceOp.MAX, group=group
-                )
+            # hetero: a single reduction instead of one per model parallel group
+            total_norm_cuda = all_reduce_across_global_groups(
+                [(total_norm_cuda, grad_stats_parallel_group)], op=torch.distributed.ReduceOp.MAX
+            )
         else:
             torch.distributed.all_reduce(
                 total_norm_cuda, op=torch.distributed.ReduceOp.MAX, group=grad_stats_parallel_group
@@ -144,13 +147,8 @@ def get_grad_norm_fp32(
         tensor_device = get_device_type_for_comm(grad_stats_parallel_group)
         total_norm = total_norm.to(tensor_device)
         if isinstance(grad_stats_parallel_group, list):
-            original_total_norm = total_norm.clone().detach()
-            for mp_group in grad_stats_parallel_group:
-                total_norm.data = original_total_norm.data.clone()
-                total_norm = total_norm.to(tensor_device)
-                torch.distributed.all_reduce(
-                    total_norm, op=torch.distributed.ReduceOp.SUM, group=mp_group
-                )
+            # hetero: a single reduction instead of one per model parallel group
+            total_norm = all_reduce_across_global_groups([(total_norm, grad_stats_parallel_group)])
         else:
             torch.distributed.all_reduce(
                 total_norm, op=torch.distributed.ReduceOp.SUM, group=grad_stats_parallel_group
@@ -160,6 +158,64 @@ def get_grad_norm_fp32(
     return total_norm
 
 
+########## FlagScale Begin ##########
+def get_grad_norm_and_skip_flag_fp32(
+    grads_for_norm: Union[List[torch.Tensor], torch.Tensor],
+    skip_flag: torch.Tensor,
+    grad_stats_parallel_group: Optional[torch.distributed.ProcessGroup] = None,
+) -> Tuple[float, bool]:
+    """Calculate the L2 norm of gradients in fp32 like get_grad_norm_fp32, and whether the
+    device skip_flag is set on any rank of grad_stats_parallel_group.
+
+    The flag is summed together with the squared norms, so it costs neither another
+    collective nor another host synchronization.
+    """
+
+    if isinstance(grads_for_norm, torch.Tensor):
+        grads_for_norm = [grads_for_norm]
+
+    data_parallel_group = None
+    for grad in grads_for_norm:
+        data_parallel_group = get_data_parallel_group_if_dtensor(grad, data_parallel_group)
+
+    grads_for_norm = [to_local_if_dtensor(grad) for grad in grads_for_norm]
+
+    if grads_for_norm:
+        dummy_overflow_buf = torch.tensor([0], dtype=torch.int, device='cuda')
+        grad_norm, _ = multi_tensor_applier(
+            l2_norm_impl,
+            dummy_overflow_buf,
+            [grads_for_norm],
+            False,  # no per-parameter norm
+        )
+    else:
+        grad_norm = torch.tensor([0], dtype=torch.float, device='cuda')
+    total_norm = grad_norm**2
+
+    # Sum across all data-parallel GPUs if using FSDP.
+    if data_parallel_group:
+        torch.distributed.all_reduce(
+            total_norm, op=torch.distributed.ReduceOp.SUM, group=data_parallel_group
+        )
+
+    # Sum the squared norm and the flag across all model-parallel GPUs.
+    tensor_device = get_device_type_for_comm(grad_stats_parallel_group)
+    total_norm = torch.cat(
+        [total_norm.view(1), skip_flag.float().view(1).to(total_norm.device)]
+    ).to(tensor_device)
+    if isinstance(grad_stats_parallel_group, list):
+        total_norm = all_reduce_across_global_groups([(total_norm, grad_stats_parallel_group)])
+    else:
+        torch.distributed.all_reduce(
+            total_norm, op=torch.distributed.ReduceOp.SUM, group=grad_stats_parallel_group
+        )
+    total_norm, skipped = total_norm.tolist()
+    return total_norm**0.5, skipped > 0
+
+
+########## FlagScale End ##########
+
+
 def clip_grad_by_total_norm_fp32(
     parameters: Union[List[torch.Tensor], torch.Tensor],
     max_norm: Union[int, float],
@@ -253,12 +309,11 @@ def count_zeros_fp32(
         total_num_zeros = total_num_zeros.cpu()
 
     if isinstance(grad_stats_parallel_group, list):
-        original_total_num_zeros = total_num_zeros.clone().detach()
-        for group in grad_stats_parallel_group:
-            total_num_zeros.data = original_total_num_zeros.data.clone()
-            torch.distributed.all_reduce(
-                total_num_zeros, op=torch.distributed.ReduceOp.SUM, group=group
-            )
+        # hetero: a single reduction instead of one per model parallel group, the weighted
+        # counts of the replicas are rounded back to an integer
+        total_num_zeros = all_reduce_across_global_groups(
+            [(total_num_zeros, grad_stats_parallel_group)]
+        ).round()
     else:
         torch.distributed.all_reduce(
             total_num_zeros, op=torch.distributed.ReduceOp.SUM, group=grad_stats_parallel_group
@@ -46,10 +46,20 @@ from ..dist_checkpointing.optimizer import (
 )
 from ..dist_checkpointing.utils import add_prefix_for_sharding
 from ..transformer.module import param_is_not_shared
-from .clip_grads import clip_grad_by_total_norm_fp32, count_zeros_fp32, get_grad_norm_fp32
+from .clip_grads import (
+    clip_grad_by_total_norm_fp32,
+    count_zeros_fp32,
+    get_grad_norm_and_skip_flag_fp32,
+    get_grad_norm_fp32,
+)
 from .grad_scaler import MegatronGradScaler
 from .optimizer_config import OptimizerConfig
 
+from flagscale.train.hetero.p2p_communication import (
+    all_reduce_across_global_groups,
+    get_device_type_for_comm,
+)
+
 logger = getLogger(__name__)
 
 
@@ -187,9 +197,9 @@ class MegatronOptimizer(ABC):
     def get_grad_norm(self):
         """Compute and return grad norm."""
         grads_for_norm = self.get_main_grads_for_grad_norm()
-        total_norm = get_grad_norm_fp32(
-            grads_for_norm, grad_stats_parallel_group=self.get_grad_stats_parallel_group()
-        )
+        ########## FlagScale Begin ##########
+        total_norm = self._get_grad_norm_and_reduce_skip_flag(grads_for_norm)
+        ########## FlagScale End ##########
         return total_norm
 
     def clip_grad_norm(self, clip_grad: float) -> float:
@@ -199,9 +209,9 @@ class MegatronOptimizer(ABC):
             grads_for_norm = self.get_main_grads_for_grad_norm()
         else:
             grads_for_norm = []
-        grad_norm = get_grad_norm_fp32(
-            grads_for_norm, grad_stats_parallel_group=self.get_grad_stats_parallel_group()
-        )
+        ########## FlagScale Begin ##########
+        grad_norm = self._get_grad_norm_and_reduce_skip_flag(grads_for_norm)
+        ########## FlagScale End ##########
 
         if params:
             clip_grad_by_total_norm_fp32(
@@ -209,6 +219,61 @@ class MegatronOptimizer(ABC):
             )
         return grad_norm
 
+    ########## FlagScale Begin ##########
+    def skip_step_if(self, skip_flag: torch.Tensor):
+        """Skip the next step if the device tensor skip_flag is set on any rank.
+
+        The flag is reduced together with the inf/nan check of the grads when there is a grad
+        scaler, or else with the grad norm, so that deciding to skip does not add a collective
+        or a host synchronization to the step. A skipped step returns unsuccessful like a step
+        with inf/nan grads.
+        """
+        self._skip_flag = skip_flag
+
+    def _pop_skip_flag(self) -> Optional[torch.Tensor]:
+        skip_flag = getattr(self, '_skip_flag', None)
+        self._skip_flag = None
+        return skip_flag
+
+    def _get_grad_norm_and_reduce_skip_flag(self, grads_for_norm: List[torch.Tensor]) -> float:
+        """Compute the grad norm, reducing the pending skip flag with it."""
+        skip_flag = self._pop_skip_flag()
+        if skip_flag is None:
+            return get_grad_norm_fp32(
+                grads_for_norm, grad_stats_parallel_group=self.get_grad_stats_parallel_group()
+            )
+        grad_norm, self._skipped = get_grad_norm_and_skip_flag_fp32(
+            grads_for_norm,
+            skip_flag,
+            grad_stats_parallel_group=self.get_grad_stats_parallel_group(),
+        )
+        return grad_norm
+
+    def _should_skip_step(self) -> bool:
+        """Whether the flag of skip_step_if is set on any rank.
+
+        The flag was usually reduced with the inf/nan check or the grad norm already, it is only
+        reduced on its own when the step computes neither.
+        """
+        skipped = getattr(self, '_skipped', False)
+        self._skipped = False
+        skip_flag = self._pop_skip_flag()
+        if skip_flag is not None:
+            groups = self.get_grad_stats_parallel_group()
+            skip_flag = skip_flag.float().view(1).to(get_device_type_for_comm(groups))
+            if isinstance(groups, list):
+                skip_flag = all_reduce_across_global_groups(
+                    [(skip_flag, groups)], op=torch.distributed.ReduceOp.MAX
+                )
+            else:
+                torch.distributed.all_reduce(
+                    skip_flag, op=torch.distributed.ReduceOp.MAX, group=groups
+                )
+            skipped = skip_flag.item() > 0
+        return skipped
+
+    ########## FlagScale End ##########
+
     def count_zeros(self) -> float:
         """Count number of zeros in model's gradients."""
         params = self.get_parameters()
@@ -392,26 +457,42 @@ class MixedPrecisionOptimizer(MegatronOptimizer):
                 main_grads, self.found_inf, self.grad_scaler.inv_scale
             )
 
+        ########## FlagScale Begin ##########
+        # The pending skip flag of skip_step_if is reduced together with found inf.
+        found_inf = self.found_inf
+        skip_flag = self._pop_skip_flag()
+        if skip_flag is not None:
+            found_inf = torch.cat([found_inf, skip_flag.float().view(1).to(found_inf.device)])
+        ########## FlagScale End ##########
+
         # Update across all model parallel instances.
         groups = self.get_grad_stats_parallel_group()
         if isinstance(groups, list):
             if "cpu:gloo" == torch.distributed.get_backend(groups[0]):
-                self.found_inf = self.found_inf.cpu()
+                found_inf = found_inf.cpu()
         else:
             if "cpu:gloo" == torch.distributed.get_backend(groups):
-                self.found_inf = self.found_inf.cpu()
-        if not isinstance(groups, list):
-            groups = [groups]
-        for group in groups:
+                found_inf = found_inf.cpu()
+        if isinstance(groups, list):
+            # hetero: a single reduction instead of one per model parallel group
+            found_inf = all_reduce_across_global_groups(
+                [(found_inf, groups)], op=torch.distributed.ReduceOp.MAX
+            )
+        else:
             torch.distributed.all_reduce(
-                self.found_inf,
+                found_inf,
                 op=torch.distributed.ReduceOp.MAX,
-                group=group
+                group=groups
             )
-        if self.found_inf.device != torch.device('cuda'):
-            self.found_inf = self.found_inf.cuda()
+        if found_inf.device != torch.device('cuda'):
+            found_inf = found_inf.cuda()
+        ########## FlagScale Begin ##########
+        self.found_inf = found_inf[:1]
         # Check for nan.
-        found_inf_flag = self.found_inf.item() > 0
+        found_inf_flag, *skipped = (found_inf > 0).tolist()
+        if skip_flag is not None:
+            self._skipped = skipped[0]
+        ########## FlagScale End ##########
 
         return found_inf_flag
 
@@ -447,7 +528,11 @@ class MixedPrecisionOptimizer(MegatronOptimizer):
             # so we can update the loss scale.
             self.grad_scaler.update(found_inf_flag)
 
-            return found_inf_flag
+            ########## FlagScale Begin ##########
+            # a step skipped by skip_step_if goes through the same path as inf/nan grads
+            skipped = self._should_skip_step()
+            return found_inf_flag or skipped
+            ########## FlagScale End ##########
 
         return False
 
@@ -496,6 +581,11 @@ class MixedPrecisionOptimizer(MegatronOptimizer):
         if timers is not None:
             timers('optimizer-clip-main-grad').stop()
 
+        ########## FlagScale Begin ##########
+        if self._should_skip_step():
+            return False, None, None
+        ########## FlagScale End ##########
+
         # Count the zeros in the grads.
         if timers is not None:
             timers('optimizer-count-zeros', log_level=1).start(
@@ -858,6 +948,11 @@ class FP32Optimizer(MegatronOptimizer):
         if timers is not None:
             timers('optimizer-clip-main-grad').stop()
 
+        ########## FlagScale Begin ##########
+        if self._should_skip_step():
+            return False, None, None
+        ########## FlagScale End ##########
+
         # Count the zeros in the grads.
         if timers is not None:
             timers('optimizer-count-zeros', log_level=1).start(
@@ -1098,11 +1193,15 @@ class ChainedOptimizer(MegatronOptimizer):
             return self.chained_optimizers[0].get_grad_norm()
         if self.grads_states_parallel_group_is_shared():
             grads_for_norm = []
+            ########## FlagScale Begin ##########
+            # every optimizer holds the same flag of skip_step_if, reduced once for all
             for optimizer in self.chained_optimizers:
                 grads_for_norm += optimizer.get_main_grads_for_grad_norm()
-            grad_norm = get_grad_norm_fp32(
-                grads_for_norm, grad_stats_parallel_group=self.get_grad_stats_parallel_group()
-            )
+                skip_flag = optimizer._pop_skip_flag()
+                if skip_flag is not None:
+                    self._skip_flag = skip_flag
+            grad_norm = self._get_grad_norm_and_reduce_skip_flag(grads_for_norm)
+            ########## FlagScale End ##########
         else:
             grad_norms = []
             for optimizer in self.chained_optimizers:
@@ -1111,6 +1210,17 @@ class ChainedOptimizer(MegatronOptimizer):
             grad_norm = math.sqrt(sum([x**2 for x in grad_norms]))
         return grad_norm
 
+    ########## FlagScale Begin ##########
+    def skip_step_if(self, skip_flag: torch.Tensor):
+        for optimizer in self.chained_optimizers:
+            optimizer.skip_step_if(skip_flag)
+
+    def _should_skip_step(self) -> bool:
+        skipped = [optimizer._should_skip_step() for optimizer in self.chained_optimizers]
+        return super()._should_skip_step() or any(skipped)
+
+    ########## FlagScale End ##########
+
     @torch.no_grad()
     def count_zeros(self):
         if self.grads_states_parallel_group_is_shared():
@@ -1139,6 +1249,11 @@ class ChainedOptimizer(MegatronOptimizer):
 
         grad_norm = self.get_grad_norm()
 
+        ########## FlagScale Begin ##########
+        if self._should_skip_step():
+            return False, None, None
+        ########## FlagScale End ##########
+
         # Clip gradients.
         for optimizer in self.chained_optimizers:
             if hasattr(optimizer, 'is_stub_optimizer') and optimizer.is_stub_optimizer:
@@ -10,6 +10,8 @@ import torch
 
 from megatron.core.utils import is_torch_min_version
 
+from flagscale.train.async_eval import in_async_eval
+
 if is_torch_min_version("1.13.0"):
     dist_all_gather_func = torch.distributed.all_gather_into_tensor
 else:
@@ -213,6 +215,11 @@ class Timers:
 
     def __call__(self, name, log_level=None):
         """Call timer with name and log level."""
+        ########## FlagScale Begin ##########
+        # the timers belong to the training thread
+        if in_async_eval():
+            return self._dummy_timer
+        ########## FlagScale End ##########
         # If the timer has already been set, then check if the log-level
         # is provided, it matches the one that the timer was created with.
         if name in self._timers:
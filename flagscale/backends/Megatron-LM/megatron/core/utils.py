@@ -38,6 +38,8 @@ except ImportError:
 from megatron.core import parallel_state
 from megatron.core.dist_checkpointing.mapping import ShardedTensor
 
+from flagscale.train.async_eval import in_async_eval
+
 logger = logging.getLogger(__name__)
 
 
@@ -1657,6 +1659,11 @@ class StragglerDetector:
         Returns:
             StragglerDetector: the instance
         """
+        ########## FlagScale Begin ##########
+        # the detector belongs to the training thread
+        if in_async_eval():
+            return self
+        ########## FlagScale End ##########
         self.start()
         return self
 
@@ -1671,6 +1678,10 @@ class StragglerDetector:
         Returns:
             StragglerDetector: the instance
         """
+        ########## FlagScale Begin ##########
+        if in_async_eval():
+            return self
+        ########## FlagScale End ##########
         self.bdata = bdata
         return self
 
@@ -1694,6 +1705,10 @@ class StragglerDetector:
         if ex_type is not None:
             err = traceback.format_exception(ex_type, ex_val, ex_tb)
             logger.warning(f"{str(ex_val)}\n{err}")
+        ########## FlagScale Begin ##########
+        if in_async_eval():
+            return False
+        ########## FlagScale End ##########
         self.stop()
         return False
 
@@ -81,6 +81,8 @@ def parse_args(extra_args_provider=None, ignore_unknown_args=False):
     parser = _add_hetero_args(parser)
     parser = _add_auto_tuner_args(parser)
     parser = _add_auto_skip_spiky_loss(parser)
+    parser = _add_step_timeline_args(parser)
+    parser = _add_async_eval_args(parser)
 
     # Custom arguments.
     if extra_args_provider is not None:
@@ -2352,6 +2354,12 @@ def _add_validation_args(parser):
     group.add_argument('--extra-eval-interval', type=int, default=None,
                        help='Interval between running evaluation on '
                        'extra validation sets.')
+    group.add_argument('--extra-eval-subset-ratio', type=float, default=None,
+                       help='If set, only evaluate this fraction of every extra validation '
+                       'set, sampled once and reused at every extra evaluation.')
+    group.add_argument('--extra-eval-subset-seed', type=int, default=None,
+                       help='The seed used to sample the extra validation subsets, '
+                       'defaults to --seed.')
     group.add_argument("--test-mode", action="store_true", help='Run all real-time test alongside the experiment.')
     group.add_argument('--skip-train', action='store_true',
                        default=False, help='If set, bypass the training loop, '
@@ -2493,6 +2501,9 @@ def _add_data_args(parser):
     group.add_argument('--apply-sft-dataset-separated-loss-mask-if-existed', action='store_true',
                        help='If set, use sft dataset with separated loss mask files, '
                        'if _loss_mask_document.bin and _loss_mask_document.idx existed.')
+    group.add_argument('--sft-sequence-packing', action='store_true',
+                       help='If set, pack several conversations into every sample of the sft '
+                       'dataset with a best-fit-decreasing plan cached alongside the indices.')
 
     group.add_argument('--object-storage-cache-path', type=str, default=None,
                        help='Path to cache index files when using s3 or msc dataloader')
@@ -2913,6 +2924,10 @@ def _add_hetero_args(parser):
     group.add_argument('--expert-tensor-parallel-size-per-process-mesh', nargs='*', type=int, default=None,
                        help='The number of tensor parallel experts for each process-mesh. The number of the list should be equal to the number of process-meshes.')
     group.add_argument('--hetero-use-cpu-communication', action='store_true', help='Use CPU for communication for heterogeneous communication.')
+    group.add_argument('--hetero-comm-warmup-depth', type=int, default=1, choices=[0, 1, 2, 3],
+                       help='Process groups whose communicators are warmed up in parallel at startup: '
+                       '0 for none, 1 for the pipeline groups, 2 for the model parallel groups too, '
+                       '3 for all the groups including the data parallel ones.')
     
     return parser
 
@@ -2932,6 +2947,43 @@ def _add_auto_skip_spiky_loss(parser):
     group.add_argument('--auto-skip-spiky-loss', action='store_true',
                        help='Automatically skip spiky loss iterations.')
     group.add_argument('--spiky-loss-threshold', type=float, default=0.2,
-                          help='Threshold for skipping spiky loss iterations.')
+                          help='Threshold for skipping spiky loss iterations, relative to '
+                          'the moving mean of the losses.')
+    group.add_argument('--spiky-loss-zscore', type=float, default=4.0,
+                       help='A spiky loss must also exceed the moving mean of the losses '
+                       'by this many moving standard deviations.')
+    group.add_argument('--spiky-loss-decay', type=float, default=0.99,
+                       help='Decay of the moving mean and variance of the losses.')
+    return parser
+
+
+def _add_step_timeline_args(parser):
+    group = parser.add_argument_group(title='step timeline')
+
+    group.add_argument('--log-step-timeline', action='store_true',
+                       help='Time the phases of every training step without synchronizing '
+                       'the device, and report the throughput lost to every phase and '
+                       'the straggler ranks.')
+    group.add_argument('--step-timeline-interval', type=int, default=None,
+                       help='Number of iterations between two gathers of the step timeline '
+                       'across the ranks. Defaults to --log-interval.')
+    group.add_argument('--step-timeline-path', type=str, default=None,
+                       help='Append the step timeline reports to this jsonl file.')
+    group.add_argument('--step-timeline-peak-tflops', type=float, default=None,
+                       help='Peak TFLOP/s of a device, to report the MFU of the step timeline.')
+    group.add_argument('--step-timeline-straggler-threshold', type=float, default=1.2,
+                       help='A rank is a straggler if it is busier than the median rank '
+                       'of its pipeline stage by this ratio.')
+    return parser
+
+
+def _add_async_eval_args(parser):
+    group = parser.add_argument_group(title='async evaluation')
+
+    group.add_argument('--async-eval', action='store_true',
+                       help='Validate a snapshot of the weights in a background thread, on a '
+                       'low priority stream, while the training goes on. The results are '
+                       'logged against the iteration of the snapshot. Needs the memory of a '
+                       'second copy of the model and supports data parallelism only.')
     return parser
 ########## FlagScale End ##########
@@ -32,7 +32,7 @@ from megatron.training.global_vars import set_global_variables, set_global_write
 from megatron.training.yaml_arguments import validate_yaml
 
 from flagscale.train import FSTrainArguments
-from flagscale.train import set_parallel_context, set_get_spiky_loss_detector
+from flagscale.train import set_parallel_context, set_get_spiky_loss_detector, set_step_timeline
 
 logger = logging.getLogger(__name__)
 
@@ -125,6 +125,9 @@ def initialize_megatron(
     if args.auto_skip_spiky_loss:
         set_get_spiky_loss_detector(args=args)
 
+    if args.log_step_timeline:
+        set_step_timeline(args=args)
+
     # torch.distributed initialization
     def finish_mpu_init():
         args = get_args()
@@ -363,6 +366,9 @@ def _initialize_distributed(get_embedding_ranks, get_position_embedding_ranks):
         # Set the parallel context.
         if args.enable_hetero:
             set_parallel_context(args)
+            # Create the communicators at startup rather than during the first iteration
+            from flagscale.train.hetero.p2p_communication import warm_up_comm_group_hetero
+            warm_up_comm_group_hetero()
             return
 
         if mpu.model_parallel_is_initialized():
@@ -50,7 +50,10 @@ try:
 except ImportError:
     ALL_MODULE_WRAPPER_CLASSNAMES = (DDP, custom_FSDP, Float16Module)
 
-from flagscale.train.hetero.p2p_communication import get_device_type_for_comm
+from flagscale.train.hetero.p2p_communication import (
+    all_reduce_across_global_groups,
+    get_device_type_for_comm,
+)
 
 def unwrap_model(model, module_instances=ALL_MODULE_WRAPPER_CLASSNAMES):
     return_list = True
@@ -184,28 +187,12 @@ def calc_params_l2_norm(model, force_create_fp32_copy=False):
     if comm_device == "cpu":
         norm_2 = norm_2.cpu()
     if isinstance(mp_groups, list):  # hetero
-        original_norm_2 = norm_2.clone().detach()
-        for mp_group in mp_groups:
-            norm_2.copy_(original_norm_2)
-            torch.distributed.all_reduce(
-                norm_2, op=torch.distributed.ReduceOp.SUM, group=mp_group
-            )
-        if len(moe_params_data) > 0:
-            emp_groups = mpu.get_expert_tensor_model_pipeline_parallel_group()
-            comm_device = get_device_type_for_comm(emp_groups)
-            if comm_device == "cpu":
-                moe_norm_2 = moe_norm_2.cpu()
-
-            assert isinstance(
-                emp_groups, list
-            ), "emp_groups should be a list if mp_groups is a list"
-            original_norm_2 = moe_norm_2.clone().detach()
-            for emp_group in emp_groups:
-                moe_norm_2.copy_(original_norm_2)
-                torch.distributed.all_reduce(
-                    moe_norm_2, op=torch.distributed.ReduceOp.SUM, group=emp_group
-                )
-            norm_2 += moe_norm_2
+        # Sum the dense and expert norms across all model-parallel GPUs with a single
+        # reduction, instead of one reduction per model parallel group.
+        # Every rank takes part even without expert params to prevent hang.
+        emp_groups = mpu.get_expert_tensor_model_pipeline_parallel_group()
+        norm_2 = all_reduce_across_global_groups([(norm_2, mp_groups), (moe_norm_2, emp_groups)])
+        return norm_2.item() ** 0.5
     ########## FlagScale End ##########
     else:  # original code
 
@@ -269,10 +256,9 @@ def reduce_max_stat_across_model_parallel_group(stat: float) -> float:
         )
     else:
         stat = torch.tensor([stat], dtype=torch.float32, device=get_device_type_for_comm(model_parallel_groups[0]))
-        for model_parallel_group in model_parallel_groups:
-            torch.distributed.all_reduce(
-                stat, op=torch.distributed.ReduceOp.MAX, group=model_parallel_group
-            )
+        stat = all_reduce_across_global_groups(
+            [(stat, model_parallel_groups)], op=torch.distributed.ReduceOp.MAX
+        )
     if stat.item() == -1.0:
         return None
     else:
@@ -295,10 +281,9 @@ def logical_and_across_model_parallel_group(input: bool) -> bool:
         )
     else:
         input = torch.tensor([input], dtype=torch.int, device=get_device_type_for_comm(model_parallel_groups[0]))
-        for model_parallel_group in model_parallel_groups:
-            torch.distributed.all_reduce(
-                input, op=torch.distributed.ReduceOp.MIN, group=model_parallel_group
-            )
+        input = all_reduce_across_global_groups(
+            [(input, model_parallel_groups)], op=torch.distributed.ReduceOp.MIN
+        )
     return bool(input.item())
 
 
@@ -514,6 +499,12 @@ def get_batch_on_this_tp_rank(data_iterator):
     args = get_args()
 
     def _broadcast(item):
+        ########## FlagScale Begin ##########
+        # without tensor parallelism the batch is read directly, which keeps the async
+        # evaluation thread from communicating
+        if mpu.get_tensor_model_parallel_world_size() == 1:
+            return
+        ########## FlagScale End ##########
         if item is not None:
             torch.distributed.broadcast(
                 item,
@@ -1,3 +1,7 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 
 from compressed_tensors.quantization import (
@@ -19,18 +23,32 @@ from llmcompressor.modifiers.quantization.calibration import (
 from llmcompressor.modifiers.quantization.gptq.utils import get_output_error
 from llmcompressor.modifiers.quantization.gptq.utils.gptq_wrapper import GPTQWrapper
 from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
-from llmcompressor.modifiers.utils.pytorch_helpers import run_calibration_forward
+from llmcompressor.modifiers.utils.pytorch_helpers import (
+    EarlyStopException,
+    run_calibration_forward,
+)
+from llmcompressor.pytorch.utils import tensors_module_forward, tensors_to_device
 from llmcompressor.transformers.sparsification.compressed_tensors_utils import (
     modify_save_pretrained,
 )
 from llmcompressor.utils.fsdp.context import fix_fsdp_module_name
 from llmcompressor.utils.helpers import DisableKVCache
 
+from flagscale.compress.algo.smooth import SmoothQuantALGO
+from flagscale.compress.checkpoint import CompressCheckpoint
+from flagscale.compress.offload import (
+    ActivationSpill,
+    SafetensorsWeightLoader,
+    offload_module,
+    tensors_to,
+)
 from flagscale.runner.utils import logger
 
 __all__ = ["LLMCompressorAdapter"]
 
 QUANT_MAPPING_NAMES = {"gptq": GPTQWrapper}
+### native algorithms applied to the weights before quantization
+SMOOTH_MAPPING_NAMES = {"smoothquant": SmoothQuantALGO}
 
 
 class LLMCompressorAdapter:
@@ -43,6 +61,14 @@ class LLMCompressorAdapter:
         ignore=None,
         dataset=None,
         num_calibration_steps=384,
+        offload_dir=None,
+        model_path=None,
+        device=None,
+        checkpoint_dir=None,
+        resume=False,
+        pipeline=False,
+        num_workers=1,
+        calib_cache=None,
     ):
         self.model = model
         modify_save_pretrained(self.model)
@@ -60,6 +86,32 @@ class LLMCompressorAdapter:
         self.layer_compressors_ = []
         self.num_calibration_steps = num_calibration_steps
         self.dataset = dataset
+        ### offloaded calibration: keep one decoder layer resident and spill activations
+        self.offload_dir = offload_dir
+        self.weight_loader = SafetensorsWeightLoader(model_path) if model_path is not None else None
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        ### per-layer checkpoints to resume an interrupted calibration
+        self.checkpoint = (
+            CompressCheckpoint(checkpoint_dir, resume=resume)
+            if checkpoint_dir is not None and dataset is not None
+            else None
+        )
+        ### overlap the calibration forward of layer N+1 with the quantization of layer N
+        self.pipeline = pipeline
+        ### number of sublayers (q/k/v/o, gate/up/down, ...) quantized concurrently
+        self.num_workers = num_workers
+        ### CalibrationCache holding the first decoder layer inputs across recipes and runs
+        self.calib_cache = calib_cache
+
+        self.smoother = None
+        if self.algo in SMOOTH_MAPPING_NAMES:
+            self.smoother = SMOOTH_MAPPING_NAMES[self.algo](**(self.algo_args or {}))
+            if self.dataset is not None:
+                self.run_smoothing()
+            ### the scheme is then applied as a plain preset on the smoothed weights
+            self.algo = None
 
         if (self.algo is None and is_preset_scheme(self.scheme)) or self.algo in list(
             QUANT_MAPPING_NAMES.keys()
@@ -71,11 +123,17 @@ class LLMCompressorAdapter:
             ### overwrite forward if quantization_enabled is Tue
             apply_quantization_config(self.model, quant_config)
         if self.wrapper_cls is None:
+            if self.weight_loader is not None:
+                ### weight-only preprocessing needs every weight materialized
+                self.weight_loader.load_module(self.model, "", self.device)
             self.preprocess_weight()
         else:
             self.init_compressor()
-        if self.dataset is not None:
-            self.run_blockwise_calib_forward()
+        if self.dataset is not None and self.smoother is None:
+            if self.offload_dir is not None and self.wrapper_cls is not None:
+                self.run_offloaded_calib_forward()
+            else:
+                self.run_blockwise_calib_forward()
         self.model.apply(freeze_module_quantization)
 
     def init_quant_config(self):
@@ -136,28 +194,259 @@ class LLMCompressorAdapter:
     def add_hook(self):
         pass
 
+    def restore_checkpoint(self):
+        """Restore the layers completed by an interrupted run.
+
+        Returns:
+            The index of the last completed layer (-1 if none) and the intermediates
+            propagated out of it (None if there is nothing left to calibrate).
+        """
+        if self.checkpoint is None:
+            return -1, None
+        last_idx = self.checkpoint.last_completed_layer()
+        for layer_compressor in self.layer_compressors_[: last_idx + 1]:
+            self.checkpoint.restore_layer(layer_compressor.name, layer_compressor.layer)
+        if last_idx < 0:
+            return last_idx, None
+        logger.info(f"resume calibration after layer {self.layer_compressors_[last_idx].name}")
+        if last_idx == len(self.layer_compressors_) - 1:
+            return last_idx, None
+        return last_idx, self.checkpoint.load_intermediates()
+
+    def load_cached_layer_inputs(self):
+        """First decoder layer inputs from ``calib_cache``, None on a miss."""
+        if self.calib_cache is None:
+            return None
+        spill = self.calib_cache.load_layer_inputs()
+        if spill is None:
+            return None
+        logger.info(f"load cached calibration inputs from {spill.spill_dir}")
+        return [tensors_to(item, self.device) for item in spill]
+
+    def save_cached_layer_inputs(self, intermediates):
+        if self.calib_cache is None:
+            return
+        spill = self.calib_cache.new_layer_inputs()
+        for item in intermediates:
+            spill.append(item)
+        self.calib_cache.commit_layer_inputs(spill)
+
+    @torch.no_grad()
+    def _collect_layer_statistics(self, layer_compressor, intermediates):
+        """Wrap the sublayers of a layer and run it over ``intermediates``.
+
+        Runs in a worker thread when pipelining, hence its own ``no_grad``.
+        """
+        layer_compressor.pre_compress()
+        return layer_compressor.calibrate_layer(intermediates)
+
+    @torch.no_grad()
+    def _compress_layer(self, layer_compressor):
+        """Quantize the wrapped sublayers of a layer, ``num_workers`` at a time."""
+        if self.num_workers <= 1:
+            layer_compressor.compress()
+            return
+
+        @torch.no_grad()
+        def compress_module(module):
+            logger.info(f"Compressing {module.name}...")
+            module.compress(**self.algo_args)
+            module.free()
+
+        ### each wrapper owns its weight and Hessian, so sublayers are independent.
+        ### the wrappers hide from modules(), take them from the layer compressor
+        wrappers = list(layer_compressor.modules.values())
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            list(executor.map(compress_module, wrappers))
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    @torch.no_grad()
+    def run_smoothing(self):
+        """Stream the calibration set through the model and fold the smoothing scales."""
+        logger.info(f"start {self.algo} smoothing")
+        device = next(self.model.parameters()).device
+        self.smoother.preprocess_weight(self.model)
+        with DisableKVCache(self.model):
+            for idx, batch in enumerate(self.dataset):
+                if idx >= self.num_calibration_steps:
+                    break
+                tensors_module_forward(tensors_to_device(batch, device), self.model)
+        self.smoother.compress()
+        logger.info(f"smoothed {len(self.smoother.groups)} layer groups")
+
     @torch.no_grad()
     def run_blockwise_calib_forward(self):
+        """Calibrate and compress the decoder layers one after another.
+
+        With ``pipeline`` enabled, the statistics of layer N+1 are collected in a worker
+        thread from the unquantized outputs of layer N while layer N is being quantized.
+        Every layer is then calibrated on full-precision inputs instead of the outputs of
+        the already quantized previous layer, and the quantized forward that only measures
+        the output error is skipped.
+        """
         logger.info(f"start calibration")
         self.model.apply(disable_quantization)
-        with DisableKVCache(self.model):
-            intermediates = run_calibration_forward(
-                self.model,
-                self.dataset,
-                num_calibration_steps=self.num_calibration_steps,
-                mask_padding=False,
+        with DisableKVCache(self.model), ThreadPoolExecutor(max_workers=1) as executor:
+            last_idx, intermediates = self.restore_checkpoint()
+            if last_idx < 0:
+                intermediates = self.load_cached_layer_inputs()
+            if last_idx < 0 and intermediates is None:
+                intermediates = run_calibration_forward(
+                    self.model,
+                    self.dataset,
+                    num_calibration_steps=self.num_calibration_steps,
+                    mask_padding=False,
+                )
+                self.save_cached_layer_inputs(intermediates)
+            self.layer_compressors_[0].clear_early_stop()
+
+            next_statistics = None
+            for idx, layer_compressor in enumerate(self.layer_compressors_):
+                if idx <= last_idx:
+                    continue
+                logger.info(f"start calibration layer {layer_compressor.name}")
+                if next_statistics is not None:
+                    unquantized_outputs = next_statistics.result()
+                    next_statistics = None
+                else:
+                    unquantized_outputs = self._collect_layer_statistics(
+                        layer_compressor, intermediates
+                    )
+                if self.pipeline and idx + 1 < len(self.layer_compressors_):
+                    next_statistics = executor.submit(
+                        self._collect_layer_statistics,
+                        self.layer_compressors_[idx + 1],
+                        unquantized_outputs,
+                    )
+                self._compress_layer(layer_compressor)
+                layer_compressor.post_compress()
+                layer_compressor.revert_layer_wrappers()
+                if self.pipeline:
+                    ### the next layer is fed the unquantized outputs, so the quantized
+                    ### forward would only serve to log the error
+                    intermediates = unquantized_outputs
+                else:
+                    quantized_outputs = layer_compressor.calibrate_layer(intermediates)
+                    error = get_output_error(unquantized_outputs, quantized_outputs)
+                    logger.info(f"Mean output error from quantization: {error:.3f}")
+                    intermediates = quantized_outputs
+                if self.checkpoint is not None:
+                    if next_statistics is not None:
+                        ### the next layer must not be running while its inputs are saved
+                        next_statistics.result()
+                    self.checkpoint.save(
+                        idx, layer_compressor.name, intermediates, module=layer_compressor.layer
+                    )
+        self.model.apply(enable_quantization)
+
+    @torch.no_grad()
+    def _capture_first_layer_inputs(self, spill):
+        """Stream the inputs of the first decoder layer into ``spill``."""
+        for idx, batch in enumerate(self.dataset):
+            if idx >= self.num_calibration_steps:
+                break
+            batch = tensors_to_device(batch, self.device)
+            try:
+                tensors_module_forward(batch, self.model)
+            except EarlyStopException as e:
+                spill.append((e.args, e.kwargs))
+
+    @torch.no_grad()
+    def _calibrate_layer_offloaded(self, layer_compressor, inputs, outputs, reference=None):
+        """Run one layer over spilled ``inputs`` and spill the results into ``outputs``.
+
+        If ``reference`` is given, the mean output error against it is returned.
+        """
+        errors = []
+        for idx in range(len(inputs)):
+            args, kwargs = inputs[idx]
+            ### the layer kwargs also hold non-tensor values (attention_mask=None, use_cache=False)
+            output = layer_compressor.layer(
+                *tensors_to(args, self.device), **tensors_to(kwargs, self.device)
             )
+            outputs.append((output, kwargs))
+            if reference is not None:
+                errors.append(get_output_error([reference[idx]], [outputs[idx]]))
+        if errors:
+            return torch.stack([torch.as_tensor(e) for e in errors]).mean().item()
+        return None
+
+    @torch.no_grad()
+    def run_offloaded_calib_forward(self):
+        """Memory-bounded variant of ``run_blockwise_calib_forward``.
+
+        Only the decoder layer being calibrated is kept on ``self.device``. Its weights are
+        read from the safetensors checkpoint when the model was created with empty weights,
+        and written back to memory-mapped files under ``offload_dir`` once compressed.
+        Intermediate activations are spilled to disk one sample per file.
+        """
+        logger.info(f"start offloaded calibration, offload_dir: {self.offload_dir}")
+        layers_dir = os.path.join(self.offload_dir, "layers")
+        os.makedirs(layers_dir, exist_ok=True)
+        layer_names = [layer_compressor.name for layer_compressor in self.layer_compressors_]
+
+        self.model.apply(disable_quantization)
+        with DisableKVCache(self.model):
+            ### only the modules before and after the decoder layers are kept resident
+            if self.weight_loader is not None:
+                self.weight_loader.load_module(
+                    self.model, "", self.device, skip_prefixes=layer_names
+                )
+            last_idx, intermediates = self.restore_checkpoint()
+            if last_idx < 0 and self.calib_cache is not None:
+                intermediates = self.calib_cache.load_layer_inputs()
+                if intermediates is None:
+                    intermediates = self.calib_cache.new_layer_inputs()
+                    self._capture_first_layer_inputs(intermediates)
+                    self.calib_cache.commit_layer_inputs(intermediates)
+            elif last_idx < 0:
+                intermediates = ActivationSpill(os.path.join(self.offload_dir, "activations_input"))
+                self._capture_first_layer_inputs(intermediates)
             self.layer_compressors_[0].clear_early_stop()
 
             for idx, layer_compressor in enumerate(self.layer_compressors_):
+                if idx <= last_idx:
+                    continue
                 logger.info(f"start calibration layer {layer_compressor.name}")
+                if self.weight_loader is not None:
+                    self.weight_loader.load_module(
+                        layer_compressor.layer, layer_compressor.name, self.device
+                    )
+                else:
+                    layer_compressor.layer.to(self.device)
+
+                unquantized_outputs = ActivationSpill(
+                    os.path.join(self.offload_dir, f"activations_{idx}_unquantized")
+                )
+                quantized_outputs = ActivationSpill(
+                    os.path.join(self.offload_dir, f"activations_{idx}")
+                )
                 layer_compressor.pre_compress()
-                unquantized_outputs = layer_compressor.calibrate_layer(intermediates)
-                layer_compressor.compress()
+                self._calibrate_layer_offloaded(
+                    layer_compressor, intermediates, unquantized_outputs
+                )
+                self._compress_layer(layer_compressor)
                 layer_compressor.post_compress()
                 layer_compressor.revert_layer_wrappers()
-                quantized_outputs = layer_compressor.calibrate_layer(intermediates)
-                error = get_output_error(unquantized_outputs, quantized_outputs)
+                error = self._calibrate_layer_offloaded(
+                    layer_compressor, intermediates, quantized_outputs, unquantized_outputs
+                )
                 logger.info(f"Mean output error from quantization: {error:.3f}")
+
+                if self.checkpoint is not None:
+                    layer_path = self.checkpoint.layer_path(layer_compressor.name)
+                else:
+                    layer_path = os.path.join(layers_dir, f"{layer_compressor.name}.pt")
+                offload_module(layer_compressor.layer, layer_path)
+                if self.checkpoint is not None:
+                    ### must be recorded before the previous intermediates are removed
+                    self.checkpoint.save(idx, layer_compressor.name, quantized_outputs)
+                unquantized_outputs.cleanup()
+                intermediates.cleanup()
                 intermediates = quantized_outputs
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+            if intermediates is not None:
+                intermediates.cleanup()
         self.model.apply(enable_quantization)
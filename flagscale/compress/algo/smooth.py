@@ -0,0 +1,113 @@
+import torch
+
+from flagscale.compress.algo.algo_base import BaseALGO
+
+__all__ = ["SmoothQuantALGO"]
+
+### (balance layers, smooth layer) relative to a decoder layer, llama/qwen naming
+DEFAULT_SMOOTH_MAPPINGS = [
+    (["self_attn.q_proj", "self_attn.k_proj", "self_attn.v_proj"], "input_layernorm"),
+    (["mlp.gate_proj", "mlp.up_proj"], "post_attention_layernorm"),
+]
+
+
+class SmoothQuantALGO(BaseALGO):
+    """Activation-aware per-channel scaling folded into the model weights.
+
+    For every group of linear layers sharing an input (balance layers) and the module
+    producing that input (smooth layer, a norm or a linear), the per-channel scales are
+
+        s_j = stat(|X_j|) ** alpha / max(|W_:j|) ** (1 - alpha)
+
+    where stat is the running max (SmoothQuant) or mean (AWQ-style) of the input
+    activations. The statistics are accumulated batch by batch through forward hooks,
+    full activations are never stored. The smooth layer is divided by ``s`` and the
+    balance layers are multiplied by ``s``, which keeps the model output unchanged
+    while moving activation outliers into the weights.
+    """
+
+    def __init__(self, alpha=0.5, statistic="max", mappings=None, min_scale=1e-5):
+        super().__init__("smoothquant")
+        assert statistic in ["max", "mean"], f"Unsupported activation statistic {statistic}"
+        self.alpha = alpha
+        self.statistic = statistic
+        self.mappings = mappings if mappings is not None else DEFAULT_SMOOTH_MAPPINGS
+        self.min_scale = min_scale
+        self.groups = {}
+        self._stats = {}
+        self._counts = {}
+        self._handles = []
+
+    def preprocess_weight(self, model):
+        """Resolve the smooth/balance groups of ``model`` and hook their inputs."""
+        modules = dict(model.named_modules())
+        for name in modules:
+            for balance_names, smooth_name in self.mappings:
+                if name != smooth_name and not name.endswith(f".{smooth_name}"):
+                    continue
+                prefix = name[: -len(smooth_name)]
+                balance = [modules.get(f"{prefix}{b}") for b in balance_names]
+                if any(module is None for module in balance):
+                    continue
+                self.groups[name] = (modules[name], balance)
+
+        def add_batch_hook(name):
+            def hook(module, inputs, output):
+                self.add_batch(name, inputs[0])
+
+            return hook
+
+        ### balance layers share their input, hooking the first one is enough
+        for name, (_, balance) in self.groups.items():
+            self._handles.append(balance[0].register_forward_hook(add_batch_hook(name)))
+        self._observer = True
+
+    @torch.no_grad()
+    def add_batch(self, name, inp):
+        inp = inp.detach().reshape(-1, inp.shape[-1]).abs().float()
+        if self.statistic == "max":
+            stat = inp.amax(dim=0)
+            if name in self._stats:
+                stat = torch.maximum(self._stats[name], stat)
+        else:
+            stat = inp.sum(dim=0)
+            if name in self._stats:
+                stat = stat + self._stats[name]
+        self._stats[name] = stat
+        self._counts[name] = self._counts.get(name, 0) + inp.shape[0]
+
+    def remove_hooks(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._observer = False
+
+    def get_scales(self, name):
+        smooth, balance = self.groups[name]
+        act = self._stats[name]
+        if self.statistic == "mean":
+            act = act / self._counts[name]
+        weight = torch.cat([module.weight.detach().abs().float() for module in balance], dim=0)
+        weight = weight.amax(dim=0).clamp(min=self.min_scale).to(act.device)
+        scales = act.pow(self.alpha) / weight.pow(1 - self.alpha)
+        return scales.clamp(min=self.min_scale)
+
+    @torch.no_grad()
+    def compress(self):
+        """Fold the scales into the weights of every group seen during calibration."""
+        self.remove_hooks()
+        for name, (smooth, balance) in self.groups.items():
+            if name not in self._stats:
+                continue
+            scales = self.get_scales(name)
+            if isinstance(smooth, torch.nn.Linear):
+                smooth.weight.div_(scales.view(-1, 1).to(smooth.weight))
+            else:
+                smooth.weight.div_(scales.to(smooth.weight))
+            if getattr(smooth, "bias", None) is not None:
+                smooth.bias.div_(scales.to(smooth.bias))
+            for module in balance:
+                module.weight.mul_(scales.view(1, -1).to(module.weight))
+        self._stats = {}
+        self._counts = {}
+        self._compress = True
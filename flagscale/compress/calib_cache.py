@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+
+import torch
+
+from flagscale.compress.offload import ActivationSpill, tensors_to_cpu
+
+__all__ = ["CalibrationCache"]
+
+BATCHES_NAME = "batches.pt"
+LAYER_INPUTS_NAME = "layer_inputs"
+COMPLETE_NAME = "COMPLETE"
+
+
+class CalibrationCache:
+    """On-disk cache of calibration batches and first decoder layer inputs.
+
+    Entries are keyed by model, dataset, number of calibration samples and sequence
+    length, so recipes of one job and later runs sweeping quantization schemes skip
+    preparing the calibration data and the forward pass up to the first decoder layer.
+    The calibration forward runs with quantization disabled, hence the first layer
+    inputs do not depend on the scheme.
+    """
+
+    def __init__(self, cache_dir, model_path, dataset_path, num_samples, seq_length, dtype=None):
+        key = json.dumps([str(model_path), str(dataset_path), num_samples, seq_length, str(dtype)])
+        self.cache_dir = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest()[:16])
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, "key.json"), "w") as f:
+            f.write(key)
+
+    def _complete_file(self, name):
+        return os.path.join(self.cache_dir, f"{name}.{COMPLETE_NAME}")
+
+    def batches(self, dataset, num_batches):
+        """Return the first ``num_batches`` items of ``dataset``, cached on disk."""
+        batches_file = os.path.join(self.cache_dir, BATCHES_NAME)
+        if os.path.exists(self._complete_file(BATCHES_NAME)):
+            return torch.load(batches_file, mmap=True, weights_only=False)
+
+        batches = []
+        for idx, batch in enumerate(dataset):
+            if idx >= num_batches:
+                break
+            batches.append(tensors_to_cpu(batch))
+        torch.save(batches, batches_file)
+        open(self._complete_file(BATCHES_NAME), "w").close()
+        return batches
+
+    def load_layer_inputs(self):
+        """Cached first decoder layer inputs, None on a cache miss."""
+        if not os.path.exists(self._complete_file(LAYER_INPUTS_NAME)):
+            return None
+        return ActivationSpill.open(
+            os.path.join(self.cache_dir, LAYER_INPUTS_NAME), persistent=True
+        )
+
+    def new_layer_inputs(self):
+        """Empty spill to be filled with the first decoder layer inputs."""
+        return ActivationSpill(os.path.join(self.cache_dir, LAYER_INPUTS_NAME))
+
+    def commit_layer_inputs(self, spill):
+        """Mark ``spill`` as complete so it is reused and never cleaned up."""
+        spill.persistent = True
+        open(self._complete_file(LAYER_INPUTS_NAME), "w").close()
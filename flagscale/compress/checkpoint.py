@@ -0,0 +1,93 @@
+import json
+import os
+import shutil
+
+import torch
+
+from flagscale.compress.offload import ActivationSpill, tensors_to_cpu
+
+__all__ = ["CompressCheckpoint"]
+
+PROGRESS_NAME = "progress.json"
+INTERMEDIATES_NAME = "intermediates.pt"
+
+
+class CompressCheckpoint:
+    """Per-layer progress of one compression recipe.
+
+    After each decoder layer is compressed, its state dict and the intermediates
+    propagated to the next layer are persisted under ``checkpoint_dir``, followed by
+    ``progress.json`` which records the last completed layer. A restarted job resumes
+    from the layer after it.
+
+    Layout::
+
+        checkpoint_dir/
+            progress.json
+            layers/{layer_name}.pt
+            intermediates.pt    (only for in-memory intermediates)
+    """
+
+    def __init__(self, checkpoint_dir, resume=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.layers_dir = os.path.join(checkpoint_dir, "layers")
+        self.progress_file = os.path.join(checkpoint_dir, PROGRESS_NAME)
+        if not resume:
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        os.makedirs(self.layers_dir, exist_ok=True)
+
+    def layer_path(self, layer_name):
+        return os.path.join(self.layers_dir, f"{layer_name}.pt")
+
+    def load_progress(self):
+        if not os.path.exists(self.progress_file):
+            return None
+        with open(self.progress_file, "r") as f:
+            return json.load(f)
+
+    def last_completed_layer(self):
+        """Index of the last completed layer, -1 if no layer was completed."""
+        progress = self.load_progress()
+        return -1 if progress is None else progress["layer_idx"]
+
+    def save(self, layer_idx, layer_name, intermediates, module=None):
+        """Persist a completed layer.
+
+        ``module`` may be None if its state was already written to ``layer_path``.
+        ``intermediates`` is either an ``ActivationSpill``, which is already on disk
+        and must not be cleaned up before the next call, or a list kept in memory.
+        """
+        if module is not None:
+            layer_path = self.layer_path(layer_name)
+            torch.save(tensors_to_cpu(module.state_dict()), f"{layer_path}.tmp")
+            os.replace(f"{layer_path}.tmp", layer_path)
+
+        if isinstance(intermediates, ActivationSpill):
+            intermediates_path = intermediates.spill_dir
+        else:
+            intermediates_path = os.path.join(self.checkpoint_dir, INTERMEDIATES_NAME)
+            torch.save(intermediates, f"{intermediates_path}.tmp")
+            os.replace(f"{intermediates_path}.tmp", intermediates_path)
+
+        # progress.json is replaced atomically, it only ever points to complete files
+        progress = {
+            "layer_idx": layer_idx,
+            "layer_name": layer_name,
+            "intermediates": intermediates_path,
+        }
+        with open(f"{self.progress_file}.tmp", "w") as f:
+            json.dump(progress, f)
+        os.replace(f"{self.progress_file}.tmp", self.progress_file)
+
+    def restore_layer(self, layer_name, module):
+        """Load the compressed state of a completed layer into ``module``."""
+        state_dict = torch.load(self.layer_path(layer_name), mmap=True, weights_only=True)
+        assign = any(param.is_meta for param in module.parameters())
+        module.load_state_dict(state_dict, assign=assign)
+
+    def load_intermediates(self):
+        """Intermediates propagated out of the last completed layer."""
+        intermediates_path = self.load_progress()["intermediates"]
+        if os.path.isdir(intermediates_path):
+            return ActivationSpill.open(intermediates_path)
+        return torch.load(intermediates_path, weights_only=False)
@@ -10,6 +10,7 @@ from omegaconf import OmegaConf
 from transformers import *
 
 from flagscale.compress.adapter import LLMCompressorAdapter
+from flagscale.compress.calib_cache import CalibrationCache
 from flagscale.compress.combined_algo import prepare_compress_methods
 
 _g_ignore_fields = ["experiment", "action"]
@@ -57,24 +58,63 @@ def copy_rest_file(src_path, dst_path):
                 shutil.copytree(full_file_name, os.path.join(dst_path, filename))
 
 
-def compress(cfg, model=None, dataset=None):
+def compress(cfg, model=None, dataset=None, resume=False):
     tokenizer = None
     model_path = cfg.model.pop("model_path")
     if cfg.data.tokenzier_args is not None:
         tokenizer = AutoTokenizer.from_pretrained(
             cfg.data.tokenzier_args.pop("tokenizer_path"), **cfg.data.tokenzier_args
         )
+    offload_dir = cfg.system.get("offload_dir", None)
+    checkpoint_dir = cfg.system.get("checkpoint_dir", None)
     if model is None:
         model_cls = eval(cfg.model.pop("model_cls"))
-        model = model_cls.from_pretrained(model_path, **cfg.model)
+        if offload_dir is not None:
+            ### weights are loaded layer by layer from safetensors during calibration
+            from accelerate import init_empty_weights
+
+            model_kwargs = OmegaConf.to_container(cfg.model)
+            model_kwargs.pop("device_map", None)
+            torch_dtype = model_kwargs.pop("torch_dtype", None)
+            model_config = AutoConfig.from_pretrained(model_path, **model_kwargs)
+            with init_empty_weights(include_buffers=False):
+                model = model_cls.from_config(
+                    model_config,
+                    torch_dtype=getattr(torch, torch_dtype) if torch_dtype else None,
+                    trust_remote_code=model_kwargs.get("trust_remote_code", False),
+                )
+        else:
+            model = model_cls.from_pretrained(model_path, **cfg.model)
     assert isinstance(model, torch.nn.Module), f"model type {type(model)} error, please check it"
+    calib_cache = None
+    calib_cache_dir = cfg.system.get("calib_cache_dir", None)
+    num_calibration_steps = cfg.data.get("max_seq_length", 384)
+    if calib_cache_dir is not None and dataset is not None:
+        ### prepared once, shared by all recipes and by later runs with the same data
+        calib_cache = CalibrationCache(
+            calib_cache_dir,
+            model_path,
+            cfg.data.get("data_path", None),
+            cfg.data.get("num_calibration_samples", None),
+            cfg.data.get("max_seq_length", None),
+            dtype=next(model.parameters()).dtype,
+        )
+        dataset = calib_cache.batches(dataset, num_calibration_steps)
     compress_args = cfg.compress_args
     recipes = prepare_compress_methods(compress_args)
     for method, recipe in recipes.items():
-        for algo_args in recipe:
+        for idx, algo_args in enumerate(recipe):
             algo_args = OmegaConf.to_container(algo_args)
             algo_args["dataset"] = dataset
-            algo_args["num_calibration_steps"] = cfg.data.get("max_seq_length", 384)
+            algo_args["num_calibration_steps"] = num_calibration_steps
+            algo_args["calib_cache"] = calib_cache
+            if offload_dir is not None:
+                algo_args["offload_dir"] = os.path.join(offload_dir, f"{method}_{idx}")
+                algo_args["model_path"] = model_path
+            if checkpoint_dir is not None:
+                ### completed recipes are restored from their checkpoints on resume
+                algo_args["checkpoint_dir"] = os.path.join(checkpoint_dir, f"{method}_{idx}")
+                algo_args["resume"] = resume
             adapter = LLMCompressorAdapter(model=model, **algo_args)
             ### modify model inplace
             model = adapter.model
@@ -89,7 +129,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--config-path", type=str, required=True, help="Path to the configuration YAML file"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the last completed layer saved under system.checkpoint_dir",
+    )
     args = parser.parse_args()
     cfg = prepare_config(args.config_path)
 
-    compress(cfg)
+    compress(cfg, resume=args.resume)
@@ -60,7 +60,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--config-path", type=str, required=True, help="Path to the configuration YAML file"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the last completed layer saved under system.checkpoint_dir",
+    )
     args = parser.parse_args()
     cfg = prepare_config(args.config_path)
     dataset = prepare_dataset(cfg)
-    compress(cfg, dataset=dataset)
+    compress(cfg, dataset=dataset, resume=args.resume)
@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+
+import torch
+
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+
+__all__ = ["ActivationSpill", "SafetensorsWeightLoader", "offload_module"]
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+
+def tensors_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().cpu()
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(tensors_to_cpu(o) for o in obj)
+    if isinstance(obj, dict):
+        return {k: tensors_to_cpu(v) for k, v in obj.items()}
+    return obj
+
+
+def tensors_to(obj, device):
+    """Move the tensors nested in ``obj`` to ``device``, other values are passed through."""
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(tensors_to(o, device) for o in obj)
+    if isinstance(obj, dict):
+        return {k: tensors_to(v, device) for k, v in obj.items()}
+    return obj
+
+
+class ActivationSpill:
+    """List-like store of calibration intermediates spilled to disk.
+
+    Every appended item (usually an ``(args, kwargs)`` tuple of layer inputs or outputs)
+    is saved to its own file under ``spill_dir`` and loaded back memory-mapped on access,
+    so only the item being processed occupies host memory. A ``persistent`` spill is
+    shared (e.g. cached across runs) and is not removed by ``cleanup``.
+    """
+
+    def __init__(self, spill_dir):
+        self.spill_dir = spill_dir
+        self.persistent = False
+        self._paths = []
+        # a new spill never picks up files left by an interrupted run
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+    @classmethod
+    def open(cls, spill_dir, persistent=False):
+        """Reattach to the files of an existing spill."""
+        spill = cls.__new__(cls)
+        spill.spill_dir = spill_dir
+        spill.persistent = persistent
+        spill._paths = sorted(
+            os.path.join(spill_dir, name) for name in os.listdir(spill_dir) if name.endswith(".pt")
+        )
+        return spill
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __getitem__(self, idx):
+        # kwargs of decoder layers may contain non-tensor objects
+        return torch.load(self._paths[idx], mmap=True, weights_only=False)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def append(self, item):
+        path = os.path.join(self.spill_dir, f"{len(self._paths):08d}.pt")
+        torch.save(tensors_to_cpu(item), path)
+        self._paths.append(path)
+
+    def cleanup(self):
+        if self.persistent:
+            return
+        self._paths = []
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+class SafetensorsWeightLoader:
+    """Materializes parameters left on the meta device from a safetensors checkpoint.
+
+    Only the tensors of the requested module are read, which allows a model created with
+    ``accelerate.init_empty_weights`` to be loaded one decoder layer at a time.
+    """
+
+    def __init__(self, model_path):
+        if not os.path.isdir(model_path):
+            from huggingface_hub import snapshot_download
+
+            model_path = snapshot_download(model_path, allow_patterns=["*.json", "*.safetensors"])
+        self.model_path = model_path
+
+        index_file = os.path.join(model_path, SAFE_WEIGHTS_INDEX_NAME)
+        if os.path.exists(index_file):
+            with open(index_file, "r") as f:
+                self.weight_map = json.load(f)["weight_map"]
+        else:
+            weights_file = os.path.join(model_path, SAFE_WEIGHTS_NAME)
+            assert os.path.exists(weights_file), f"No safetensors checkpoint found in {model_path}"
+            with safe_open(weights_file, framework="pt") as f:
+                self.weight_map = {name: SAFE_WEIGHTS_NAME for name in f.keys()}
+
+    def _read(self, names):
+        tensors = {}
+        by_file = {}
+        for name in names:
+            by_file.setdefault(self.weight_map[name], []).append(name)
+        for filename, file_names in by_file.items():
+            with safe_open(os.path.join(self.model_path, filename), framework="pt") as f:
+                for name in file_names:
+                    tensors[name] = f.get_tensor(name)
+        return tensors
+
+    def load_module(self, module, prefix, device, skip_prefixes=()):
+        """Move ``module`` to ``device``, reading its meta parameters from the checkpoint.
+
+        Meta parameters missing from the checkpoint (e.g. quantization scales) are
+        allocated uninitialized, their values are computed during calibration.
+        Parameters whose name starts with one of ``skip_prefixes`` are left untouched.
+        """
+        params = {}
+        for name, param in module.named_parameters():
+            full_name = f"{prefix}.{name}" if prefix else name
+            if any(full_name.startswith(f"{p}.") for p in skip_prefixes):
+                continue
+            params[name] = (full_name, param)
+
+        checkpoint = self._read(
+            [
+                full_name
+                for full_name, param in params.values()
+                if param.is_meta and full_name in self.weight_map
+            ]
+        )
+        for name, (full_name, param) in params.items():
+            if full_name in checkpoint:
+                value = checkpoint.pop(full_name).to(param.dtype)
+            elif param.is_meta:
+                value = torch.empty(param.shape, dtype=param.dtype)
+            else:
+                value = param.data
+            set_module_tensor_to_device(module, name, device, value=value)
+
+
+def offload_module(module, path):
+    """Save the state of ``module`` to ``path`` and map it back from disk.
+
+    The parameters are replaced by file-backed memory-mapped tensors, so the pages of an
+    already calibrated layer can be evicted by the OS instead of staying resident.
+    """
+    # never truncate a file that may still be mapped by the current parameters
+    torch.save(tensors_to_cpu(module.state_dict()), f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    state_dict = torch.load(path, mmap=True, weights_only=True)
+    module.load_state_dict(state_dict, assign=True)
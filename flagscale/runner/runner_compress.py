@@ -105,6 +105,8 @@ def _generate_run_script_compress(config, host, node_rank, cmd, background=True,
         f.write("#!/bin/bash\n\n")
         f.write(f"{before_start}\n")
         f.write(f"mkdir -p {system_config.save_dir}\n")
+        if system_config.get("checkpoint_dir", None):
+            f.write(f"mkdir -p {system_config.checkpoint_dir}\n")
         f.write(f"mkdir -p {system_config.logging.log_dir}\n")
         f.write(f"mkdir -p {system_config.logging.pids_dir}\n")
         f.write(f"mkdir -p {system_config.logging.tensorboard_dir}\n")
@@ -163,12 +165,14 @@ class SSHCompressRunner(RunnerBase):
         nproc_per_node,
         with_test=False,
         dryrun=False,
+        resume=False,
     ):
         export_cmd = []
         for k, v in self.user_envs.items():
             export_cmd += [f"{k}={v}"]
 
-        cmd = shlex.join(export_cmd + ["python"] + [self.user_script] + self.user_args)
+        user_args = self.user_args + (["--resume"] if resume else [])
+        cmd = shlex.join(export_cmd + ["python"] + [self.user_script] + user_args)
 
         logging_config = self.config.compress.system.logging
         host_run_script_file = _generate_run_script_compress(
@@ -192,7 +196,12 @@ class SSHCompressRunner(RunnerBase):
         else:
             run_local_command(f"bash {host_run_script_file}", dryrun)
 
-    def run(self, with_test=False, dryrun=False):
+    def run(self, with_test=False, dryrun=False, resume=False):
+        if resume:
+            assert self.config.compress.system.get(
+                "checkpoint_dir", None
+            ), "compress.system.checkpoint_dir must be set to resume a compression job"
+
         num_visible_devices = None
         visible_devices = self.user_envs.get("CUDA_VISIBLE_DEVICES", None)
         if visible_devices is not None and isinstance(visible_devices, str):
@@ -227,6 +236,7 @@ class SSHCompressRunner(RunnerBase):
                     nproc_per_node,
                     with_test=with_test,
                     dryrun=dryrun,
+                    resume=resume,
                 )
         else:
             # If hostfile is not provided, run the job on localhost
@@ -243,6 +253,7 @@ class SSHCompressRunner(RunnerBase):
                 nproc_per_node,
                 with_test=with_test,
                 dryrun=dryrun,
+                resume=resume,
             )
 
     def stop(self):
@@ -3,7 +3,9 @@ from .global_vars import (
     get_extra_valid_datasets,
     get_parallel_context,
     get_spiky_loss_detector,
+    get_step_timeline,
     set_extra_valid_datasets,
     set_get_spiky_loss_detector,
     set_parallel_context,
+    set_step_timeline,
 )
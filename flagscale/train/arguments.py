@@ -297,4 +297,20 @@ class FSTrainArguments:
             "recompute_num_layers_per_stage_micro_batch",
         )
 
+        if args.async_eval:
+            # The background validation must not communicate while the training does.
+            assert (
+                args.tensor_model_parallel_size == 1
+                and args.pipeline_model_parallel_size == 1
+                and args.context_parallel_size == 1
+                and args.expert_model_parallel_size == 1
+                and not args.enable_hetero
+            ), "async-eval supports data parallelism only."
+            assert args.eval_interval, "async-eval needs an eval-interval."
+            # Nor drive the rerun state machine of the training, the validation results are
+            # then only checked as evaluate does with the rerun mode disabled.
+            assert (
+                args.rerun_mode == "disabled" and not args.check_for_spiky_loss
+            ), "async-eval needs --rerun-mode disabled and no --check-for-spiky-loss."
+
         # TODO: update other args if need
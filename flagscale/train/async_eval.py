@@ -0,0 +1,126 @@
+import collections
+import concurrent.futures
+import threading
+
+import torch
+
+_thread_state = threading.local()
+
+
+def in_async_eval():
+    """Whether the caller runs in the validation thread of an AsyncEvaluator.
+
+    The timers and the straggler detector of the training are left alone in that thread.
+    """
+    return getattr(_thread_state, "active", False)
+
+
+def _enter_async_eval():
+    _thread_state.active = True
+
+
+class AsyncEvaluator:
+    """Validation of a snapshot of the weights overlapping the training.
+
+    At every submit, the weights of the trained model are copied into an evaluation replica
+    on the current stream, then evaluate_func runs on the replica in a background thread and
+    on a separate stream of the lowest priority, so the training goes on during the validation.
+
+    evaluate_func must not communicate, it returns the local sum and count of every loss as
+    {key: tensor([sum, count])}. The losses are reduced across group by poll, called by all the
+    ranks at the same iterations, once every rank completed the validation. The replica is
+    shared by the validations, so a submit waits for the previous validation to complete.
+    The weights are paired by name once both models are unwrapped with unwrap_func.
+    """
+
+    def __init__(self, eval_model, evaluate_func, group=None, use_cuda=None, unwrap_func=None):
+        self.eval_model = eval_model
+        self.evaluate_func = evaluate_func
+        self.group = group
+        self.unwrap_func = unwrap_func or (lambda model: model)
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="async-eval", initializer=_enter_async_eval
+        )
+        self._pending = collections.deque()
+        if self.use_cuda:
+            self._device = torch.cuda.current_device()
+            lowest_priority, _ = torch.cuda.Stream.priority_range()
+            self._stream = torch.cuda.Stream(priority=lowest_priority)
+
+    def _named_tensors(self, model):
+        for model_module in self.unwrap_func(model):
+            yield from model_module.named_parameters()
+            yield from model_module.named_buffers()
+
+    def submit(self, iteration, model, context=None):
+        """Validate the current weights of model, context is returned with the losses."""
+        concurrent.futures.wait([future for _, _, future in self._pending])
+        with torch.no_grad():
+            for (name, src), (eval_name, dst) in zip(
+                self._named_tensors(model), self._named_tensors(self.eval_model)
+            ):
+                assert name == eval_name, f"{name} does not match {eval_name} of the eval model"
+                dst.copy_(src)
+        ready = None
+        if self.use_cuda:
+            ready = torch.cuda.Event()
+            ready.record()
+        future = self._executor.submit(self._evaluate, ready)
+        self._pending.append((iteration, context, future))
+
+    def _evaluate(self, ready):
+        if not self.use_cuda:
+            return self._to_host(self.evaluate_func(self.eval_model))
+        # the current device and stream are per thread
+        torch.cuda.set_device(self._device)
+        with torch.cuda.stream(self._stream):
+            self._stream.wait_event(ready)
+            return self._to_host(self.evaluate_func(self.eval_model))
+
+    @staticmethod
+    def _to_host(total_loss_dict):
+        return {key: val.tolist() for key, val in total_loss_dict.items()}
+
+    def poll(self, wait=False):
+        """Return the (iteration, context, losses) of the validations completed on all the ranks.
+
+        Called by all the ranks, wait blocks until all the submitted validations complete.
+        """
+        if not self._pending:
+            return []
+        if wait:
+            concurrent.futures.wait([future for _, _, future in self._pending])
+        num_done = 0
+        for _, _, future in self._pending:
+            if not future.done():
+                break
+            num_done += 1
+
+        device = "cuda" if torch.distributed.get_backend(self.group) == "nccl" else "cpu"
+        count = torch.tensor([num_done], dtype=torch.int64, device=device)
+        torch.distributed.all_reduce(count, op=torch.distributed.ReduceOp.MIN, group=self.group)
+        done = [self._pending.popleft() for _ in range(int(count.item()))]
+        if not done:
+            return []
+
+        # the exception of a failed validation is raised here
+        results = [(iteration, context, future.result()) for iteration, context, future in done]
+        sums = torch.tensor(
+            [val for _, _, losses in results for key in sorted(losses) for val in losses[key]],
+            dtype=torch.float,
+            device=device,
+        ).view(-1, 2)
+        torch.distributed.all_reduce(sums, group=self.group)
+        sums = iter(sums.cpu())
+        reduced = []
+        for iteration, context, losses in results:
+            total_loss_dict = {}
+            for key in sorted(losses):
+                numerator, denominator = next(sums)
+                total_loss_dict[key] = numerator / denominator
+            reduced.append((iteration, context, total_loss_dict))
+        return reduced
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -1,4 +1,4 @@
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Sequence, Tuple, Union
 
 import numpy
 
@@ -6,45 +6,119 @@ from megatron.core.datasets.indexed_dataset import IndexedDataset
 
 
 class ConcatedIndexedDataset(IndexedDataset):
+    """Concatenation of several IndexedDatasets exposed as a single IndexedDataset
+
+    Args:
+        datasets (List[IndexedDataset]): The datasets to concatenate, in order
+    """
+
     def __init__(self, datasets) -> None:
         self.path_prefix = datasets[-1].path_prefix
         self.datasets = datasets
-        self.offsets = [0]
-        for dataset in datasets:
-            self.offsets.append(self.offsets[-1] + len(dataset))
+        # offsets[i] is the global index of the first sequence of datasets[i]
+        self.offsets = numpy.cumsum([0] + [len(dataset) for dataset in datasets], dtype=numpy.int64)
+        self._sequence_lengths = None
+        self._document_indices = None
 
     def __del__(self) -> None:
         for dataset in self.datasets:
             del dataset
 
     def __len__(self) -> int:
-        return self.offsets[-1]
+        return int(self.offsets[-1])
+
+    def _locate(self, idx: Union[int, numpy.integer]) -> Tuple[int, int]:
+        """Map a global sequence index to (dataset index, local sequence index)"""
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"index {idx} out of range for dataset of size {len(self)}")
+        i = int(numpy.searchsorted(self.offsets, idx, side="right")) - 1
+        return i, int(idx - self.offsets[i])
 
     def __getitem__(
         self, idx: Union[int, numpy.integer, slice]
-    ) -> Union[numpy.ndarray, Tuple[numpy.ndarray, numpy.ndarray]]:
-        for i, size in enumerate(self.offsets[1:]):
-            if idx < size:
-                break
-        return self.datasets[i][idx - self.offsets[i]]
+    ) -> Union[
+        numpy.ndarray,
+        Tuple[numpy.ndarray, numpy.ndarray],
+        List[numpy.ndarray],
+        Tuple[List[numpy.ndarray], numpy.ndarray],
+    ]:
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step != 1:
+                raise ValueError("Slices into indexed_dataset must be contiguous")
+            # Read every overlapped dataset with a single contiguous slice
+            sequences = []
+            modes = []
+            for i in range(len(self.datasets)):
+                lo = max(start, self.offsets[i])
+                hi = min(stop, self.offsets[i + 1])
+                if lo >= hi:
+                    continue
+                part = self.datasets[i][lo - self.offsets[i] : hi - self.offsets[i]]
+                if isinstance(part, tuple):
+                    sequences.extend(part[0])
+                    modes.append(part[1])
+                else:
+                    sequences.extend(part)
+            if modes:
+                return sequences, numpy.concatenate(modes)
+            return sequences
+
+        i, local_idx = self._locate(idx)
+        return self.datasets[i][local_idx]
 
     def get(self, idx: int, offset: int = 0, length: Optional[int] = None) -> numpy.ndarray:
-        for i, size in enumerate(self.offsets[1:]):
-            if idx < size:
-                break
+        i, local_idx = self._locate(idx)
+        return self.datasets[i].get(local_idx, offset, length)
+
+    def get_many(
+        self, indices: Sequence[int], offset: int = 0, length: Optional[int] = None
+    ) -> List[numpy.ndarray]:
+        """Retrieve many sequences at once
+
+        The owning dataset of every index is found with a single search over the offsets,
+        then every sequence is read from its dataset.
+
+        Args:
+            indices (Sequence[int]): The global sequence indices
+
+            offset (int): The integer token offset in each sequence
+
+            length (Optional[int]): The number of tokens to grab from each sequence
+
+        Returns:
+            List[numpy.ndarray]: The sequences, in the order of indices
+        """
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        indices = numpy.where(indices < 0, indices + len(self), indices)
+        if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError(f"indices out of range for dataset of size {len(self)}")
+        dataset_ids = numpy.searchsorted(self.offsets, indices, side="right") - 1
+        local_indices = indices - self.offsets[dataset_ids]
 
-        return self.datasets[i].get(idx - self.offsets[i], offset, length)
+        return [
+            self.datasets[i].get(int(local_idx), offset, length)
+            for i, local_idx in zip(dataset_ids, local_indices)
+        ]
 
     @property
     def sequence_lengths(self) -> numpy.ndarray:
-        return numpy.concatenate([dataset.sequence_lengths for dataset in self.datasets])
+        if self._sequence_lengths is None:
+            self._sequence_lengths = numpy.concatenate(
+                [dataset.sequence_lengths for dataset in self.datasets]
+            )
+        return self._sequence_lengths
 
     @property
     def document_indices(self) -> numpy.ndarray:
-        return numpy.concatenate(
-            [
-                dataset.document_indices[:-1] + offset
-                for dataset, offset in zip(self.datasets, self.offsets)
-            ]
-            + [numpy.array([len(self)])]
-        )
+        if self._document_indices is None:
+            self._document_indices = numpy.concatenate(
+                [
+                    dataset.document_indices[:-1] + offset
+                    for dataset, offset in zip(self.datasets, self.offsets)
+                ]
+                + [numpy.array([len(self)])]
+            )
+        return self._document_indices
@@ -5,7 +5,7 @@ import os
 import time
 
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy
 import torch
@@ -16,7 +16,9 @@ from megatron.core.datasets.gpt_dataset import (
     _get_ltor_masks_and_position_ids,
 )
 from megatron.core.datasets.indexed_dataset import IndexedDataset, get_bin_path, get_idx_path
-from megatron.core.datasets.utils import Split
+from megatron.core.datasets.utils import Split, is_built_on_zero_rank
+from megatron.core.packed_seq_params import PackedSeqParams
+from megatron.core.utils import log_single_rank
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +30,9 @@ class SFTDatasetConfig(GPTDatasetConfig):
     apply_sft_dataset_separated_loss_mask_if_existed: bool = None
     """Option to apply separated loss mask files"""
 
+    sft_sequence_packing: bool = False
+    """Option to pack several conversations into every sample with a best-fit-decreasing plan"""
+
 
 class SFTDataset(GPTDataset):
     """The base GPT dataset
@@ -59,6 +64,7 @@ class SFTDataset(GPTDataset):
         self.apply_sft_dataset_separated_loss_mask_if_existed = (
             config.apply_sft_dataset_separated_loss_mask_if_existed
         )
+        self.sft_sequence_packing = config.sft_sequence_packing
         self.loss_mask_dataset = None
 
         super().__init__(
@@ -90,6 +96,217 @@ class SFTDataset(GPTDataset):
                         self.loss_mask_dataset
                     ), f"Samples are not equal, ({len(self.dataset)} != {len(self.loss_mask_dataset)})"
 
+    @staticmethod
+    def _key_config_attributes() -> List[str]:
+        """Inherited method implementation
+
+        Returns:
+            List[str]: The key config attributes
+        """
+        return super(SFTDataset, SFTDataset)._key_config_attributes() + ["sft_sequence_packing"]
+
+    def __len__(self) -> int:
+        """Abstract method implementation
+
+        Returns:
+            int: The length of the dataset
+        """
+        if self.sft_sequence_packing:
+            return self.shuffle_index.shape[0]
+        return super().__len__()
+
+    def _build_document_sample_shuffle_indices(
+        self,
+    ) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """Build the document index, the sample index, and the shuffle index
+
+        Without packing these are the GPTDataset indices. With packing:
+
+        The document index:
+            -- 1-D
+            -- The document ids grouped by packed sample
+
+        The sample index:
+            -- 1-D
+            -- The offsets into the document index which mark the start of every packed sample
+
+        The shuffle index:
+            -- 1-D
+            -- A random permutation of the packed samples per epoch, for as many epochs as
+               needed to draw num_samples
+
+        Returns:
+            Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]: The document index, the sample
+            index, and the shuffle index
+        """
+        if not self.sft_sequence_packing:
+            return super()._build_document_sample_shuffle_indices()
+
+        path_to_cache = self.config.path_to_cache
+        if path_to_cache is None:
+            path_to_cache = os.path.join(
+                self.dataset.path_prefix, "cache", f"{type(self).__name__}_indices"
+            )
+
+        base = f"{self.unique_description_hash}-{type(self).__name__}-{self.index_split.name}"
+        get_path_to = lambda affix: os.path.join(path_to_cache, f"{base}-{affix}")
+        path_to_description = get_path_to("description.txt")
+        path_to_document_index = get_path_to("pack_document_index.npy")
+        path_to_sample_index = get_path_to("pack_sample_index.npy")
+        path_to_shuffle_index = get_path_to("pack_shuffle_index.npy")
+        cache_hit = all(
+            map(
+                os.path.isfile,
+                [
+                    path_to_description,
+                    path_to_document_index,
+                    path_to_sample_index,
+                    path_to_shuffle_index,
+                ],
+            )
+        )
+
+        if not cache_hit and (not torch.distributed.is_initialized() or is_built_on_zero_rank()):
+            log_single_rank(
+                logger,
+                logging.INFO,
+                f"Build and save the packed {type(self).__name__} {self.index_split.name} indices",
+            )
+            t_beg = time.time()
+
+            # Every document contributes len - 1 (tokens, labels) pairs, at most sequence_length
+            documents = numpy.asarray(self.indices, dtype=numpy.int64)
+            lengths = self.dataset.sequence_lengths[documents].astype(numpy.int64) - 1
+            documents = documents[lengths > 0]
+            lengths = numpy.minimum(lengths[lengths > 0], self.config.sequence_length)
+
+            order, sample_index = _build_packing_plan(lengths, self.config.sequence_length)
+            document_index = documents[order]
+
+            num_packed_samples = sample_index.shape[0] - 1
+            num_epochs = 1
+            if self.num_samples is not None and num_packed_samples > 0:
+                num_epochs = max(1, -(-self.num_samples // num_packed_samples))
+            numpy_random_state = numpy.random.RandomState(self.config.random_seed)
+            shuffle_index = numpy.concatenate(
+                [
+                    numpy_random_state.permutation(num_packed_samples).astype(numpy.int64)
+                    for _ in range(num_epochs)
+                ]
+            )
+
+            os.makedirs(path_to_cache, exist_ok=True)
+            with open(path_to_description, "wt") as writer:
+                writer.write(self.unique_description)
+            numpy.save(path_to_document_index, document_index, allow_pickle=True)
+            numpy.save(path_to_sample_index, sample_index, allow_pickle=True)
+            numpy.save(path_to_shuffle_index, shuffle_index, allow_pickle=True)
+
+            t_end = time.time()
+            log_single_rank(logger, logging.DEBUG, f"\t> time elapsed: {t_end - t_beg:4f} seconds")
+            log_single_rank(
+                logger,
+                logging.INFO,
+                f"> packed {len(documents)} documents into {num_packed_samples} samples, "
+                f"{lengths.sum() / max(num_packed_samples * self.config.sequence_length, 1):.2%} "
+                f"of the tokens are not padding",
+            )
+            log_single_rank(logger, logging.INFO, f"> total number of epochs: {num_epochs}")
+
+            return document_index, sample_index, shuffle_index
+
+        log_single_rank(
+            logger,
+            logging.INFO,
+            f"Load the packed {type(self).__name__} {self.index_split.name} indices",
+        )
+        document_index = numpy.load(path_to_document_index, allow_pickle=True, mmap_mode='r')
+        sample_index = numpy.load(path_to_sample_index, allow_pickle=True, mmap_mode='r')
+        shuffle_index = numpy.load(path_to_shuffle_index, allow_pickle=True, mmap_mode='r')
+        log_single_rank(
+            logger, logging.INFO, f"> total number of packed samples: {sample_index.shape[0] - 1}"
+        )
+
+        return document_index, sample_index, shuffle_index
+
+    def _get_packed_item(self, idx: Optional[int]) -> Dict[str, torch.Tensor]:
+        """Concatenate the documents of a packed sample
+
+        Every document is shifted on its own so that no label crosses a document boundary.
+        Position ids restart at every document, the attention mask (if created) is block
+        diagonal and cu_seqlens holds the document boundaries, padded to a fixed size with
+        the sequence length so that samples can be collated.
+
+        Args:
+            idx (Optioal[int]): The index into the dataset
+
+        Returns:
+            Dict[str, torch.Tensor]: The sample information wrapped in a dictionary
+        """
+        sequence_length = self.config.sequence_length
+        sample = self.shuffle_index[0 if idx is None else idx]
+        beg, end = self.sample_index[sample], self.sample_index[sample + 1]
+
+        tokens = numpy.zeros(sequence_length, dtype=numpy.int64)
+        labels = numpy.zeros(sequence_length, dtype=numpy.int64)
+        loss_mask = numpy.zeros(sequence_length, dtype=numpy.float32)
+        position_ids = numpy.zeros(sequence_length, dtype=numpy.int64)
+        cu_seqlens = numpy.full(sequence_length + 1, sequence_length, dtype=numpy.int32)
+        cu_seqlens[0] = 0
+
+        offset = 0
+        for i, document_id in enumerate(self.document_index[beg:end]):
+            text = self.dataset.get(document_id, length=sequence_length + 1).astype(numpy.int64)
+            length = len(text) - 1
+            tokens[offset : offset + length] = text[:-1]
+            labels[offset : offset + length] = text[1:]
+            if self.loss_mask_dataset is not None:
+                aux_loss_mask = self.loss_mask_dataset.get(document_id, length=sequence_length + 1)
+                loss_mask[offset : offset + length] = aux_loss_mask[1:]
+            else:
+                loss_mask[offset : offset + length] = 1.0
+                if self.config.eod_mask_loss:
+                    loss_mask[offset : offset + length][
+                        text[:-1] == self.config.tokenizer.eod
+                    ] = 0.0
+            position_ids[offset : offset + length] = numpy.arange(length)
+            offset += length
+            cu_seqlens[i + 1] = offset
+        # The padding tail is a segment of its own
+        position_ids[offset:] = numpy.arange(sequence_length - offset)
+
+        tokens = torch.from_numpy(tokens)
+        labels = torch.from_numpy(labels)
+        loss_mask = torch.from_numpy(loss_mask)
+        position_ids = torch.from_numpy(position_ids)
+        cu_seqlens = torch.from_numpy(cu_seqlens)
+
+        # For padded sequences, ensure the embedding layer can map the token ID
+        tokens[tokens == self._pad_token_id] = 0
+        labels[labels == self._pad_token_id] = 0
+
+        # Batch padding sequence so we mask the loss
+        if idx is None:
+            loss_mask = torch.zeros_like(loss_mask)
+
+        item = {
+            "tokens": tokens,
+            "labels": labels,
+            "loss_mask": loss_mask,
+            "position_ids": position_ids,
+            "cu_seqlens": cu_seqlens,
+        }
+        if self.config.create_attention_mask:
+            document_ids = torch.bucketize(
+                torch.arange(sequence_length, dtype=torch.int32), cu_seqlens[1:], right=True
+            )
+            attention_mask = torch.tril(
+                document_ids.unsqueeze(0) == document_ids.unsqueeze(1)
+            ).unsqueeze(0)
+            # Convert attention mask to binary, True means masked out
+            item["attention_mask"] = ~attention_mask
+        return item
+
     def __getitem__(self, idx: Optional[int]) -> Dict[str, torch.Tensor]:
         """Abstract method implementation
 
@@ -99,6 +316,9 @@ class SFTDataset(GPTDataset):
         Returns:
             Dict[str, torch.Tensor]: The sample information wrapped in a dictionary
         """
+        if self.sft_sequence_packing:
+            return self._get_packed_item(idx)
+
         if idx is None:
             # Batch padding sequence so the index does not matter
             text, _ = self._query_document_sample_shuffle_indices(0)
@@ -228,3 +448,98 @@ class SFTDataset(GPTDataset):
             numpy.array(numpy.concatenate(sample_parts), dtype=numpy.int64),
             numpy.array(document_ids, dtype=numpy.int64),
         )
+
+
+def _build_packing_plan(
+    lengths: numpy.ndarray, capacity: int
+) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Pack items into bins of a fixed capacity with the best-fit-decreasing heuristic
+
+    Items are placed from the longest to the shortest, each one into the open bin with the
+    smallest remaining capacity that still fits it. The open bins are bucketed by remaining
+    capacity and a segment tree over the buckets finds the best fit in O(log(capacity)).
+
+    Args:
+        lengths (numpy.ndarray): The item lengths, each in [1, capacity]
+
+        capacity (int): The bin capacity
+
+    Returns:
+        Tuple[numpy.ndarray, numpy.ndarray]: The item indices grouped by bin, and the offsets
+        into them which mark the start of every bin
+    """
+    assert len(lengths) == 0 or (lengths.min() >= 1 and lengths.max() <= capacity)
+
+    size = 1
+    while size < capacity + 1:
+        size *= 2
+    # tree[size + r] counts the open bins with remaining capacity r
+    tree = [0] * (2 * size)
+    buckets = [[] for _ in range(capacity + 1)]
+    bins = []
+
+    def update(remaining, delta):
+        i = size + remaining
+        while i:
+            tree[i] += delta
+            i //= 2
+
+    def best_fit(length):
+        # The leftmost non empty bucket at or after length
+        i = size + length
+        if tree[i]:
+            return length
+        while i > 1:
+            if i % 2 == 0 and tree[i + 1]:
+                i += 1
+                break
+            i //= 2
+        else:
+            return -1
+        while i < size:
+            i = 2 * i if tree[2 * i] else 2 * i + 1
+        return i - size
+
+    for item in numpy.argsort(-lengths, kind="stable"):
+        length = int(lengths[item])
+        remaining = best_fit(length)
+        if remaining < 0:
+            bin_id = len(bins)
+            bins.append([])
+            remaining = capacity
+        else:
+            bin_id = buckets[remaining].pop()
+            update(remaining, -1)
+        bins[bin_id].append(item)
+        remaining -= length
+        if remaining > 0:
+            buckets[remaining].append(bin_id)
+            update(remaining, 1)
+
+    order = numpy.array([item for items in bins for item in items], dtype=numpy.int64)
+    offsets = numpy.zeros(len(bins) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(items) for items in bins], out=offsets[1:])
+    return order, offsets
+
+
+def get_packed_seq_params(cu_seqlens: torch.Tensor) -> PackedSeqParams:
+    """Build the THD attention parameters of a packed micro batch
+
+    Args:
+        cu_seqlens (torch.Tensor): The padded document boundaries of a packed sample as
+        collated by the dataloader, of shape [1, sequence_length + 1]
+
+    Returns:
+        PackedSeqParams: The parameters which keep the documents from attending to each other
+    """
+    assert cu_seqlens.shape[0] == 1, "Sequence packing requires --micro-batch-size 1"
+    # The padding entries repeat the sequence length, empty documents repeat their offset
+    cu_seqlens = torch.unique_consecutive(cu_seqlens[0].to(torch.int32))
+    max_seqlen = (cu_seqlens[1:] - cu_seqlens[:-1]).max().item()
+    return PackedSeqParams(
+        qkv_format="thd",
+        cu_seqlens_q=cu_seqlens,
+        cu_seqlens_kv=cu_seqlens,
+        max_seqlen_q=max_seqlen,
+        max_seqlen_kv=max_seqlen,
+    )
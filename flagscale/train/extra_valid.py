@@ -1,5 +1,6 @@
 import math
 
+import numpy
 import torch
 
 from megatron.core import mpu
@@ -75,13 +76,19 @@ def extra_valid_datasets_provider(data_path, num_samples):
     return extra_valid_ds
 
 
-def build_extra_valid_datasets(build_extra_valid_dataset_provider):
-    """Build extra_valid datasets."""
+def init_extra_valid_metadata():
+    """Parse extra_valid_data_path into the number of samples and iterations of every dataset.
+
+    This only depends on the arguments, so it is done on every rank without building any dataset.
+    Returns the number of extra validation datasets.
+    """
 
     args = get_args()
 
     if args.extra_valid_data_path is None:
-        return [None]
+        return 0
+    if getattr(args, "extra_eval_iters_list", None) is not None:
+        return len(args.extra_eval_iters_list)
 
     assert (
         len(args.extra_valid_data_path) % 2 == 0
@@ -92,7 +99,11 @@ def build_extra_valid_datasets(build_extra_valid_dataset_provider):
         *[(blend[i], blend[i + 1]) for i in range(0, len(blend), 2)]
     )
 
+    subset_ratio = getattr(args, "extra_eval_subset_ratio", None)
+    assert subset_ratio is None or 0 < subset_ratio <= 1, "extra_eval_subset_ratio should be in (0, 1]"
+
     num_samples_per_dataset = []
+    eval_samples_per_dataset = []
     valid_iters_per_dataset = []
     for rntpd in raw_num_tokens_per_dataset:
         try:
@@ -107,31 +118,59 @@ def build_extra_valid_datasets(build_extra_valid_dataset_provider):
         eval_iters = (num_samples + args.global_batch_size - 1) // args.global_batch_size
         num_samples = eval_iters * args.global_batch_size
         num_samples_per_dataset.append(num_samples)
+        if subset_ratio is not None:
+            # Only evaluate a fixed random subset of the dataset, at least one global batch.
+            eval_iters = max(1, round(eval_iters * subset_ratio))
+        eval_samples_per_dataset.append(eval_iters * args.global_batch_size)
         valid_iters_per_dataset.append(eval_iters)
 
     args.extra_eval_iters_list = valid_iters_per_dataset
     args.extra_prefix_paths_list = raw_prefix_paths_per_dataset
-    args.extra_num_samples_list = num_samples_per_dataset
+    args.extra_num_samples_list = eval_samples_per_dataset
+    args.extra_dataset_num_samples_list = num_samples_per_dataset
+
+    return len(valid_iters_per_dataset)
+
+
+def build_extra_valid_dataset(build_extra_valid_dataset_provider, index):
+    """Build the extra_valid dataset of the given index on first use and cache it."""
+
+    args = get_args()
+
+    num_datasets = init_extra_valid_metadata()
+    if num_datasets == 0:
+        return None
 
-    assert len(raw_prefix_paths_per_dataset) == len(
-        num_samples_per_dataset
-    ), f"Number of extra_valid data paths {len(raw_prefix_paths_per_dataset)} does not match number of extra_valid data samples {len(num_samples_per_dataset)}"
+    extra_valid_datasets = get_extra_valid_datasets()
+    if extra_valid_datasets is None:
+        extra_valid_datasets = [None] * num_datasets
+        set_extra_valid_datasets(extra_valid_datasets)
 
-    extra_valid_datasets = []
-    for path, num_samples in zip(raw_prefix_paths_per_dataset, num_samples_per_dataset):
-        extra_valid_datasets.append(build_extra_valid_dataset_provider([path], num_samples))
+    if extra_valid_datasets[index] is None:
+        dataset = build_extra_valid_dataset_provider(
+            [args.extra_prefix_paths_list[index]], args.extra_dataset_num_samples_list[index]
+        )
+        eval_samples = args.extra_num_samples_list[index]
+        subset_ratio = getattr(args, "extra_eval_subset_ratio", None)
+        if dataset is not None and subset_ratio is not None and eval_samples < len(dataset):
+            # The same samples are evaluated at every interval to keep the losses comparable.
+            seed = getattr(args, "extra_eval_subset_seed", None)
+            rng = numpy.random.RandomState(args.seed if seed is None else seed)
+            indices = numpy.sort(rng.choice(len(dataset), eval_samples, replace=False))
+            dataset = torch.utils.data.Subset(dataset, indices.tolist())
+        extra_valid_datasets[index] = dataset
 
-    return extra_valid_datasets
+    return extra_valid_datasets[index]
 
 
-def build_extra_valid_data_loaders(build_extra_valid_dataset_provider):
-    """Build extra_valid data loaders."""
+def build_extra_valid_data_loader(build_extra_valid_dataset_provider, index):
+    """Build the extra_valid data loader of the given index."""
 
     args = get_args()
 
-    extra_valid_dataloaders = [None]
+    extra_valid_dataloader = None
 
-    print_rank_0("> building extra validation datasets ...")
+    print_rank_0(f"> building extra validation dataset {index} ...")
     print_rank_0("> extra validation consumed_samples is always 0.")
 
     # Rely on distributed-aware core datasets, temporary
@@ -140,21 +179,14 @@ def build_extra_valid_data_loaders(build_extra_valid_dataset_provider):
     # Construct the data pipeline
     if is_distributed or mpu.get_tensor_model_parallel_rank() == 0:
 
-        # Build datasets if necessary.
-        if get_extra_valid_datasets() is None:
-            extra_valid_datasets = build_extra_valid_datasets(build_extra_valid_dataset_provider)
-            set_extra_valid_datasets(extra_valid_datasets)
-        else:
-            extra_valid_datasets = get_extra_valid_datasets()
+        # Build the dataset if necessary.
+        extra_valid_ds = build_extra_valid_dataset(build_extra_valid_dataset_provider, index)
 
-        # Build dataloders.
-        extra_valid_dataloaders = []
-        for extra_valid_ds in extra_valid_datasets:
-            extra_valid_dataloaders.append(build_pretraining_data_loader(extra_valid_ds, 0))
+        # Build dataloder.
+        extra_valid_dataloader = build_pretraining_data_loader(extra_valid_ds, 0)
 
         # Flags to know if we need to do extra_validation.
-        is_none = map(lambda _: _ is None, extra_valid_dataloaders)
-        do_extra_valid = len(extra_valid_dataloaders) > 0 and not any(is_none)
+        do_extra_valid = extra_valid_dataloader is not None
         flags = torch.tensor([int(do_extra_valid)], dtype=torch.long, device="cuda")
     else:
         flags = torch.tensor([0], dtype=torch.long, device="cuda")
@@ -163,7 +195,7 @@ def build_extra_valid_data_loaders(build_extra_valid_dataset_provider):
 
     args.do_extra_valid = getattr(args, "do_extra_valid", False) or flags[0].item()
 
-    return extra_valid_dataloaders
+    return extra_valid_dataloader
 
 
 def cyclic_iter(iter):
@@ -172,17 +204,20 @@ def cyclic_iter(iter):
             yield x
 
 
-def build_extra_valid_data_iterators(build_extra_valid_dataset_provider):
-    """Build pretraining data iterators."""
+def build_extra_valid_data_iterator(build_extra_valid_dataset_provider, index):
+    """Build the extra_valid data iterator of the given index.
+
+    The iterator is meant to be released after each evaluation, only the dataset is kept.
+    """
     if build_extra_valid_dataset_provider is None:
         return None
 
     args = get_args()
 
-    # Build loaders.
-    extra_valid_dataloaders = build_extra_valid_data_loaders(build_extra_valid_dataset_provider)
+    # Build loader.
+    extra_valid_dataloader = build_extra_valid_data_loader(build_extra_valid_dataset_provider, index)
 
-    # Build iterators.
+    # Build iterator.
     dl_type = args.dataloader_type
     assert dl_type in ["single", "cyclic", "external"]
 
@@ -201,15 +236,27 @@ def build_extra_valid_data_iterators(build_extra_valid_dataset_provider):
         else:
             raise RuntimeError("unexpected dataloader type")
 
-    if extra_valid_dataloaders[0] is not None:
-        extra_valid_data_iterators = [
-            _get_iterator(dl_type, extra_valid_dataloader)
-            for extra_valid_dataloader in extra_valid_dataloaders
-        ]
-    else:
-        extra_valid_data_iterators = [None for _ in extra_valid_dataloaders]
+    if extra_valid_dataloader is None:
+        return None
+    return _get_iterator(dl_type, extra_valid_dataloader)
 
-    return extra_valid_data_iterators
+
+def build_extra_valid_data_iterators(build_extra_valid_dataset_provider, index, model):
+    """Build the extra_valid data iterator of the given index for every model chunk."""
+    args = get_args()
+
+    # NOTE(zhaoyinglia): Must rebuild the dataloaders for extra validation here,
+    # to guarantee extra validation start from extra_iter=0 every time,
+    # but we don't need to rebuild the datasets.
+    if args.virtual_pipeline_model_parallel_size is not None:
+        extra_valid_data_iterator = []
+        for i in range(len(model)):
+            mpu.set_virtual_pipeline_model_parallel_rank(i)
+            extra_valid_data_iterator.append(
+                build_extra_valid_data_iterator(build_extra_valid_dataset_provider, index)
+            )
+        return extra_valid_data_iterator
+    return build_extra_valid_data_iterator(build_extra_valid_dataset_provider, index)
 
 
 def extra_evaluate_and_print_results(
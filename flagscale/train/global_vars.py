@@ -2,10 +2,12 @@ import torch
 
 from flagscale.train.hetero.parallel_context import ParallelContext
 from flagscale.train.spiky_loss import SpikyLossDetector
+from flagscale.train.step_timeline import StepTimeline
 
 _GLOBAL_EXTRA_VALID_DATASETS = None
 _GLOBAL_PARALLEL_CONTEXT = None
 _GLOBAL_SPIKY_LOSS_DETECTOR = None
+_GLOBAL_STEP_TIMELINE = None
 
 
 def _ensure_var_is_initialized(var, name):
@@ -53,4 +55,23 @@ def set_get_spiky_loss_detector(args):
     """Initialize spiky loss detector."""
     global _GLOBAL_SPIKY_LOSS_DETECTOR
     _ensure_var_is_not_initialized(_GLOBAL_SPIKY_LOSS_DETECTOR, "spiky loss detector")
-    _GLOBAL_SPIKY_LOSS_DETECTOR = SpikyLossDetector(args.spiky_loss_threshold)
+    _GLOBAL_SPIKY_LOSS_DETECTOR = SpikyLossDetector(
+        args.spiky_loss_threshold, decay=args.spiky_loss_decay, zscore=args.spiky_loss_zscore
+    )
+
+
+def get_step_timeline():
+    """Return step timeline, None if not enabled."""
+    return _GLOBAL_STEP_TIMELINE
+
+
+def set_step_timeline(args):
+    """Initialize step timeline."""
+    global _GLOBAL_STEP_TIMELINE
+    _ensure_var_is_not_initialized(_GLOBAL_STEP_TIMELINE, "step timeline")
+    _GLOBAL_STEP_TIMELINE = StepTimeline(
+        args.step_timeline_interval or args.log_interval,
+        path=args.step_timeline_path,
+        peak_tflops=args.step_timeline_peak_tflops,
+        straggler_threshold=args.step_timeline_straggler_threshold,
+    )
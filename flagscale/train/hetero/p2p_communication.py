@@ -1,6 +1,8 @@
 # Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
 
+import logging
 import operator
+import time
 from functools import reduce
 from typing import Callable, List, Optional, Tuple, Union
 
@@ -18,6 +20,9 @@ from megatron.core.pipeline_parallel.p2p_communication import _communicate
 
 from flagscale.train import get_parallel_context
 from flagscale.train.hetero.parallel_context import ParallelContext
+
+logger = logging.getLogger(__name__)
+
 # Types
 Shape = Union[List[int], torch.Size]
 
@@ -35,69 +40,123 @@ def get_device_type_for_comm(model_parallel_group=None):
     return device
 
 
-def warm_up_comm_group_hetero(config: ModelParallelConfig):
-    """ Warm up the communication for all PP groups, to avoid the hang issue.
+def all_reduce_across_global_groups(partials, op=torch.distributed.ReduceOp.SUM):
+    """All-reduce values over the hetero global groups of the caller rank with one collective.
+
+    partials is a list of (tensor, groups), where groups is the list of global groups (e.g. the
+    model parallel groups) the tensor would otherwise be reduced over one after another. These
+    groups only differ by the data parallel replicas they go through, which hold the same
+    values, so a single reduction over all the ranks gives the same result: with SUM every
+    tensor is weighted by the inverse of its number of replicas and the partials are summed,
+    with MAX and MIN the partials are combined elementwise.
+
+    Returns the reduced tensor on the communication device of the groups.
+    """
+    para_ctx = get_parallel_context()
+    device = get_device_type_for_comm(partials[0][1])
+    tensor = None
+    for partial, groups in partials:
+        partial = partial.to(device=device, dtype=torch.float)
+        if op == torch.distributed.ReduceOp.SUM:
+            partial = partial * para_ctx.get_global_group_replica_weight(groups)
+            tensor = partial if tensor is None else tensor + partial
+        elif op == torch.distributed.ReduceOp.MAX:
+            tensor = partial if tensor is None else torch.maximum(tensor, partial)
+        elif op == torch.distributed.ReduceOp.MIN:
+            tensor = partial if tensor is None else torch.minimum(tensor, partial)
+        else:
+            raise ValueError(f"Unsupported reduce op {op} across the global groups")
+    torch.distributed.all_reduce(tensor, op=op)
+    return tensor
+
+
+_COMM_GROUPS_WARMED_UP = False
+
+
+def _warm_up_depth(group_name):
+    """Depth of hetero_comm_warmup_depth from which a process group is warmed up."""
+    if group_name == "global-pp":
+        return 1
+    if group_name.startswith("global-") or "dp" not in group_name:
+        return 2
+    return 3
+
+
+def warm_up_comm_group_hetero(config: Optional[ModelParallelConfig] = None):
+    """ Warm up the communicators of all the process groups of the caller rank.
 
     P2P comm would call batch_isend_irecv API, which requires
     all ranks of the group to participate if this API is the
     first collective call in the group passed to `dist.P2POp`.
+    The other communicators are only created by their first
+    collective call, which delays the first iteration.
 
-    See batch_isend_irecv for more details.
+    A tiny batched exchange along every pipeline group and a tiny
+    all-reduce over every other group are issued at once, in the
+    same order on every rank, and waited on together. The groups
+    depend on hetero_comm_warmup_depth: 1 for the pipeline groups,
+    2 for the model parallel groups too, 3 for all the groups.
+
+    Only runs once, returns the init latency (ms) of every group.
     """
-    group = None
+    global _COMM_GROUPS_WARMED_UP
+    if _COMM_GROUPS_WARMED_UP:
+        return {}
+    _COMM_GROUPS_WARMED_UP = True
+
     rank = torch.distributed.get_rank()
     para_ctx = get_parallel_context()
-    pp_groups = para_ctx.get_pipeline_model_parallel_group()
-    # This is arbitrary because the shape of the recv tensor needs
-    # to be specified when communicating.
-    # It can be changed into any other shape.
-    tensor_shape = [1]
-    to_send_tensor= torch.empty(
-            tensor_shape,
-            requires_grad=True,
-            device=torch.cuda.current_device() if "cpu:gloo" != pp_groups[0].name() else torch.device("cpu"),
-            dtype=config.pipeline_dtype,
-        )
-    to_recv_tensor= torch.empty(
-            tensor_shape,
-            requires_grad=True,
-            device=torch.cuda.current_device() if "cpu:gloo" !=  pp_groups[0].name() else torch.device("cpu") ,
-            dtype=config.pipeline_dtype,
-        )
-
-    for pp_group in pp_groups:
-        group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-        pipeline_rank = get_pipeline_model_parallel_rank()
-        if pipeline_rank == 0:
-            _communicate(
-                tensor_send_next=to_send_tensor,
-                tensor_send_prev=None,
-                recv_prev=False,
-                recv_next=False,
-                tensor_shape=to_recv_tensor.shape,
-                config=config,
-                group=pp_group,
-            )
-        elif pipeline_rank == len(group_ranks) - 1:
-            _communicate(
-                tensor_send_next=None,
-                tensor_send_prev=None,
-                recv_prev=True,
-                recv_next=False,
-                tensor_shape=to_recv_tensor.shape,
-                config=config,
-                group=pp_group,
-            )
-        elif rank in group_ranks:
-            _communicate(
-                tensor_send_next=to_send_tensor,
-                tensor_send_prev=None,
-                recv_prev=True,
-                recv_next=False,
-                tensor_shape=to_recv_tensor.shape,
-                config=config,
-                group=pp_group,
-            )
+    depth = para_ctx._args.hetero_comm_warmup_depth
+    groups = []
+    for group_name, group in para_ctx.get_all_process_groups():
+        ranks = torch.distributed.get_process_group_ranks(group)
+        if len(ranks) > 1 and _warm_up_depth(group_name) <= depth:
+            groups.append((ranks, group_name, group))
+    # Every rank initializes the communicators in the same order to avoid deadlocks
+    groups.sort(key=lambda item: (item[0], item[1]))
+
+    pending, warmed_up = [], set()
+    start = time.perf_counter()
+    for ranks, group_name, group in groups:
+        # e.g. the distributed optimizer groups may be the data parallel groups
+        if group in warmed_up:
+            continue
+        warmed_up.add(group)
+        issued = time.perf_counter()
+        tensor = torch.zeros(1, device=get_device_type_for_comm(group))
+        if group_name == "global-pp":
+            index = ranks.index(rank)
+            ops = []
+            if index < len(ranks) - 1:
+                ops.append(torch.distributed.P2POp(torch.distributed.isend, tensor, ranks[index + 1], group))
+            if index > 0:
+                ops.append(torch.distributed.P2POp(torch.distributed.irecv, torch.empty_like(tensor), ranks[index - 1], group))
+            works = torch.distributed.batch_isend_irecv(ops)
+        else:
+            works = [torch.distributed.all_reduce(tensor, group=group, async_op=True)]
+        # the gloo works only complete once waited on, the others are polled
+        blocking = torch.distributed.get_backend(group) != "nccl"
+        pending.append((f"{group_name}{ranks}", issued, works, blocking))
+
+    latencies = {}
+    while pending:
+        still_pending = []
+        for name, issued, works, blocking in pending:
+            if blocking or all(work.is_completed() for work in works):
+                for work in works:
+                    work.wait()
+                latencies[name] = (time.perf_counter() - issued) * 1000.0
+            else:
+                still_pending.append((name, issued, works, blocking))
+        pending = still_pending
+
+    total = (time.perf_counter() - start) * 1000.0
+    slowest = sorted(latencies.items(), key=lambda item: item[1], reverse=True)
+    logger.info(
+        f"rank {rank} warmed up {len(latencies)} communicators in {total:.1f} ms: "
+        + ", ".join(f"{name} {ms:.1f} ms" for name, ms in slowest)
+    )
+    return latencies
 
 
 def is_inter_mesh_comm(para_ctx: ParallelContext, comm_with_front_layer: bool):
@@ -127,6 +186,53 @@ def is_inter_mesh_comm(para_ctx: ParallelContext, comm_with_front_layer: bool):
         return get_pipeline_model_parallel_rank() == total_current_pipeline_model_parallel_size - 1
 
 
+def _exchange_inter_mesh_slices(
+    config: ModelParallelConfig,
+    tensor_send: Optional[torch.Tensor] = None,
+    send_plan: Optional[list] = None,
+    tensor_recv: Optional[torch.Tensor] = None,
+    recv_plan: Optional[list] = None,
+) -> None:
+    """ Exchange the slices of an inter-mesh p2p communication in one batch.
+
+    The plans come from ParallelContext.get_inter_mesh_exchange_plan. Every slice is
+    received straight into its view of tensor_recv when the view is contiguous, through a
+    staging buffer otherwise. batch_isend_irecv requires a single group per call, so one
+    batch is issued per pipeline group and all of them are waited on together.
+    """
+    ops_per_group = {}
+    for peer, group, (sp, dp) in send_plan or []:
+        tensor = tensor_send[sp, dp, :]
+        if "cpu:gloo" == group.name():
+            tensor = tensor.cpu()
+        ops_per_group.setdefault(group, []).append(
+            torch.distributed.P2POp(torch.distributed.isend, tensor.contiguous(), peer, group)
+        )
+    staged = []
+    for peer, group, (sp, dp) in recv_plan or []:
+        view = tensor_recv.data[sp, dp, :]
+        buffer = view if view.is_contiguous() else torch.empty_like(view, memory_format=torch.contiguous_format)
+        if buffer is not view:
+            staged.append((view, buffer))
+        ops_per_group.setdefault(group, []).append(
+            torch.distributed.P2POp(torch.distributed.irecv, buffer, peer, group)
+        )
+
+    reqs = []
+    for ops in ops_per_group.values():
+        reqs.extend(torch.distributed.batch_isend_irecv(ops))
+    for req in reqs:
+        req.wait()
+    for view, buffer in staged:
+        view.copy_(buffer)
+
+    if torch.cuda.is_available() and (
+        (config.batch_p2p_comm and config.batch_p2p_sync) or len(ops_per_group) > 1
+    ):
+        # To protect against race condition when using batch_isend_irecv().
+        torch.cuda.synchronize()
+
+
 def recv_forward_hetero(tensor_shape: Shape, config: ModelParallelConfig, is_first_stage: bool
 ) -> torch.Tensor:
     """ Receive tensor from previous rank in pipeline (forward receive).
@@ -154,34 +260,14 @@ def recv_forward_hetero(tensor_shape: Shape, config: ModelParallelConfig, is_fir
                 group=group,
             )
         else:
-            tensor_slices = para_ctx.get_inter_mesh_tensor_slices(
+            recv_plan = para_ctx.get_inter_mesh_exchange_plan(
                 rank=rank, local_tensor_shape=tensor_shape, next=False
             )
             input_tensor = torch.empty(tensor_shape,
                                        device=torch.cuda.current_device() if "cpu:gloo" != pp_groups[0].name() else torch.device("cpu"),
                                        dtype=config.pipeline_dtype,
                                        requires_grad=True)
-            if tensor_slices is not None:
-                for tensor_slice in tensor_slices:
-                    dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size = tensor_slice
-                    tensor_shape_sliced = (sp_end - sp_start, dp_end - dp_start, local_hidden_size)
-                    group = None
-                    pp_groups = para_ctx.get_pipeline_model_parallel_group()
-                    for pp_group in pp_groups:
-                        pp_group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-                        if rank in pp_group_ranks and dst_rank in pp_group_ranks:
-                            group = pp_group
-                            break
-                    input_tensor_sliced, _, _ = _communicate(
-                        tensor_send_next=None,
-                        tensor_send_prev=None,
-                        recv_prev=True,
-                        recv_next=False,
-                        tensor_shape=tensor_shape_sliced,
-                        config=config,
-                        group=group,
-                    )
-                    input_tensor.data[sp_start:sp_end, dp_start:dp_end, :] = input_tensor_sliced
+            _exchange_inter_mesh_slices(config, tensor_recv=input_tensor, recv_plan=recv_plan)
         if config.timers is not None:
             config.timers('forward-recv').stop()
     if input_tensor is not None and input_tensor.device == torch.device("cpu"):
@@ -217,38 +303,18 @@ def recv_backward_hetero(
                 group=group,
             )
         else:
-            tensor_slices = para_ctx.get_inter_mesh_tensor_slices(
+            recv_plan = para_ctx.get_inter_mesh_exchange_plan(
                 rank=rank, local_tensor_shape=tensor_shape, next=True
             )
             output_tensor_grad = torch.empty(tensor_shape,
                                              device=torch.cuda.current_device() if "cpu:gloo" != pp_groups[0].name() else torch.device("cpu"),
                                              dtype=config.pipeline_dtype,
                                              requires_grad=True)
-            if tensor_slices is not None:
-                for tensor_slice in tensor_slices:
-                    dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size = tensor_slice
-                    tensor_shape_sliced = (sp_end - sp_start, dp_end - dp_start, local_hidden_size)
-                    group = None
-                    for pp_group in pp_groups:
-                        pp_group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-                        if rank in pp_group_ranks and dst_rank in pp_group_ranks:
-                            group = pp_group
-                            break
-                    _, output_tensor_grad_sliced, _ = _communicate(
-                        tensor_send_next=None,
-                        tensor_send_prev=None,
-                        recv_prev=False,
-                        recv_next=True,
-                        tensor_shape=tensor_shape_sliced,
-                        config=config,
-                        group=group,
-                    )
-                    # tensor_shape is current tensor shape
-                    dp_coef = para_ctx.get_dp_coef_when_recv_backward()
-                    if dp_coef != 1.0:
-                        output_tensor_grad.data[sp_start:sp_end, dp_start:dp_end, :] = output_tensor_grad_sliced * dp_coef
-                    else:
-                        output_tensor_grad.data[sp_start:sp_end, dp_start:dp_end, :] = output_tensor_grad_sliced
+            _exchange_inter_mesh_slices(config, tensor_recv=output_tensor_grad, recv_plan=recv_plan)
+            # tensor_shape is current tensor shape
+            dp_coef = para_ctx.get_dp_coef_when_recv_backward()
+            if dp_coef != 1.0:
+                output_tensor_grad.data.mul_(dp_coef)
         if config.timers is not None:
             config.timers('backward-recv').stop()
 
@@ -283,29 +349,10 @@ def send_forward_hetero(
                 group=group,
             )
         else:
-            tensor_slices = para_ctx.get_inter_mesh_tensor_slices(
+            send_plan = para_ctx.get_inter_mesh_exchange_plan(
                 rank=rank, local_tensor_shape=output_tensor.shape, next=True
             )
-            if tensor_slices is not None:
-                for tensor_slice in tensor_slices:
-                    dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size = tensor_slice
-                    output_tensor_sliced = output_tensor[sp_start:sp_end, dp_start:dp_end, :]
-                    group = None
-                    pp_groups = para_ctx.get_pipeline_model_parallel_group()
-                    for pp_group in pp_groups:
-                        pp_group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-                        if rank in pp_group_ranks and dst_rank in pp_group_ranks:
-                            group = pp_group
-                            break
-                    _communicate(
-                        tensor_send_next=output_tensor_sliced.contiguous() if "cpu:gloo" != group.name() else output_tensor_sliced.cpu(),
-                        tensor_send_prev=None,
-                        recv_prev=False,
-                        recv_next=False,
-                        tensor_shape=None,
-                        config=config,
-                        group=group,
-                    )
+            _exchange_inter_mesh_slices(config, tensor_send=output_tensor, send_plan=send_plan)
         if config.timers is not None:
             config.timers('forward-send').stop()
 
@@ -335,29 +382,10 @@ def send_backward_hetero(
                 group=group,
             )
         else:
-            tensor_slices = para_ctx.get_inter_mesh_tensor_slices(
+            send_plan = para_ctx.get_inter_mesh_exchange_plan(
                 rank=rank, local_tensor_shape=input_tensor_grad.shape, next=False
             )
-            if tensor_slices is not None:
-                for tensor_slice in tensor_slices:
-                    dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size = tensor_slice
-                    input_tensor_grad_sliced = input_tensor_grad[sp_start:sp_end, dp_start:dp_end, :]
-                    group = None
-                    pp_groups = para_ctx.get_pipeline_model_parallel_group()
-                    for pp_group in pp_groups:
-                        pp_group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-                        if rank in pp_group_ranks and dst_rank in pp_group_ranks:
-                            group = pp_group
-                            break
-                    _communicate(
-                        tensor_send_next=None,
-                        tensor_send_prev=input_tensor_grad_sliced.contiguous() if "cpu:gloo" != group.name() else input_tensor_grad_sliced.cpu(),
-                        recv_prev=False,
-                        recv_next=False,
-                        tensor_shape=None,
-                        config=config,
-                        group=group,
-                    )
+            _exchange_inter_mesh_slices(config, tensor_send=input_tensor_grad, send_plan=send_plan)
         if config.timers is not None:
             config.timers('backward-send').stop()
 
@@ -393,38 +421,23 @@ def send_forward_recv_backward_hetero(
                 group=group,
             )
         else:
-            tensor_slices = para_ctx.get_inter_mesh_tensor_slices(
+            plan = para_ctx.get_inter_mesh_exchange_plan(
                 rank=rank, local_tensor_shape=output_tensor.shape, next=True
             )
             output_tensor_grad = torch.empty(tensor_shape,
                                              device=torch.cuda.current_device() if "cpu:gloo" != pp_groups[0].name() else torch.device("cpu"),
                                              dtype=config.pipeline_dtype,
                                              requires_grad=True)
-            if tensor_slices is not None:
-                for tensor_slice in tensor_slices:
-                    dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size = tensor_slice
-                    output_tensor_sliced = output_tensor[sp_start:sp_end, dp_start:dp_end, :]
-                    tensor_shape_sliced = (sp_end - sp_start, dp_end - dp_start, local_hidden_size)
-                    group = None
-                    for pp_group in pp_groups:
-                        pp_group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-                        if rank in pp_group_ranks and dst_rank in pp_group_ranks:
-                            group = pp_group
-                            break
-                    _, output_tensor_grad_sliced, _ = _communicate(
-                        tensor_send_next=output_tensor_sliced.contiguous() if "cpu:gloo" != group.name() else output_tensor_sliced.cpu(),
-                        tensor_send_prev=None,
-                        recv_prev=False,
-                        recv_next=True,
-                        tensor_shape=tensor_shape_sliced,
-                        config=config,
-                        group=group,
-                    )
-                    dp_coef = para_ctx.get_dp_coef_when_recv_backward()
-                    if dp_coef != 1.0:
-                        output_tensor_grad.data[sp_start:sp_end, dp_start:dp_end, :] = output_tensor_grad_sliced * dp_coef
-                    else:
-                        output_tensor_grad.data[sp_start:sp_end, dp_start:dp_end, :] = output_tensor_grad_sliced
+            _exchange_inter_mesh_slices(
+                config,
+                tensor_send=output_tensor,
+                send_plan=plan,
+                tensor_recv=output_tensor_grad,
+                recv_plan=plan,
+            )
+            dp_coef = para_ctx.get_dp_coef_when_recv_backward()
+            if dp_coef != 1.0:
+                output_tensor_grad.data.mul_(dp_coef)
         if config.timers is not None:
             config.timers('forward-send-backward-recv').stop()
     if output_tensor_grad is not None and output_tensor_grad.device == torch.device("cpu"):
@@ -463,34 +476,20 @@ def send_backward_recv_forward_hetero(
                 group=group,
             )
         else:
-            tensor_slices = para_ctx.get_inter_mesh_tensor_slices(
+            plan = para_ctx.get_inter_mesh_exchange_plan(
                 rank=rank, local_tensor_shape=input_tensor_grad.shape, next=False
             )
             input_tensor = torch.empty(tensor_shape,
                                        device=torch.cuda.current_device() if "cpu:gloo" != pp_groups[0].name() else torch.device("cpu"),
                                        dtype=config.pipeline_dtype,
                                        requires_grad=True)
-            if tensor_slices is not None:
-                for tensor_slice in tensor_slices:
-                    dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size = tensor_slice
-                    input_tensor_grad_sliced = input_tensor_grad[sp_start:sp_end, dp_start:dp_end, :]
-                    tensor_shape_sliced = (sp_end - sp_start, dp_end - dp_start, local_hidden_size)
-                    group = None
-                    for pp_group in pp_groups:
-                        pp_group_ranks = torch.distributed.get_process_group_ranks(pp_group)
-                        if rank in pp_group_ranks and dst_rank in pp_group_ranks:
-                            group = pp_group
-                            break
-                    input_tensor_sliced, _, _ = _communicate(
-                        tensor_send_next=None,
-                        tensor_send_prev=input_tensor_grad_sliced.contiguous() if "cpu:gloo" != group.name() else input_tensor_grad_sliced.cpu(),
-                        recv_prev=True,
-                        recv_next=False,
-                        tensor_shape=tensor_shape_sliced,
-                        config=config,
-                        group=group,
-                    )
-                    input_tensor.data[sp_start:sp_end, dp_start:dp_end, :] = input_tensor_sliced
+            _exchange_inter_mesh_slices(
+                config,
+                tensor_send=input_tensor_grad,
+                send_plan=plan,
+                tensor_recv=input_tensor,
+                recv_plan=plan,
+            )
         if config.timers is not None:
             config.timers('backward-send-forward-recv').stop()
     if input_tensor is not None and input_tensor.device == torch.device("cpu"):
@@ -7,7 +7,6 @@ import warnings
 import dataclasses
 from typing import List, Optional
 from datetime import timedelta
-from functools import cmp_to_key
 from collections import defaultdict
 from typing import Callable, List, Optional
 
@@ -113,70 +112,170 @@ def find_overlapped_mapping(dim1, dim2, global_size=None):
     return overlapped_mapping
 
 
+def _inter_mesh_group_edges(groups_per_mesh, connections):
+    """
+    For every pair of adjacent meshes, map the index of a group of the first mesh to the sorted
+    indices of the groups of the next mesh whose first rank it is connected to.
+    """
+    edges = []
+    for groups, next_groups in zip(groups_per_mesh[:-1], groups_per_mesh[1:]):
+        rank_to_group = {rank: i for i, ranks in enumerate(groups) for rank in ranks}
+        first_rank_to_group = {ranks[0]: j for j, ranks in enumerate(next_groups)}
+        mesh_edges = defaultdict(set)
+        for src_rank, dst_rank in connections:
+            if src_rank in rank_to_group and dst_rank in first_rank_to_group:
+                mesh_edges[rank_to_group[src_rank]].add(first_rank_to_group[dst_rank])
+        edges.append({i: sorted(js) for i, js in mesh_edges.items()})
+    return edges
+
+
+def iter_inter_mesh_group_ranks(groups_per_mesh, connections, rank=None, reverse=False):
+    """
+    Enumerate the global process groups crossing all the process meshes in closed form.
+
+    groups_per_mesh[i] lists the ranks of the groups of one token in mesh i, and connections
+    holds the (src_rank, dst_rank) pairs linking the last stage of mesh i to the first stage of
+    mesh i + 1. A global group concatenates one group per mesh, each connected to the previous
+    one. The groups are yielded in the lexicographic order of their group indices (reversed with
+    reverse). With rank, only the groups containing rank are walked, as the product of the
+    paths reaching its group and of the paths leaving it.
+    """
+    if not groups_per_mesh:
+        return
+    edges = _inter_mesh_group_edges(groups_per_mesh, connections)
+    order = reversed if reverse else iter
+
+    def _walk(mesh_index, group_index, path, step, stop):
+        path.append(group_index)
+        if mesh_index == stop:
+            yield list(path)
+        elif step > 0:
+            for j in order(edges[mesh_index].get(group_index, [])):
+                yield from _walk(mesh_index + 1, j, path, step, stop)
+        else:
+            for j in order(reverse_edges[mesh_index - 1].get(group_index, [])):
+                yield from _walk(mesh_index - 1, j, path, step, stop)
+        path.pop()
+
+    last_mesh = len(groups_per_mesh) - 1
+    if rank is None:
+        for i in order(range(len(groups_per_mesh[0]))):
+            for path in _walk(0, i, [], 1, last_mesh):
+                yield [r for m, g in enumerate(path) for r in groups_per_mesh[m][g]]
+        return
+
+    mesh_index = group_index = None
+    for m, groups in enumerate(groups_per_mesh):
+        for g, ranks in enumerate(groups):
+            if rank in ranks:
+                mesh_index, group_index = m, g
+    if mesh_index is None:
+        return
+    reverse_edges = []
+    for mesh_edges in edges:
+        reverse_mesh_edges = defaultdict(list)
+        for i, js in mesh_edges.items():
+            for j in js:
+                reverse_mesh_edges[j].append(i)
+        reverse_edges.append(reverse_mesh_edges)
+    prefixes = sorted(
+        (path[::-1] for path in _walk(mesh_index, group_index, [], -1, 0)), reverse=reverse
+    )
+    suffixes = list(_walk(mesh_index, group_index, [], 1, last_mesh))
+    for prefix in prefixes:
+        for suffix in suffixes:
+            path = prefix + suffix[1:]
+            yield [r for m, g in enumerate(path) for r in groups_per_mesh[m][g]]
+
+
+# (world process group, device types) -> device type index of every rank, the rank mapping is
+# only gathered once per process even if several RankMappers are built
+_RANK_DEVICE_TYPE_INDICES = {}
+
+
 class RankMapper:
-    def __init__(self, args):
-        assert (
-            torch.distributed.is_initialized()
-        ), "torch.distributed is not initialized"
-        self._world_size = torch.distributed.get_world_size()
+    def __init__(self, args, rank_infos=None):
+        """rank_infos ([{'rank': ..., 'device_type': ...}, ...]) describes every rank of the
+        world, it is gathered from all the ranks if not given."""
+        if rank_infos is None:
+            assert (
+                torch.distributed.is_initialized()
+            ), "torch.distributed is not initialized"
+            self._world_size = torch.distributed.get_world_size()
+        else:
+            self._world_size = len(rank_infos)
         # The order of device types is very import for creating the logical rank.
         # Users should make sure the order satisfies their needs.
         self._hetero_device_types = args.hetero_device_types
         self._hetero_current_device_type = args.hetero_current_device_type
         self._rank_infos = {}
-        self._physical_rank_to_logical_rank = {}
-        self._logical_rank_to_physical_rank = {}
-        self.build_rank_mapping()
+        self._physical_rank_to_logical_rank = []
+        self._logical_rank_to_physical_rank = []
+        self.build_rank_mapping(rank_infos)
 
-    def build_rank_mapping(self):
-        # Collect all rank infos.
-        rank = torch.distributed.get_rank()
-        world_size = torch.distributed.get_world_size()
-        all_rank_infos = [None] * world_size
-        cur_rank_info = {'rank': rank,
-                         'device_type': self._hetero_current_device_type}
-        torch.distributed.all_gather_object(
-            all_rank_infos, cur_rank_info)
-        physical_ranks = []
-        for info in all_rank_infos:
-            self._rank_infos[info['rank']] = info
-            physical_ranks.append(info['rank'])
+    def _device_type_index(self, device_type):
+        if not self._hetero_device_types:
+            return 0
+        if device_type not in self._hetero_device_types:
+            return -1
+        return self._hetero_device_types.index(device_type)
+
+    def _gather_device_type_indices(self):
+        """Gather the index of the device type of every rank with a single tensor collective,
+        instead of pickling the rank infos through an object collective."""
+        world = torch.distributed.group.WORLD
+        key = (tuple(self._hetero_device_types or []), self._world_size)
+        cached = _RANK_DEVICE_TYPE_INDICES.get(key)
+        if cached is not None and cached[0] is world:
+            return cached[1]
+
+        if torch.distributed.get_backend() == "nccl":
+            device = torch.device("cuda", torch.cuda.current_device())
+        else:
+            device = torch.device("cpu")
+        index = torch.tensor(
+            [self._device_type_index(self._hetero_current_device_type)], dtype=torch.int32, device=device
+        )
+        indices = torch.empty(self._world_size, dtype=torch.int32, device=device)
+        torch.distributed.all_gather_into_tensor(indices, index)
+        indices = indices.tolist()
+        _RANK_DEVICE_TYPE_INDICES[key] = (world, indices)
+        return indices
+
+    def build_rank_mapping(self, all_rank_infos=None):
+        # Collect the device type of all ranks.
+        if all_rank_infos is None:
+            indices = self._gather_device_type_indices()
+            for rank, index in enumerate(indices):
+                device_type = self._hetero_device_types[index] if self._hetero_device_types and index >= 0 else None
+                self._rank_infos[rank] = {'rank': rank, 'device_type': device_type}
+        else:
+            indices = [None] * self._world_size
+            for info in all_rank_infos:
+                self._rank_infos[info['rank']] = info
+                indices[info['rank']] = self._device_type_index(info['device_type'])
+        unknown_ranks = [rank for rank, index in enumerate(indices) if index < 0]
+        if unknown_ranks:
+            raise ValueError(
+                f"The device type of ranks {unknown_ranks} is not in hetero_device_types {self._hetero_device_types}"
+            )
 
         # Sort the physical ranks by device type and rank.
-        def _compare(rank1, rank2):
-            device_type1 = self._rank_infos[rank1]['device_type']
-            device_type2 = self._rank_infos[rank2]['device_type']
-            if self._hetero_device_types \
-                and self._hetero_device_types.index(device_type1) < self._hetero_device_types.index(device_type2):
-                return -1
-            elif self._hetero_device_types \
-                and self._hetero_device_types.index(device_type1) > self._hetero_device_types.index(device_type2):
-                return 1
-            else:
-                return rank1 - rank2
-        sorted_physical_ranks = sorted(
-            physical_ranks, key=cmp_to_key(_compare))
+        sorted_physical_ranks = sorted(range(self._world_size), key=lambda rank: (indices[rank], rank))
 
         # Build the mapping between physical rank and logical rank
+        self._logical_rank_to_physical_rank = sorted_physical_ranks
+        self._physical_rank_to_logical_rank = [0] * self._world_size
         for logical_rank, physical_rank in enumerate(sorted_physical_ranks):
             self._physical_rank_to_logical_rank[physical_rank] = logical_rank
-            self._logical_rank_to_physical_rank[logical_rank] = physical_rank
 
     def to_physical_ranks(self, logical_ranks: list) -> list:
         """Converts logical ranks to physical ranks."""
-        physical_ranks = []
-        for logical_rank in logical_ranks:
-            physical_ranks.append(
-                self._logical_rank_to_physical_rank[logical_rank])
-        return physical_ranks
+        return [self._logical_rank_to_physical_rank[logical_rank] for logical_rank in logical_ranks]
 
     def to_logical_ranks(self, physical_ranks: list) -> list:
         """Converts physical ranks to logical ranks."""
-        logical_ranks = []
-        for physical_rank in physical_ranks:
-            logical_ranks.append(
-                self._physical_rank_to_logical_rank[physical_rank])
-        return logical_ranks
+        return [self._physical_rank_to_logical_rank[physical_rank] for physical_rank in physical_ranks]
 
 
 class ProcessMesh:
@@ -548,7 +647,7 @@ class ProcessMesh:
 
 
 class ParallelContext:
-    def __init__(self, args):
+    def __init__(self, args, rank_mapper=None):
         assert args.context_parallel_size == 1, "Context parallelism is not supported."
         assert args.num_distributed_optimizer_instances == 1, "Distributed optimizer is not supported."
         assert torch.distributed.is_initialized()
@@ -563,18 +662,23 @@ class ParallelContext:
         self._inter_mesh_process_groups_edp = {} # (src_rank, dst_rank) -> bool
         # (src_rank, local_tensor_shape, next) -> (dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size)
         self._inter_mesh_tensor_slices = {}
+        # (rank, local_tensor_shape, next) -> [(peer_rank, pp_group, (sp_slice, dp_slice)), ...]
+        self._inter_mesh_exchange_plans = {}
         self._inter_mesh_tensor_slices_for_embd_group = {}
 
         self._global_group_ranks = defaultdict(list) # current rank: {group_name: [[ranks0], [ranks1], ...], ...}
-        self._global_all_group_ranks = defaultdict(list) # all_rank: {group_name -> [[rank0], [rank1], [rank2], ...], ...}
+        self._global_all_group_ranks = defaultdict(list) # all_rank: {group_name -> [[rank0], [rank1], [rank2], ...], ...}, enumerated on demand
+        self._global_group_specs = {} # group_name -> (ranks of the groups of every process mesh, inter-mesh connections)
         self._global_process_groups = defaultdict(list) # current rank: {group_name: [group0, group1, ...], ...}
         self._global_process_group_to_ranks = {}
+        # current rank: {group_name -> inverse of the number of replicas of its values across the global groups}
+        self._global_group_replica_weights = {}
         self._global_parallel_world_sizes = {}
         self._global_parallel_ranks = {}
         self._timeout = timedelta(minutes=self._args.distributed_timeout_minutes)
 
         self._rank = torch.distributed.get_rank()
-        self._rank_mapper = RankMapper(args)
+        self._rank_mapper = rank_mapper if rank_mapper is not None else RankMapper(args)
         self.build_all_process_meshes()
         self.build_all_inter_mesh_process_groups()
         self.build_global_process_groups()
@@ -750,46 +854,37 @@ class ParallelContext:
     def build_global_process_groups(self):
         """ Build global process groups across all process meshes. The global process groups are used for the communication
             between different pipeline stages. Heteregonous process groups except for the default process groups are all here"""
-        # build global pipeline process groups
-        def _backtrack(mesh_index, prev_rank, path, token = "pp", is_expert=False):
-            assert token in ["tp-pp", "pp", "tp-ep-pp"], f"Invalid token: {token} for inter-mesh process groups"
+        # build the global process groups which across the different Processmesh.
+        # They are created with local synchronization, so every rank only enumerates
+        # and creates the groups it belongs to.
+        for token, is_expert, connections in [
+            ("tp-pp", False, self._inter_mesh_process_groups_dp),
+            ("pp", False, self._inter_mesh_process_groups_pp),
+            ("tp-ep-pp", True, self._inter_mesh_process_groups_edp),
+        ]:
             group_name = get_group_name(token, is_expert=is_expert)
-            if mesh_index == len(self._process_meshes):
-                aggregated_ranks = [rank for ranks in path for rank in ranks]
-                self._global_all_group_ranks[group_name].append(aggregated_ranks)
+            groups_per_mesh = [
+                mesh.get_all_process_group_ranks(token, is_expert=is_expert, check_initialized=True)
+                for mesh in self._process_meshes
+            ]
+            self._global_group_specs[group_name] = (groups_per_mesh, connections)
+            # The global groups of the current rank only differ by the data parallel replicas
+            # of the other meshes, every mesh holds world_size / len(mesh_group_ranks) replicas.
+            current_mesh = self._process_meshes[self._current_process_mesh_index]
+            mesh_group_ranks = current_mesh.get_process_group_ranks(token, is_expert=is_expert, check_initialized=True)
+            self._global_group_replica_weights[group_name] = len(mesh_group_ranks) / current_mesh._world_size
+            for aggregated_ranks in iter_inter_mesh_group_ranks(
+                groups_per_mesh, connections, rank=self._rank
+            ):
                 group = create_group(aggregated_ranks, timeout=self._timeout, use_local_synchronization=True, group_desc=group_name)
-                if self._rank in aggregated_ranks:
-                    self._global_process_groups[group_name].append(group)
-                    self._global_group_ranks[group_name].append(aggregated_ranks)
-                    self._global_process_group_to_ranks[group] = aggregated_ranks
-                return
-            current_mesh = self._process_meshes[mesh_index]
-            ranks_list = current_mesh.get_all_process_group_ranks(token, is_expert=is_expert, check_initialized=True)
-            valid_ranks_list = []
-            for ranks in ranks_list:
-                mesh_is_connected = False
-                for prev_path_ranks in path:
-                    for prev_path_rank in prev_path_ranks:
-                        if token == "pp" and (prev_path_rank, ranks[0]) in self._inter_mesh_process_groups_pp:
-                            mesh_is_connected = True
-                        elif token == "tp-pp" and (prev_path_rank, ranks[0]) in self._inter_mesh_process_groups_dp:
-                            mesh_is_connected = True
-                        elif token == "tp-ep-pp" and (prev_path_rank, ranks[0]) in self._inter_mesh_process_groups_edp:
-                            mesh_is_connected = True
-                if prev_rank == -1 or mesh_is_connected:
-                    valid_ranks_list.append(ranks)
-            for ranks in valid_ranks_list:
-                path.append(ranks)
-                _backtrack(mesh_index + 1, ranks[-1], path, token=token, is_expert=is_expert)
-                path.pop()
-        # build the global process groups which across the different Processmesh
-        _backtrack(0, -1, path=[], token="tp-pp", is_expert=False)
-        _backtrack(0, -1, path=[], token="pp", is_expert=False)
-        _backtrack(0, -1, path=[], token="tp-ep-pp", is_expert=True)
+                self._global_process_groups[group_name].append(group)
+                self._global_group_ranks[group_name].append(aggregated_ranks)
+                self._global_process_group_to_ranks[group] = aggregated_ranks
 
         # 'last_rank' is the last rank of the last pipeline stage
-        pp_ranks = self.get_global_all_group_ranks("pp")
-        self._global_parallel_ranks["last_rank"] = pp_ranks[-1][-1] if isinstance(pp_ranks[0], list) else pp_ranks[-1]
+        groups_per_mesh, connections = self._global_group_specs["pp"]
+        last_pp_ranks = next(iter_inter_mesh_group_ranks(groups_per_mesh, connections, reverse=True))
+        self._global_parallel_ranks["last_rank"] = last_pp_ranks[-1]
 
         # build global embedding process groups
         for ranks in self._global_group_ranks["pp"]:
@@ -907,6 +1002,35 @@ class ParallelContext:
                     )
         return self._inter_mesh_tensor_slices[(rank, local_tensor_shape, next)]
 
+    def get_inter_mesh_exchange_plan(self, rank, local_tensor_shape, next=True):
+        """Return the slices of the local tensor exchanged with the adjacent process mesh.
+
+        Every entry is (peer_rank, pp_group, region), where pp_group is the pipeline group
+        shared with peer_rank and region indexes the local (seq, batch, hidden) tensor.
+        The plan is built once per (rank, local_tensor_shape, next).
+        """
+        local_tensor_shape = tuple(local_tensor_shape)
+        key = (rank, local_tensor_shape, next)
+        if key in self._inter_mesh_exchange_plans:
+            return self._inter_mesh_exchange_plans[key]
+
+        tensor_slices = self.get_inter_mesh_tensor_slices(rank, local_tensor_shape, next=next)
+        pp_groups = self.get_pipeline_model_parallel_group()
+        pp_group_ranks = [
+            set(torch.distributed.get_process_group_ranks(pp_group)) for pp_group in pp_groups
+        ]
+        plan = []
+        for dst_rank, (dp_start, dp_end), (sp_start, sp_end), _ in tensor_slices or []:
+            group = None
+            for pp_group, ranks in zip(pp_groups, pp_group_ranks):
+                if rank in ranks and dst_rank in ranks:
+                    group = pp_group
+                    break
+            assert group is not None, f"No pipeline group contains both rank {rank} and {dst_rank}"
+            plan.append((dst_rank, group, (slice(sp_start, sp_end), slice(dp_start, dp_end))))
+        self._inter_mesh_exchange_plans[key] = plan
+        return plan
+
     def get_dp_coef_when_recv_backward(self) -> float:
         if self._args.calculate_per_token_loss:
             return 1.0
@@ -946,8 +1070,22 @@ class ParallelContext:
             ), f"Process group {group_name} is not initialized."
         return ranks
 
+    def get_global_group_replica_weight(self, groups):
+        """Weight of the caller rank when the reductions over the global groups `groups`
+        (e.g. the model parallel groups) are replaced by a single reduction over all the ranks."""
+        for group_name, global_groups in self._global_process_groups.items():
+            if global_groups is groups:
+                return self._global_group_replica_weights[group_name]
+        raise ValueError("The groups are not global process groups of the current rank.")
+
     def get_global_all_group_ranks(self, token, is_expert=False, check_initialized=False):
         group_name = get_group_name(token, is_expert=is_expert)
+        if group_name not in self._global_all_group_ranks and group_name in self._global_group_specs:
+            # Only enumerated on demand, the groups of all the ranks are not needed to build them
+            groups_per_mesh, connections = self._global_group_specs[group_name]
+            self._global_all_group_ranks[group_name] = list(
+                iter_inter_mesh_group_ranks(groups_per_mesh, connections)
+            )
         ranks = self._global_all_group_ranks.get(group_name, None)
         if check_initialized:
             assert (
@@ -955,6 +1093,19 @@ class ParallelContext:
             ), f"Process group {group_name} is not initialized."
         return ranks
 
+    def get_all_process_groups(self):
+        """Get (group_name, group) of every process group the caller rank belongs to, except the
+        gloo ones. The names of the global process groups are prefixed with `global-`."""
+        all_groups = []
+        for group_name, groups in self._global_process_groups.items():
+            all_groups.extend((f"global-{group_name}", group) for group in groups)
+        current_process_mesh = self._process_meshes[self._current_process_mesh_index]
+        for group_name, groups in current_process_mesh._process_groups.items():
+            if not isinstance(groups, list):
+                groups = [groups]
+            all_groups.extend((group_name, group) for group in groups if group is not None)
+        return all_groups
+
     def get_model_parallel_group(self, check_initialized=True):
         """Get the model parallel group the caller rank belongs to."""
         group = self.get_global_process_group("tp-pp", is_expert=False, check_initialized=True)
@@ -1667,6 +1818,7 @@ class ParallelContext:
                     eod_mask_loss=args.eod_mask_loss,
                     create_attention_mask=args.create_attention_mask_in_dataloader,
                     apply_sft_dataset_separated_loss_mask_if_existed=args.apply_sft_dataset_separated_loss_mask_if_existed,
+                    sft_sequence_packing=args.sft_sequence_packing,
                 )
             else:
                 tokenizer = get_tokenizer()
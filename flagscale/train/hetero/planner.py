@@ -0,0 +1,412 @@
+"""
+Offline planner for heterogeneous training topologies.
+
+The hetero arguments are validated and the process meshes, the inter-mesh connections and
+the global process groups are built by the same code as a real job, but against a fake world
+of N ranks (torch "fake" process group backend), so no device or cluster is needed.
+
+Example:
+    python -m flagscale.train.hetero.planner \\
+        --hetero-process-meshes 2 1 1 4 1 2 1 1 2 2 --hetero-device-types A800 BI150 \\
+        --device-tflops A800=312 BI150=128 --num-layers 32 --hidden-size 4096 \\
+        --seq-length 4096 --micro-batch-size 1 --global-batch-size 512
+"""
+
+import argparse
+import heapq
+import json
+
+from argparse import Namespace
+from collections import defaultdict
+
+import torch
+
+from flagscale.train.hetero.parallel_context import ParallelContext, RankMapper
+
+# (token, is_expert) of the groups built inside every process mesh
+MESH_GROUP_TOKENS = [
+    ("dp", False),
+    ("dp-cp", False),
+    ("cp", False),
+    ("tp-pp", False),
+    ("tp", False),
+    ("pp", False),
+    ("tp-dp-cp", False),
+    ("tp-dp", False),
+    ("tp-cp", False),
+    ("ep", True),
+    ("tp", True),
+    ("tp-ep", True),
+    ("tp-ep-pp", True),
+    ("dp", True),
+]
+# (token, is_expert) of the groups crossing all the process meshes
+GLOBAL_GROUP_TOKENS = [("tp-pp", False), ("pp", False), ("tp-ep-pp", True)]
+
+DTYPE_BYTES = {"fp32": 4, "fp16": 2, "bf16": 2}
+
+
+class OfflineParallelContext(ParallelContext):
+    """ParallelContext of a fake world, without the model related configs."""
+
+    def build_config(self):
+        pass
+
+    def get_all_inter_mesh_tensor_slices(self, mesh_index, local_tensor_shape):
+        """Slices sent by every rank of the last stage of mesh_index to the next mesh."""
+        process_mesh = self._process_meshes[mesh_index]
+        current_process_mesh_index = self._current_process_mesh_index
+        self._current_process_mesh_index = mesh_index
+        try:
+            return {
+                ranks[-1]: self.get_inter_mesh_tensor_slices(ranks[-1], local_tensor_shape)
+                for ranks in process_mesh.get_all_process_group_ranks("pp")
+            }
+        finally:
+            self._current_process_mesh_index = current_process_mesh_index
+
+
+def build_planner_args(
+    hetero_process_meshes,
+    hetero_device_types,
+    num_layers,
+    hidden_size,
+    seq_length,
+    micro_batch_size,
+    hetero_pipeline_layer_split=None,
+    expert_tensor_parallel_size_per_process_mesh=None,
+    untie_embeddings_and_output_weights=False,
+    use_distributed_optimizer=False,
+    use_partial_reduce_for_shared_embedding=False,
+):
+    """Build the subset of the training arguments used to create the hetero topology."""
+    meshes = [hetero_process_meshes[i : i + 5] for i in range(0, len(hetero_process_meshes), 5)]
+    return Namespace(
+        enable_hetero=True,
+        hetero_process_meshes=list(hetero_process_meshes),
+        hetero_device_types=list(hetero_device_types),
+        hetero_current_device_type=hetero_device_types[0] if hetero_device_types else None,
+        hetero_pipeline_layer_split=hetero_pipeline_layer_split,
+        hetero_use_cpu_communication=False,
+        num_layers=num_layers,
+        hidden_size=hidden_size,
+        seq_length=seq_length,
+        micro_batch_size=micro_batch_size,
+        tensor_model_parallel_size=meshes[0][0] if meshes else 1,
+        context_parallel_size=meshes[0][1] if meshes else 1,
+        pipeline_model_parallel_size=sum(mesh[4] for mesh in meshes if len(mesh) == 5),
+        pipeline_model_parallel_split_rank=None,
+        num_layers_per_virtual_pipeline_stage=None,
+        standalone_embedding_stage=False,
+        expert_model_parallel_size=1,
+        expert_tensor_parallel_size=None,
+        expert_tensor_parallel_size_per_process_mesh=expert_tensor_parallel_size_per_process_mesh,
+        num_distributed_optimizer_instances=1,
+        untie_embeddings_and_output_weights=untie_embeddings_and_output_weights,
+        mtp_num_layers=None,
+        use_distributed_optimizer=use_distributed_optimizer,
+        use_partial_reduce_for_shared_embedding=use_partial_reduce_for_shared_embedding,
+        sequence_parallel=True,
+        calculate_per_token_loss=False,
+        use_tp_pp_dp_mapping=False,
+        nccl_communicator_config_path=None,
+        distributed_timeout_minutes=10,
+        distributed_backend="fake",
+        enable_gloo_process_groups=False,
+    )
+
+
+def build_fake_rank_infos(hetero_process_meshes, hetero_device_types):
+    """Rank infos of a world launched mesh by mesh, every mesh on its own device type."""
+    rank_infos = []
+    for (tp, cp, ep, dp, pp), device_type in zip(hetero_process_meshes, hetero_device_types):
+        for _ in range(tp * cp * dp * pp):
+            rank_infos.append({"rank": len(rank_infos), "device_type": device_type})
+    return rank_infos
+
+
+def layer_flops_per_token(hidden_size, seq_length, ffn_hidden_size=None, swiglu=False):
+    """Forward and backward flops of one transformer layer per token."""
+    ffn_hidden_size = ffn_hidden_size or 4 * hidden_size
+    forward = (
+        8 * hidden_size * hidden_size
+        + 4 * seq_length * hidden_size
+        + (6 if swiglu else 4) * hidden_size * ffn_hidden_size
+    )
+    return 3 * forward
+
+
+def estimate_layer_split(stage_costs, num_layers):
+    """Split num_layers across the pipeline stages minimizing the slowest stage.
+
+    stage_costs[i] is the time of one layer on stage i. Every stage gets at least one layer,
+    then every layer goes to the stage which finishes it first, which is optimal for identical
+    layers.
+    """
+    if num_layers < len(stage_costs):
+        raise ValueError(
+            f"num_layers {num_layers} should be at least the number of pipeline stages {len(stage_costs)}"
+        )
+    layer_split = [1] * len(stage_costs)
+    heap = [(2 * cost, i) for i, cost in enumerate(stage_costs)]
+    heapq.heapify(heap)
+    for _ in range(num_layers - len(stage_costs)):
+        _, i = heapq.heappop(heap)
+        layer_split[i] += 1
+        heapq.heappush(heap, ((layer_split[i] + 1) * stage_costs[i], i))
+    return layer_split
+
+
+def _pipeline_estimate(layer_split, stage_costs, num_microbatches):
+    stage_times = [layers * cost for layers, cost in zip(layer_split, stage_costs)]
+    bottleneck = max(stage_times)
+    estimate = {
+        "layer_split": list(layer_split),
+        "stage_ms": [round(t * 1e3, 3) for t in stage_times],
+        "bottleneck_ms": round(bottleneck * 1e3, 3),
+        "balance": round(sum(stage_times) / len(stage_times) / bottleneck, 3),
+    }
+    if num_microbatches is not None:
+        estimate["step_ms"] = round(
+            (num_microbatches + len(stage_times) - 1) * bottleneck * 1e3, 3
+        )
+    return estimate
+
+
+def _plan_inter_mesh(context, mesh_index, seq_length, micro_batch_sizes, hidden_size, dtype_bytes):
+    """Fan-out and per-link bytes of one microbatch sent from mesh_index to the next mesh."""
+    process_mesh1 = context._process_meshes[mesh_index]
+    process_mesh2 = context._process_meshes[mesh_index + 1]
+    tp1 = process_mesh1.get_parallel_size("tp")
+    cp1 = process_mesh1.get_parallel_size("cp")
+    tp2 = process_mesh2.get_parallel_size("tp")
+    # the same sequence split as the hetero p2p communication
+    sp1 = cp1 if tp1 == 1 and tp2 == 1 else tp1 * cp1
+    local_tensor_shape = (seq_length // sp1, micro_batch_sizes[mesh_index], hidden_size)
+    all_slices = context.get_all_inter_mesh_tensor_slices(mesh_index, local_tensor_shape)
+
+    fan_in = defaultdict(int)
+    link_bytes = []
+    for slices in all_slices.values():
+        for dst_rank, (dp_start, dp_end), (sp_start, sp_end), local_hidden_size in slices:
+            fan_in[dst_rank] += 1
+            link_bytes.append(
+                (sp_end - sp_start) * (dp_end - dp_start) * local_hidden_size * dtype_bytes
+            )
+    fan_out = [len(slices) for slices in all_slices.values()]
+    return {
+        "meshes": [mesh_index, mesh_index + 1],
+        "local_tensor_shape": list(local_tensor_shape),
+        "num_links": len(link_bytes),
+        "max_fan_out": max(fan_out),
+        "max_fan_in": max(fan_in.values()),
+        "min_link_bytes": min(link_bytes),
+        "max_link_bytes": max(link_bytes),
+        # the gradients of the backward pass have the same size
+        "total_bytes_per_microbatch": sum(link_bytes),
+    }
+
+
+def plan_hetero_topology(
+    args,
+    device_tflops=None,
+    ffn_hidden_size=None,
+    swiglu=False,
+    params_dtype="bf16",
+    global_batch_size=None,
+):
+    """Validate a hetero configuration and report its topology offline.
+
+    args holds the training arguments used by the hetero topology, see build_planner_args.
+    device_tflops maps a device type to its sustained throughput, the device types without a
+    figure count as 1 TFLOPS, which still ranks the layouts when the figures are relative.
+    Raises AssertionError or RuntimeError like the training when the configuration is invalid.
+    """
+    from flagscale.train.arguments import FSTrainArguments
+
+    if torch.distributed.is_initialized():
+        raise RuntimeError("The hetero planner creates its own fake world, call it before torch.distributed")
+    assert args.hetero_process_meshes is not None and len(args.hetero_process_meshes) % 5 == 0, (
+        f"length of hetero_process_meshes {args.hetero_process_meshes} should be divisible by 5"
+    )
+    hetero_process_meshes = [
+        args.hetero_process_meshes[i : i + 5] for i in range(0, len(args.hetero_process_meshes), 5)
+    ]
+    world_size = sum(tp * cp * dp * pp for tp, cp, ep, dp, pp in hetero_process_meshes)
+    # the micro batch size of every mesh, before the arguments are specialized to rank 0
+    micro_batch_sizes = [
+        hetero_process_meshes[0][3] * args.micro_batch_size // dp for _, _, _, dp, _ in hetero_process_meshes
+    ]
+    device_tflops = device_tflops or {}
+
+    from torch.testing._internal.distributed.fake_pg import FakeStore
+
+    torch.distributed.init_process_group(
+        "fake", store=FakeStore(), rank=0, world_size=world_size
+    )
+    try:
+        rank_mapper = RankMapper(
+            args, rank_infos=build_fake_rank_infos(hetero_process_meshes, args.hetero_device_types)
+        )
+        FSTrainArguments(args, rank_mapper=rank_mapper).pre_validate_args()
+        context = OfflineParallelContext(args, rank_mapper=rank_mapper)
+
+        meshes = []
+        for process_mesh, (tp, cp, ep, dp, pp), device_type in zip(
+            context._process_meshes, hetero_process_meshes, args.hetero_device_types
+        ):
+            group_counts = {}
+            for token, is_expert in MESH_GROUP_TOKENS:
+                ranks = process_mesh.get_all_process_group_ranks(token, is_expert=is_expert)
+                group_counts[("exp_" if is_expert else "") + token] = len(ranks or [])
+            meshes.append(
+                {
+                    "device_type": device_type,
+                    "tp": tp,
+                    "cp": cp,
+                    "ep": ep,
+                    "dp": dp,
+                    "pp": pp,
+                    "world_size": process_mesh._world_size,
+                    "micro_batch_size": micro_batch_sizes[len(meshes)],
+                    "group_counts": group_counts,
+                }
+            )
+        global_group_counts = {}
+        for token, is_expert in GLOBAL_GROUP_TOKENS:
+            ranks = context.get_global_all_group_ranks(token, is_expert=is_expert)
+            global_group_counts[("exp_" if is_expert else "") + token] = len(ranks or [])
+
+        inter_mesh = [
+            _plan_inter_mesh(
+                context,
+                i,
+                args.seq_length,
+                micro_batch_sizes,
+                args.hidden_size,
+                DTYPE_BYTES[params_dtype],
+            )
+            for i in range(len(hetero_process_meshes) - 1)
+        ]
+    finally:
+        torch.distributed.destroy_process_group()
+
+    flops = layer_flops_per_token(args.hidden_size, args.seq_length, ffn_hidden_size, swiglu)
+    stage_costs = []
+    for mesh in meshes:
+        tokens = mesh["micro_batch_size"] * args.seq_length
+        tflops = device_tflops.get(mesh["device_type"], 1.0)
+        stage_costs += [tokens * flops / (mesh["tp"] * mesh["cp"] * tflops * 1e12)] * mesh["pp"]
+    num_microbatches = None
+    if global_batch_size is not None:
+        num_microbatches = global_batch_size // (args.micro_batch_size * hetero_process_meshes[0][3])
+
+    return {
+        "world_size": world_size,
+        "meshes": meshes,
+        "num_groups": sum(sum(mesh["group_counts"].values()) for mesh in meshes)
+        + sum(global_group_counts.values()),
+        "global_group_counts": global_group_counts,
+        "inter_mesh": inter_mesh,
+        "layer_split": _pipeline_estimate(
+            args.hetero_pipeline_layer_split, stage_costs, num_microbatches
+        ),
+        "estimated_layer_split": _pipeline_estimate(
+            estimate_layer_split(stage_costs, args.num_layers), stage_costs, num_microbatches
+        ),
+    }
+
+
+def print_report(report):
+    print(f"world size: {report['world_size']}, process groups: {report['num_groups']}")
+    for i, mesh in enumerate(report["meshes"]):
+        print(
+            f"mesh {i} [{mesh['device_type']}]: tp={mesh['tp']} cp={mesh['cp']} ep={mesh['ep']} "
+            f"dp={mesh['dp']} pp={mesh['pp']} ranks={mesh['world_size']} "
+            f"micro_batch_size={mesh['micro_batch_size']} groups={sum(mesh['group_counts'].values())}"
+        )
+    print(f"global groups: {report['global_group_counts']}")
+    for link in report["inter_mesh"]:
+        src, dst = link["meshes"]
+        print(
+            f"mesh {src} -> mesh {dst}: {link['num_links']} links, fan-out {link['max_fan_out']}, "
+            f"fan-in {link['max_fan_in']}, {link['min_link_bytes']}-{link['max_link_bytes']} bytes per link, "
+            f"{link['total_bytes_per_microbatch']} bytes per microbatch"
+        )
+    for name in ["layer_split", "estimated_layer_split"]:
+        estimate = report[name]
+        line = (
+            f"{name}: {estimate['layer_split']}, bottleneck {estimate['bottleneck_ms']} ms, "
+            f"balance {estimate['balance']}"
+        )
+        if "step_ms" in estimate:
+            line += f", step {estimate['step_ms']} ms"
+        print(line)
+
+
+def _parse_device_tflops(values):
+    device_tflops = {}
+    for value in values or []:
+        device_type, _, tflops = value.partition("=")
+        if not tflops:
+            raise argparse.ArgumentTypeError(f"Invalid device throughput {value}, expected TYPE=TFLOPS")
+        device_tflops[device_type] = float(tflops)
+    return device_tflops
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline planner of hetero training topologies")
+    parser.add_argument("--hetero-process-meshes", type=int, nargs="+", required=True)
+    parser.add_argument("--hetero-device-types", type=str, nargs="+", required=True)
+    parser.add_argument("--hetero-pipeline-layer-split", type=int, nargs="+", default=None)
+    parser.add_argument("--expert-tensor-parallel-size-per-process-mesh", type=int, nargs="+", default=None)
+    parser.add_argument(
+        "--device-tflops",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Sustained throughput of every device type, e.g. A800=312 BI150=128",
+    )
+    parser.add_argument("--num-layers", type=int, required=True)
+    parser.add_argument("--hidden-size", type=int, required=True)
+    parser.add_argument("--ffn-hidden-size", type=int, default=None)
+    parser.add_argument("--swiglu", action="store_true")
+    parser.add_argument("--seq-length", type=int, required=True)
+    parser.add_argument("--micro-batch-size", type=int, required=True)
+    parser.add_argument("--global-batch-size", type=int, default=None)
+    parser.add_argument("--params-dtype", choices=list(DTYPE_BYTES), default="bf16")
+    parser.add_argument("--untie-embeddings-and-output-weights", action="store_true")
+    parser.add_argument("--use-distributed-optimizer", action="store_true")
+    parser.add_argument("--use-partial-reduce-for-shared-embedding", action="store_true")
+    parser.add_argument("--json", type=str, default=None, help="Also write the report to this file")
+    cli_args = parser.parse_args()
+
+    args = build_planner_args(
+        cli_args.hetero_process_meshes,
+        cli_args.hetero_device_types,
+        cli_args.num_layers,
+        cli_args.hidden_size,
+        cli_args.seq_length,
+        cli_args.micro_batch_size,
+        hetero_pipeline_layer_split=cli_args.hetero_pipeline_layer_split,
+        expert_tensor_parallel_size_per_process_mesh=cli_args.expert_tensor_parallel_size_per_process_mesh,
+        untie_embeddings_and_output_weights=cli_args.untie_embeddings_and_output_weights,
+        use_distributed_optimizer=cli_args.use_distributed_optimizer,
+        use_partial_reduce_for_shared_embedding=cli_args.use_partial_reduce_for_shared_embedding,
+    )
+    report = plan_hetero_topology(
+        args,
+        device_tflops=_parse_device_tflops(cli_args.device_tflops),
+        ffn_hidden_size=cli_args.ffn_hidden_size,
+        swiglu=cli_args.swiglu,
+        params_dtype=cli_args.params_dtype,
+        global_batch_size=cli_args.global_batch_size,
+    )
+    print_report(report)
+    if cli_args.json is not None:
+        with open(cli_args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -36,16 +36,19 @@ from .vision_attention import SelfAttentionVision
 
 # Use this spec to use lower level Transformer Engine modules (required for fp8 training)
 def get_gpt_layer_with_transformer_engine_spec(
-    qk_layernorm: bool = False
+    qk_layernorm: bool = False,
+    packed_seq: bool = False,
 ) -> ModuleSpec:
     mlp = get_mlp_module_spec(
         use_te=True, num_experts=None, moe_grouped_gemm=False
     )
+    # NOTE: the mrope freqs are computed per token, with packed (THD) sequences they must not be
+    # restarted at every sequence like the 1D rope, which SelfAttentionVision already handles.
     return ModuleSpec(
         module=TransformerLayer,
         submodules=TransformerLayerSubmodules(
             self_attention=ModuleSpec(
-                module=SelfAttention,
+                module=SelfAttentionVision if packed_seq else SelfAttention,
                 params={"attn_mask_type": AttnMaskType.causal},
                 submodules=SelfAttentionSubmodules(
                     linear_qkv=TELayerNormColumnParallelLinear,
@@ -190,6 +190,7 @@ class Qwen2_5VLModel(MegatronModule):
             attention_mask (torch.Tensor): attention mask for the language model [batch, 1, combined_seq_len, combined_seq_len].
             labels (torch.Tensor): Optional target text labels [batch, combined_seq_len].
             inference_params (InferenceParams): Inference-time parameters including KV cache.
+            packed_seq_params (PackedSeqParams): THD boundaries of the packed samples, None without packing.
 
             video_start_index:
                 0 -- all video
@@ -275,7 +276,7 @@ class Qwen2_5VLModel(MegatronModule):
             decoder_input=combined_embeddings,      # only not None in the first decoder PP stage
             labels=labels,                          # only not None in the last decoder PP stage
             inference_params=inference_params,      # currently always None
-            packed_seq_params=packed_seq_params,    # currently always None
+            packed_seq_params=packed_seq_params,    # THD boundaries of packed samples, else None
             **(extra_block_kwargs or {}),
         )
         return output
@@ -68,9 +68,7 @@ class VisionTransformerBlock(TransformerBlock):
         context_mask: Tensor,
         rotary_pos_emb: Tensor,
         attention_bias: Tensor,
-        packed_seq_params: PackedSeqParams,
-        packed_seq_params_full: PackedSeqParams,
-        fullatt_block_indexes: List[int],
+        layer_packed_seq_params: List[PackedSeqParams],
     ):
         """Forward method with activation checkpointing."""
 
@@ -79,10 +77,6 @@ class VisionTransformerBlock(TransformerBlock):
                 hidden_states, attention_mask, context, context_mask, rotary_pos_emb
             ):
                 for index in range(start, end):
-                    if index in fullatt_block_indexes:
-                        packed_seq_params_now = packed_seq_params_full
-                    else:
-                        packed_seq_params_now = packed_seq_params
                     layer = self._get_layer(index)
                     hidden_states, context = layer(
                         hidden_states=hidden_states,
@@ -92,7 +86,7 @@ class VisionTransformerBlock(TransformerBlock):
                         rotary_pos_emb=rotary_pos_emb,
                         attention_bias=attention_bias,
                         inference_context=None,
-                        packed_seq_params=packed_seq_params_now,
+                        packed_seq_params=layer_packed_seq_params[index],
                     )
                 return hidden_states, context
 
@@ -178,6 +172,7 @@ class VisionTransformerBlock(TransformerBlock):
         inference_params: Optional[BaseInferenceContext] = None,
         packed_seq_params_full: Optional[PackedSeqParams] = None,
         fullatt_block_indexes = None,
+        layer_packed_seq_params: Optional[List[PackedSeqParams]] = None,
     ):
         """
         Perform the forward pass through the transformer block.
@@ -202,6 +197,10 @@ class VisionTransformerBlock(TransformerBlock):
                 optimizations.
             packed_seq_params (PackedSeqParams, optional): Parameters for packed sequence
                 processing.
+            packed_seq_params_full (PackedSeqParams, optional): Parameters of the layers in
+                fullatt_block_indexes, packed_seq_params is used by the other layers.
+            layer_packed_seq_params (List[PackedSeqParams], optional): Parameters of every
+                layer, which replace packed_seq_params_full and fullatt_block_indexes.
 
         Returns:
             Union[Tensor, Tuple[Tensor, Tensor]]: The output hidden states tensor of shape
@@ -210,6 +209,13 @@ class VisionTransformerBlock(TransformerBlock):
 
         inference_context = deprecate_inference_params(inference_context, inference_params)
 
+        if layer_packed_seq_params is None:
+            fullatt_block_indexes = set(fullatt_block_indexes or [])
+            layer_packed_seq_params = [
+                packed_seq_params_full if index in fullatt_block_indexes else packed_seq_params
+                for index in range(len(self.layers))
+            ]
+
         # Delete the obsolete reference to the initial input tensor if necessary
         if isinstance(hidden_states, WrappedTensor):
             hidden_states = hidden_states.unwrap()
@@ -263,16 +269,10 @@ class VisionTransformerBlock(TransformerBlock):
                     context_mask=context_mask,
                     rotary_pos_emb=rotary_pos_emb,
                     attention_bias=attention_bias,
-                    packed_seq_params=packed_seq_params,
-                    packed_seq_params_full=packed_seq_params_full,
-                    fullatt_block_indexes=fullatt_block_indexes
+                    layer_packed_seq_params=layer_packed_seq_params,
                 )
             else:
                 for l_no, layer in enumerate(self.layers):
-                    if l_no in fullatt_block_indexes:
-                        packed_seq_params_now = packed_seq_params_full
-                    else:
-                        packed_seq_params_now = packed_seq_params
                     inner_fp8_context = (
                         get_fp8_context(self.config, layer.layer_number - 1)
                         if use_inner_fp8_context
@@ -289,7 +289,7 @@ class VisionTransformerBlock(TransformerBlock):
                             rotary_pos_sin=rotary_pos_sin,
                             attention_bias=attention_bias,
                             inference_context=inference_context,
-                            packed_seq_params=packed_seq_params_now,
+                            packed_seq_params=layer_packed_seq_params[l_no],
                             sequence_len_offset=sequence_len_offset,
                         )
 
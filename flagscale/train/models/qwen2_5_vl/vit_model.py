@@ -1,6 +1,7 @@
 # Mainly adopted from https://github.com/alibaba/Pai-Megatron-Patch/blob/8949a6647cbf6b39837ad3dd911fa4aa0726895b/megatron_patch/model/qwen2_5_vl/visionmodel.py.
 
-from typing import Optional
+from collections import OrderedDict
+from typing import NamedTuple, Optional, Tuple
 
 import torch
 from torch import nn
@@ -17,6 +18,33 @@ from megatron.core.models.vision.multimodal_projector import MultimodalProjector
 from flagscale.train.models.qwen2_5_vl.vision_transformer_block import VisionTransformerBlock
 
 
+class VisionIndices(NamedTuple):
+    """Index tensors and attention metadata of a batch of (t, h, w) grids, built once per
+    batch and shared by every layer of the vision tower."""
+
+    max_grid_size: int
+    pos_ids: torch.Tensor
+    window_index: torch.Tensor
+    reverse_window_index: torch.Tensor
+    # window attention, the step of cu_seqlens is window_size
+    packed_seq_params: PackedSeqParams
+    # full attention, each frame is a sequence (rather than each grid)
+    packed_seq_params_full: PackedSeqParams
+    # packed_seq_params or packed_seq_params_full for every layer
+    layer_packed_seq_params: Tuple[PackedSeqParams, ...]
+
+
+def _thd_packed_seq_params(cu_seqlens, max_seqlen):
+    # max_seqlen is a python int, so that the attention does not read it back from the device
+    return PackedSeqParams(
+        cu_seqlens_q=cu_seqlens,
+        cu_seqlens_kv=cu_seqlens,
+        qkv_format='thd',
+        max_seqlen_q=max_seqlen,
+        max_seqlen_kv=max_seqlen,
+    )
+
+
 # copied from https://github.com/huggingface/transformers/blob/main/src/transformers/models/qwen2_vl/modeling_qwen2_vl.py
 class PatchEmbed(nn.Module):
     def __init__(
@@ -154,6 +182,11 @@ class Qwen2_5VisionModel(VisionModule):
 
         self.input_tensor = None
 
+        # LRU caches of the rotary/window index tensors, keyed by grid shapes
+        self.index_cache_size = 32
+        self._index_cache = OrderedDict()
+        self._grid_index_cache = OrderedDict()
+
     def set_input_tensor(self, input_tensor: torch.Tensor) -> None:
         """Sets input tensor to the model.
 
@@ -165,82 +198,128 @@ class Qwen2_5VisionModel(VisionModule):
         else:
             raise NotImplementedError()
 
-    def rot_pos_emb(self, grid_thw):
-        pos_ids = []
-        for t, h, w in grid_thw:
-            hpos_ids = torch.arange(h).unsqueeze(1).expand(-1, w)
-            hpos_ids = hpos_ids.reshape(
-                h // self.spatial_merge_size,
-                self.spatial_merge_size,
-                w // self.spatial_merge_size,
-                self.spatial_merge_size,
-            )
-            hpos_ids = hpos_ids.permute(0, 2, 1, 3)
-            hpos_ids = hpos_ids.flatten()
-
-            wpos_ids = torch.arange(w).unsqueeze(0).expand(h, -1)
-            wpos_ids = wpos_ids.reshape(
-                h // self.spatial_merge_size,
-                self.spatial_merge_size,
-                w // self.spatial_merge_size,
-                self.spatial_merge_size,
-            )
-            wpos_ids = wpos_ids.permute(0, 2, 1, 3)
-            wpos_ids = wpos_ids.flatten()
-            pos_ids.append(torch.stack([hpos_ids, wpos_ids], dim=-1).repeat(t, 1))
-        pos_ids = torch.cat(pos_ids, dim=0).to(grid_thw.device)
-        max_grid_size = grid_thw[:, 1:].max()
-        rotary_pos_emb_full = self.rotary_pos_emb(max_grid_size).to(grid_thw.device)
-        rotary_pos_emb = rotary_pos_emb_full[pos_ids].flatten(1)
+    def _grid_rot_pos_ids(self, t, h, w):
+        """(h, w) position ids of one grid, ordered by spatial merge unit: [t * h * w, 2]"""
+        m = self.spatial_merge_size
+        shape = (h // m, m, w // m, m)
+        hpos_ids = torch.arange(h).view(h // m, m, 1, 1).expand(shape).permute(0, 2, 1, 3)
+        wpos_ids = torch.arange(w).view(1, 1, w // m, m).expand(shape).permute(0, 2, 1, 3)
+        pos_ids = torch.stack([hpos_ids.flatten(), wpos_ids.flatten()], dim=-1)
+        return pos_ids.repeat(t, 1)
+
+    def _grid_window_index(self, t, h, w):
+        """Window order of the merge units of one grid and the cumulative window lengths
+        (in patches, without the leading 0)"""
+        # 112 // 2 // 14 = 4
+        vit_merger_window_size = self.window_size // self.spatial_merge_size // self.patch_size
+        llm_grid_h, llm_grid_w = h // self.spatial_merge_size, w // self.spatial_merge_size
+        index = torch.arange(t * llm_grid_h * llm_grid_w).reshape(t, llm_grid_h, llm_grid_w)
+        pad_h = vit_merger_window_size - llm_grid_h % vit_merger_window_size
+        pad_w = vit_merger_window_size - llm_grid_w % vit_merger_window_size
+        num_windows_h = (llm_grid_h + pad_h) // vit_merger_window_size
+        num_windows_w = (llm_grid_w + pad_w) // vit_merger_window_size
+        index_padded = F.pad(index, (0, pad_w, 0, pad_h), "constant", -100)
+        index_padded = index_padded.reshape(
+            t, num_windows_h, vit_merger_window_size, num_windows_w, vit_merger_window_size
+        )
+        index_padded = index_padded.permute(0, 1, 3, 2, 4).reshape(
+            t, num_windows_h * num_windows_w, vit_merger_window_size, vit_merger_window_size
+        )
+        # seqlens: [t * num_windows]
+        seqlens = (index_padded != -100).sum([2, 3]).reshape(-1)
+        index_padded = index_padded.reshape(-1)
+        return index_padded[index_padded != -100], seqlens.cumsum(0) * self.spatial_merge_unit
+
+    def _build_vision_indices(self, grids, device):
+        """VisionIndices of a list of (t, h, w) grids, composed from the per grid cache"""
+        pos_ids, window_index, cu_window_seqlens = [], [], []
+        for grid in grids:
+            if grid not in self._grid_index_cache:
+                self._grid_index_cache[grid] = (
+                    self._grid_rot_pos_ids(*grid),
+                    *self._grid_window_index(*grid),
+                )
+            self._grid_index_cache.move_to_end(grid)
+            grid_pos_ids, grid_window_index, grid_cu_window_seqlens = self._grid_index_cache[grid]
+            pos_ids.append(grid_pos_ids)
+            window_index.append(grid_window_index)
+            cu_window_seqlens.append(grid_cu_window_seqlens)
+        while len(self._grid_index_cache) > self.index_cache_size:
+            self._grid_index_cache.popitem(last=False)
+
+        # offsets of every grid, in merge units for window_index and in patches for cu_seqlens
+        num_units = torch.tensor([t * h * w for t, h, w in grids]) // self.spatial_merge_unit
+        unit_offsets = torch.cumsum(num_units, 0) - num_units
+        window_index = torch.cat(window_index) + torch.repeat_interleave(unit_offsets, num_units)
+        num_windows = torch.tensor([len(cu) for cu in cu_window_seqlens])
+        cu_window_seqlens = torch.cat(cu_window_seqlens) + torch.repeat_interleave(
+            unit_offsets * self.spatial_merge_unit, num_windows
+        )
+        cu_window_seqlens = torch.unique_consecutive(F.pad(cu_window_seqlens, (1, 0), value=0))
+        max_window_seqlen = int((cu_window_seqlens[1:] - cu_window_seqlens[:-1]).max())
+        packed_seq_params = _thd_packed_seq_params(
+            cu_window_seqlens.to(device=device, dtype=torch.int32, non_blocking=True),
+            max_window_seqlen,
+        )
+
+        frame_seqlens = torch.repeat_interleave(
+            torch.tensor([h * w for _, h, w in grids]), torch.tensor([t for t, _, _ in grids])
+        )
+        cu_seqlens = F.pad(frame_seqlens.cumsum(dim=0), (1, 0), value=0)
+        packed_seq_params_full = _thd_packed_seq_params(
+            cu_seqlens.to(device=device, dtype=torch.int32, non_blocking=True),
+            max(h * w for _, h, w in grids),
+        )
+
+        fullatt_block_indexes = set(self.fullatt_block_indexes)
+        return VisionIndices(
+            max_grid_size=max(max(h, w) for _, h, w in grids),
+            pos_ids=torch.cat(pos_ids).to(device, non_blocking=True),
+            window_index=window_index.to(device, non_blocking=True),
+            reverse_window_index=torch.argsort(window_index).to(device, non_blocking=True),
+            packed_seq_params=packed_seq_params,
+            packed_seq_params_full=packed_seq_params_full,
+            layer_packed_seq_params=tuple(
+                packed_seq_params_full if index in fullatt_block_indexes else packed_seq_params
+                for index in range(len(self.decoder.layers))
+            ),
+        )
+
+    def get_vision_indices(self, grid_thw, grids=None):
+        """
+        VisionIndices of grid_thw: max grid size, rotary position ids, window index, reverse
+        window index and the attention metadata of the window and full attention layers.
+        They are memoized on the grid shapes in LRU caches of index_cache_size entries (per batch
+        on device and per grid on host), so that steps reusing the same image resolutions skip
+        rebuilding them. grids, the (t, h, w) of grid_thw on the host, saves reading grid_thw back.
+        """
+        if grids is None:
+            grids = grid_thw.tolist()
+        grids = tuple(tuple(grid) for grid in grids)
+        key = (grids, grid_thw.device)
+        if key not in self._index_cache:
+            self._index_cache[key] = self._build_vision_indices(grids, grid_thw.device)
+        self._index_cache.move_to_end(key)
+        while len(self._index_cache) > self.index_cache_size:
+            self._index_cache.popitem(last=False)
+        return self._index_cache[key]
+
+    def rot_pos_emb(self, grid_thw, vision_indices=None):
+        if vision_indices is None:
+            vision_indices = self.get_vision_indices(grid_thw)
+        rotary_pos_emb_full = self.rotary_pos_emb(vision_indices.max_grid_size).to(grid_thw.device)
+        rotary_pos_emb = rotary_pos_emb_full[vision_indices.pos_ids].flatten(1)
         return rotary_pos_emb
 
-    def get_window_index(self, grid_thw):
+    def get_window_index(self, grid_thw, vision_indices=None):
         '''
         grid_thw: (tiles, 3) ->
         '''
-        window_index: list = []
-        cu_window_seqlens: list = [0]
-        window_index_id = 0
-        # 112 // 2 // 14 = 4
-        vit_merger_window_size = self.window_size // self.spatial_merge_size // self.patch_size
-
-        for grid_t, grid_h, grid_w in grid_thw:
-            llm_grid_h, llm_grid_w = (
-                grid_h // self.spatial_merge_size, # 224 // 2 = 112
-                grid_w // self.spatial_merge_size,
-            )
-            index = torch.arange(grid_t * llm_grid_h * llm_grid_w).reshape(grid_t, llm_grid_h, llm_grid_w)
-            pad_h = vit_merger_window_size - llm_grid_h % vit_merger_window_size # vit_merger_window_size = 4
-            pad_w = vit_merger_window_size - llm_grid_w % vit_merger_window_size
-            num_windows_h = (llm_grid_h + pad_h) // vit_merger_window_size # 向上取整
-            num_windows_w = (llm_grid_w + pad_w) // vit_merger_window_size
-            index_padded = F.pad(index, (0, pad_w, 0, pad_h), "constant", -100)
-            index_padded = index_padded.reshape(
-                grid_t,
-                num_windows_h,
-                vit_merger_window_size,
-                num_windows_w,
-                vit_merger_window_size,
-            )
-            index_padded = index_padded.permute(0, 1, 3, 2, 4).reshape(
-                grid_t,
-                num_windows_h * num_windows_w,
-                vit_merger_window_size,
-                vit_merger_window_size,
-            )
-            seqlens = (index_padded != -100).sum([2, 3]).reshape(-1)
-            index_padded = index_padded.reshape(-1)
-            index_new = index_padded[index_padded != -100]
-            # grid_t * llm_grid_h * llm_grid_w: num_windows
-            window_index.append(index_new + window_index_id)
-            # seqlens: [grid_t, num_windows]
-            cu_seqlens_tmp = seqlens.cumsum(0) * self.spatial_merge_unit + cu_window_seqlens[-1]
-            cu_window_seqlens.extend(cu_seqlens_tmp.tolist())
-            window_index_id += (grid_t * llm_grid_h * llm_grid_w).item()
-        window_index = torch.cat(window_index, dim=0)
+        if vision_indices is None:
+            vision_indices = self.get_vision_indices(grid_thw)
         # window_index: [tiles, num_windows]
         # cu_window_seqlens: the step of cu_seqlens is window_size, not sampel seq_length
-        return window_index, cu_window_seqlens
+        return vision_indices.window_index, vision_indices.packed_seq_params.cu_seqlens_q
 
     def forward(
         self,
@@ -248,6 +327,7 @@ class Qwen2_5VisionModel(VisionModule):
         grid_thw: torch.Tensor,
         inference_params: Optional[InferenceParams] = None,
         extra_block_kwargs: dict = None,
+        vision_indices: Optional[VisionIndices] = None,
     ) -> torch.Tensor:
         """Forward function of the Qwen2 Vision Model. This function passes the input tensors
         through the embedding layer and then the transformer.
@@ -255,7 +335,7 @@ class Qwen2_5VisionModel(VisionModule):
         Args:
             x (torch.Tensor): input image/video data of shape [n_tokens, n_dims]
             grid_thw (torch.Tensor): the size tensor indicates grid size of each image/frame
-            packed_seq_params (PackedSeqParams): parameters to build attention mask in the backend
+            vision_indices (VisionIndices, optional): precomputed get_vision_indices(grid_thw)
 
         Returns:
             x (torch.Tensor): output after final transformer block of shape [b, s, h].
@@ -267,21 +347,17 @@ class Qwen2_5VisionModel(VisionModule):
         # Rotary positional embeddings (embedding is None for PP intermediate devices)
         #vision_data (t, 3) --> (t, embed_dim)
         vision_data = self.patch_embed(vision_data)
-        # window_index: [tiles, num_windows]   cu_window_seqlens: [tiles * num_windows]
-        window_index, cu_window_seqlens = self.get_window_index(grid_thw)
-        cu_window_seqlens = torch.tensor(
-            cu_window_seqlens,
-            device=vision_data.device,
-            dtype=torch.int32,
-        )
-        cu_window_seqlens = torch.unique_consecutive(cu_window_seqlens)
+        # window_index: [tiles, num_windows]
+        if vision_indices is None:
+            vision_indices = self.get_vision_indices(grid_thw)
+        window_index = vision_indices.window_index
 
         seq_len, _ = vision_data.size()
         vision_data = vision_data.reshape(seq_len // self.spatial_merge_unit, self.spatial_merge_unit, -1)
         vision_data = vision_data[window_index, :, :]
         vision_data = vision_data.reshape(seq_len, 1, -1)
 
-        rotary_pos_emb = self.rot_pos_emb(grid_thw)
+        rotary_pos_emb = self.rot_pos_emb(grid_thw, vision_indices)
         rotary_pos_emb = rotary_pos_emb.reshape(seq_len // self.spatial_merge_unit, self.spatial_merge_unit, -1)
         rotary_pos_emb = rotary_pos_emb[window_index, :, :]
         rotary_pos_emb = rotary_pos_emb.reshape(seq_len, 1, 1, -1).repeat(1, 1, 1, 2)
@@ -291,34 +367,10 @@ class Qwen2_5VisionModel(VisionModule):
             attention_mask = None,
             inference_params = inference_params,
             rotary_pos_emb=rotary_pos_emb,
-            packed_seq_params=self.build_packed_seq_params(None, cu_window_seqlens),
-            packed_seq_params_full=self.build_packed_seq_params(grid_thw),
-            fullatt_block_indexes=self.fullatt_block_indexes,
+            packed_seq_params=vision_indices.packed_seq_params,
+            layer_packed_seq_params=vision_indices.layer_packed_seq_params,
             **(extra_block_kwargs or {}),
         )
 
         hidden_states = self.projection(hidden_states.view(-1, self.merge_hidden_size))
-        reverse_indices = torch.argsort(window_index)
-        return hidden_states[reverse_indices, :]
-
-    def build_packed_seq_params(
-        self,
-        grid_thw: Optional[torch.Tensor],
-        cu_seqlens: Optional[torch.Tensor] = None,
-    ) -> PackedSeqParams:
-        # NOTE: each frame is a sequence (rather than each grid)
-        if grid_thw is not None:
-            seqlens = torch.repeat_interleave(grid_thw[:, 1] * grid_thw[:, 2], grid_thw[:, 0])
-            cu_seqlens = seqlens.cumsum(dim=0)
-            cu_seqlens = F.pad(cu_seqlens, (1, 0), value=0).int()
-        else: # the step of cu_seqlens is window_size, not sampel seq_length
-            seqlens = cu_seqlens[1:] - cu_seqlens[:-1]
-
-        max_seqlen_q = seqlens.max()
-        return PackedSeqParams(
-            cu_seqlens_q=cu_seqlens,
-            cu_seqlens_kv=cu_seqlens,
-            qkv_format='thd',
-            max_seqlen_q=max_seqlen_q,
-            max_seqlen_kv=max_seqlen_q
-        )
+        return hidden_states[vision_indices.reverse_window_index, :]
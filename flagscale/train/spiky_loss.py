@@ -3,54 +3,126 @@ import math
 import torch
 
 
+def average_losses_across_microbatches(losses_reduced, average_across_data_parallel=False):
+    """Average the losses of every microbatch on the last pipeline stage.
+
+    The per-token losses are reduced across the data parallel group, as done in train_step.
+    With average_across_data_parallel, the legacy per-microbatch losses are also averaged
+    across the data parallel group, so that every rank of the last stage holds the same value.
+    Returns an empty dict on the other pipeline stages.
+    """
+    from megatron.core import mpu
+
+    loss_reduced = {}
+    if mpu.is_pipeline_last_stage(ignore_virtual=True):
+        # Average loss across microbatches.
+        for key in losses_reduced[0].keys():
+            val = [x[key].view(-1) for x in losses_reduced]
+            if val[0].numel() == 2:
+                # there is one dict per microbatch. in new reporting, we average
+                # over the total number of tokens across the global batch.
+                val = torch.vstack(val).sum(dim=0)
+                torch.distributed.all_reduce(
+                    val, group=mpu.get_data_parallel_group(with_context_parallel=True)
+                )
+                loss_reduced[key] = val[0] / val[1]
+            elif val[0].numel() == 1:
+                # legacy behavior, we average over the number of microbatches
+                val = torch.cat(val).mean()
+                if average_across_data_parallel:
+                    torch.distributed.all_reduce(
+                        val, group=mpu.get_data_parallel_group(with_context_parallel=True)
+                    )
+                    val = val / mpu.get_data_parallel_world_size(with_context_parallel=True)
+                loss_reduced[key] = val
+            else:
+                raise ValueError(f"Invalid value shape: {val[0].shape} for key {key}")
+    return loss_reduced
+
+
 class SpikyLossDetector:
     """This class represents a Spiky Loss Detector.
     It is used to detect spikes in loss values during training.
+
+    The detector keeps an exponential moving mean and variance of the accepted losses on the
+    device. A loss is spiky if it is inf, or if it exceeds the moving mean by more than
+    threshold (relative) and, once min_samples losses were seen, by more than zscore moving
+    standard deviations. Nan losses are never spiky and are left to the nan checks.
     """
 
-    def __init__(self, threshold=0.2, loss=None):
-        self.last_loss = loss
+    def __init__(self, threshold=0.2, loss=None, decay=0.99, zscore=4.0, min_samples=10):
         self.threshold = threshold
+        self.decay = decay
+        self.zscore = zscore
+        self.min_samples = min_samples
+        self.mean = None
+        self.var = None
+        self.count = None
+        if loss is not None:
+            self._init_stats(torch.tensor(float(loss)))
+
+    @property
+    def last_loss(self):
+        return None if self.mean is None else self.mean.item()
+
+    def _init_stats(self, loss):
+        self.mean = loss.detach().float().clone()
+        self.var = torch.zeros_like(self.mean)
+        self.count = torch.ones_like(self.mean)
 
     def reduce_losses(self, losses_reduced):
-        loss_reduced = {}
-        from megatron.core import mpu
-
-        if mpu.is_pipeline_last_stage(ignore_virtual=True):
-            # Average loss across microbatches.
-            for key in losses_reduced[0].keys():
-                val = [x[key].view(-1) for x in losses_reduced]
-                if val[0].numel() == 2:
-                    # there is one dict per microbatch. in new reporting, we average
-                    # over the total number of tokens across the global batch.
-                    val = torch.vstack(val).sum(dim=0)
-                    torch.distributed.all_reduce(
-                        val, group=mpu.get_data_parallel_group(with_context_parallel=True)
-                    )
-                    loss_reduced[key] = val[0] / val[1]
-                elif val[0].numel() == 1:
-                    # legacy behavior, we average over the number of microbatches
-                    val = torch.cat(val).mean()
-                    loss_reduced[key] = val
-                else:
-                    raise ValueError(f"Invalid value shape: {val[0].shape} for key {key}")
+        return average_losses_across_microbatches(
+            losses_reduced, average_across_data_parallel=True
+        ).get("lm loss")
+
+    @torch.no_grad()
+    def detect(self, loss):
+        """Return whether loss is spiky as a bool tensor, without synchronizing with the host.
+
+        The statistics are only updated with the finite losses which are not spiky.
+        """
+        loss = loss.detach().float().reshape(())
+        finite = torch.isfinite(loss)
+        if self.mean is None:
+            self._init_stats(torch.where(finite, loss, torch.zeros_like(loss)))
+            self.count.copy_(finite.float())
+            return torch.isinf(loss)
+        self.mean = self.mean.to(loss.device)
+        self.var = self.var.to(loss.device)
+        self.count = self.count.to(loss.device)
 
-        return loss_reduced.get("lm loss")
+        delta = loss - self.mean
+        relative = delta >= self.threshold * self.mean.abs()
+        outlier = (self.count < self.min_samples) | (delta > self.zscore * self.var.sqrt())
+        spiky = torch.isinf(loss) | (relative & outlier & (self.count > 0))
+
+        # the first accepted loss initializes the statistics
+        accept = finite & ~spiky
+        first = accept & (self.count == 0)
+        decay = torch.where(first, torch.zeros_like(loss), torch.full_like(loss, self.decay))
+        delta = torch.where(accept, delta, torch.zeros_like(delta))
+        self.mean = self.mean + (1 - decay) * delta
+        self.var = torch.where(
+            accept, decay * (self.var + (1 - decay) * delta * delta), self.var
+        )
+        self.count = self.count + accept.float()
+        return spiky
+
+    def skip_flag(self, loss):
+        """Return whether the current iteration is spiky as a device flag for the optimizer.
+
+        loss is the reduced loss of the last pipeline stage, identical across its data parallel
+        ranks, and None on the other stages. The flag is given to optimizer.skip_step_if, which
+        shares it across the ranks together with its inf/nan check or grad norm, so detecting
+        spikes adds no collective and no host synchronization to the iteration.
+        """
+        if loss is None:
+            return torch.zeros((), dtype=torch.bool, device="cuda")
+        return self.detect(loss)
 
     def is_spkiy_loss(self, loss):
         if loss is None:
             return False
-        if self.last_loss is not None:
-            if math.isnan(loss) or math.isnan(self.last_loss):
-                self.last_loss = loss
-            elif math.isinf(loss) or math.isinf(self.last_loss):
-                return True
-            else:
-                result = (loss - self.last_loss) / self.last_loss >= self.threshold
-                if result:
-                    return True
-                else:
-                    self.last_loss = loss
-        else:
-            self.last_loss = loss
-        return False
+        if not isinstance(loss, torch.Tensor):
+            loss = torch.tensor(float(loss))
+        return bool(self.detect(loss).item())
@@ -0,0 +1,278 @@
+import collections
+import functools
+import json
+import time
+
+import torch
+
+# The phases partition the device time of a training step.
+PHASES = ("data-wait", "compute", "pipeline-bubble", "grads-sync", "optimizer", "other")
+# Phases of a rank that other ranks can wait for, used to find the stragglers.
+BUSY_PHASES = ("data-wait", "compute")
+
+
+def pipeline_bubble_fraction(pipeline_size, num_microbatches, virtual_pipeline_size=None):
+    """Fraction of the forward-backward time spent in the bubble of a 1F1B pipeline schedule."""
+    if pipeline_size <= 1:
+        return 0.0
+    num_chunks = (virtual_pipeline_size or 1) * num_microbatches
+    return (pipeline_size - 1) / (num_chunks + pipeline_size - 1)
+
+
+class _HostEvent:
+    """Host clock with the interface of torch.cuda.Event, used without cuda."""
+
+    def __init__(self):
+        self.time = None
+
+    def record(self):
+        self.time = time.perf_counter()
+
+    def query(self):
+        return True
+
+    def elapsed_time(self, end):
+        return (end.time - self.time) * 1000.0
+
+
+class _TimedIterator:
+    """Iterator adding the time spent waiting for the next batch to the current step."""
+
+    def __init__(self, iterable, timeline):
+        self.iterable = iterable
+        self._timeline = timeline
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.iterable)
+        finally:
+            self._timeline.add_data_wait(time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        # e.g. save_state of the dataloaders supporting checkpointing
+        if name == "iterable":
+            raise AttributeError(name)
+        return getattr(self.iterable, name)
+
+
+class StepTimeline:
+    """Always-on timeline of the phases of every training step.
+
+    The boundaries of the phases are recorded with cuda events and only read once they
+    completed, so the training loop is never synchronized with the device. The time waiting
+    for the data is measured on the host. The forward-backward time left is split between the
+    compute and the pipeline bubble with the bubble fraction of the schedule.
+
+    Every interval, the phase times of every rank are gathered with a single small collective
+    to attribute the throughput lost to every phase and to find the stragglers, i.e. the ranks
+    busier than the other ranks of the same pipeline stage by more than straggler_threshold.
+    """
+
+    def __init__(self, interval, path=None, peak_tflops=None, straggler_threshold=1.2, use_cuda=None):
+        self.interval = interval
+        self.path = path
+        self.peak_tflops = peak_tflops
+        self.straggler_threshold = straggler_threshold
+        self.use_cuda = torch.cuda.is_available() if use_cuda is None else use_cuda
+        self._step = None
+        self._pending = collections.deque()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._num_steps = 0
+        self._step_ms = 0.0
+        self._flops = 0.0
+        self._phase_ms = [0.0] * len(PHASES)
+
+    def _event(self):
+        event = torch.cuda.Event(enable_timing=True) if self.use_cuda else _HostEvent()
+        event.record()
+        return event
+
+    def start_step(self):
+        self._step = {"start": self._event(), "phases": [], "data_wait": 0.0}
+
+    def end_step(self, num_floating_point_operations, bubble_fraction=0.0):
+        """Close the current step, num_floating_point_operations is the work of all the ranks."""
+        step, self._step = self._step, None
+        step["end"] = self._event()
+        step["flops"] = num_floating_point_operations
+        step["bubble_fraction"] = bubble_fraction
+        self._pending.append(step)
+        self._collect()
+
+    def add_data_wait(self, seconds):
+        if self._step is not None:
+            self._step["data_wait"] += seconds
+
+    def time_data(self, iterable):
+        return _TimedIterator(iterable, self)
+
+    def wrap(self, name, func):
+        """Record the calls of func during a step as the phase name."""
+
+        @functools.wraps(func)
+        def _timed(*args, **kwargs):
+            if self._step is None:
+                return func(*args, **kwargs)
+            start = self._event()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._step["phases"].append((name, start, self._event()))
+
+        return _timed
+
+    def _collect(self):
+        # the events of a step are recorded in order on the same stream
+        while self._pending and self._pending[0]["end"].query():
+            self._accumulate(self._pending.popleft())
+
+    def _accumulate(self, step):
+        totals = collections.defaultdict(float)
+        for name, start, end in step["phases"]:
+            totals[name] += start.elapsed_time(end)
+        step_ms = step["start"].elapsed_time(step["end"])
+        forward_backward = totals["forward-backward"]
+        # finalize_model_grads runs at the end of the forward-backward schedule
+        grads_sync = min(totals["grads-sync"], forward_backward)
+        busy = forward_backward - grads_sync
+        data_wait = min(step["data_wait"] * 1000.0, busy)
+        bubble = (busy - data_wait) * step["bubble_fraction"]
+        optimizer = totals["optimizer"]
+        phase_ms = (
+            data_wait,
+            busy - data_wait - bubble,
+            bubble,
+            grads_sync,
+            optimizer,
+            max(step_ms - forward_backward - optimizer, 0.0),
+        )
+
+        self._num_steps += 1
+        self._step_ms += step_ms
+        self._flops += step["flops"]
+        for i, ms in enumerate(phase_ms):
+            self._phase_ms[i] += ms
+
+    def report(self, iteration, pipeline_rank=0, group=None):
+        """Gather the phase times of every rank since the last report, called by all ranks.
+
+        Only the steps completed on the device are reported, the others are kept for the
+        next report. Returns None if no rank completed a step.
+        """
+        self._collect()
+        local = torch.tensor(
+            [pipeline_rank, self._num_steps, self._step_ms, self._flops, *self._phase_ms],
+            dtype=torch.float64,
+        )
+        self._reset_window()
+        device = "cuda" if torch.distributed.get_backend(group) == "nccl" else "cpu"
+        world_size = torch.distributed.get_world_size(group)
+        gathered = torch.empty(world_size * local.numel(), dtype=torch.float64, device=device)
+        torch.distributed.all_gather_into_tensor(gathered, local.to(device), group=group)
+        return self.summarize(iteration, gathered.view(world_size, -1).tolist())
+
+    def summarize(self, iteration, rows):
+        """Build the report from the gathered rows, one per rank."""
+        world_size = len(rows)
+        ranks = {}
+        for rank, (pipeline_rank, num_steps, step_ms, flops, *phase_ms) in enumerate(rows):
+            if num_steps > 0:
+                ranks[rank] = (
+                    int(pipeline_rank),
+                    step_ms / num_steps,
+                    flops / num_steps,
+                    [ms / num_steps for ms in phase_ms],
+                )
+        if not ranks:
+            return None
+
+        step_ms = sum(r[1] for r in ranks.values()) / len(ranks)
+        flops = sum(r[2] for r in ranks.values()) / len(ranks)
+        phases_ms = {
+            name: sum(r[3][i] for r in ranks.values()) / len(ranks) for i, name in enumerate(PHASES)
+        }
+        report = {
+            "iteration": iteration,
+            "steps": int(max(row[1] for row in rows)),
+            "step_ms": step_ms,
+            "phases_ms": phases_ms,
+        }
+
+        # the throughput lost to a phase is the share of the step it takes at the compute throughput
+        tflops = flops / (step_ms / 1000.0) / world_size / 1e12 if step_ms > 0 else 0.0
+        compute_ms = phases_ms["compute"]
+        compute_tflops = tflops * step_ms / compute_ms if compute_ms > 0 else 0.0
+        report["tflops"] = tflops
+        report["compute_tflops"] = compute_tflops
+        report["lost_tflops"] = {
+            name: compute_tflops * ms / step_ms if step_ms > 0 else 0.0
+            for name, ms in phases_ms.items()
+            if name != "compute"
+        }
+        if self.peak_tflops:
+            report["mfu"] = tflops / self.peak_tflops
+            report["lost_mfu"] = {
+                name: lost / self.peak_tflops for name, lost in report["lost_tflops"].items()
+            }
+
+        # ranks of different pipeline stages hold different layers
+        busy_ms = {
+            rank: sum(r[3][PHASES.index(name)] for name in BUSY_PHASES) for rank, r in ranks.items()
+        }
+        stages = collections.defaultdict(list)
+        for rank, r in ranks.items():
+            stages[r[0]].append(busy_ms[rank])
+        stragglers = []
+        for rank, r in ranks.items():
+            times = sorted(stages[r[0]])
+            median = times[len(times) // 2]
+            ratio = busy_ms[rank] / median if median > 0 else 1.0
+            if ratio > self.straggler_threshold:
+                stragglers.append(
+                    {"rank": rank, "pipeline_rank": r[0], "busy_ms": busy_ms[rank], "ratio": ratio}
+                )
+        report["stragglers"] = sorted(stragglers, key=lambda s: s["ratio"], reverse=True)
+        return report
+
+    def write(self, report, writer=None, wandb_writer=None):
+        """Append the report to the timeline file and log it, on the logging rank only."""
+        if self.path is not None:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(report, separators=(",", ":")) + "\n")
+
+        iteration = report["iteration"]
+        scalars = {f"step-timeline/{name}-ms": ms for name, ms in report["phases_ms"].items()}
+        scalars["step-timeline/step-ms"] = report["step_ms"]
+        scalars["step-timeline/tflops"] = report["tflops"]
+        scalars["step-timeline/num-stragglers"] = len(report["stragglers"])
+        if "mfu" in report:
+            scalars["step-timeline/mfu"] = report["mfu"]
+            for name, lost in report["lost_mfu"].items():
+                scalars[f"step-timeline/lost-mfu-{name}"] = lost
+        if writer:
+            for key, value in scalars.items():
+                writer.add_scalar(key, value, iteration)
+        if wandb_writer:
+            wandb_writer.log(scalars, iteration)
+
+    @staticmethod
+    def format_report(report):
+        log_string = f" step timeline over {report['steps']} steps (ms):"
+        log_string += f" step: {report['step_ms']:.1f} |"
+        for name, ms in report["phases_ms"].items():
+            log_string += f" {name}: {ms:.1f} |"
+        if "mfu" in report:
+            log_string += f" MFU: {report['mfu'] * 100:.1f}% |"
+        else:
+            log_string += f" TFLOP/s/GPU: {report['tflops']:.1f} |"
+        if report["stragglers"]:
+            log_string += " stragglers: " + ", ".join(
+                f"rank {s['rank']} ({s['ratio']:.2f}x)" for s in report["stragglers"][:4]
+            ) + " |"
+        return log_string
@@ -123,8 +123,12 @@ from megatron.training import ft_integration
 
 from flagscale.train.extra_valid import extra_evaluate_and_print_results
 from flagscale.train.extra_valid import build_extra_valid_data_iterators
+from flagscale.train.extra_valid import init_extra_valid_metadata
 from flagscale.train.stablelm2_scheduler import StableLM2SchedulerConfig
-from flagscale.train.global_vars import get_parallel_context, get_spiky_loss_detector
+from flagscale.train.global_vars import get_parallel_context, get_spiky_loss_detector, get_step_timeline
+from flagscale.train.spiky_loss import average_losses_across_microbatches
+from flagscale.train.step_timeline import pipeline_bubble_fraction
+from flagscale.train.async_eval import AsyncEvaluator
 from flagscale.train.hetero.p2p_communication import get_device_type_for_comm
 from flagscale.train.theoretical_memory_usage import report_theoretical_memory as fs_report_theoretical_memory
 
@@ -1057,6 +1061,13 @@ def pretrain(
 
         iteration = 0
         if args.do_train and args.train_iters > 0:
+            ########## FlagScale Begin ##########
+            async_evaluator = None
+            if args.async_eval and args.do_valid:
+                async_evaluator = build_async_evaluator(
+                    model_provider, model_type, forward_step_func, valid_data_iterator
+                )
+            ########## FlagScale End ##########
             iteration, num_floating_point_operations_so_far = train(
                 forward_step_func,
                 model,
@@ -1069,6 +1080,7 @@ def pretrain(
                 checkpointing_context,
                 non_loss_data_func,
                 extra_valid_dataset_provider,
+                async_evaluator=async_evaluator,
             )
 
         print_datetime('after training is done')
@@ -1126,22 +1138,13 @@ def pretrain(
         )
 
     if extra_valid_dataset_provider is not None:
-        # NOTE(zhaoyinglia): Must rebuild the dataloaders for extra validation here,
-        # to guarantee extra validation start from extra_iter=0 every time,
-        # but we don't need to rebuild the datasets.
-        if args.virtual_pipeline_model_parallel_size is not None:
-            extra_valid_data_iterator = []
-            for i in range(len(model)):
-                mpu.set_virtual_pipeline_model_parallel_rank(i)
-                extra_iterators = build_extra_valid_data_iterators(extra_valid_dataset_provider)
-                extra_valid_data_iterator.append(extra_iterators)
-        else:
-            extra_valid_data_iterator = (
-                build_extra_valid_data_iterators(extra_valid_dataset_provider)
+        prefix = f'iteration {iteration} on extra validation set'
+        # Datasets are built on first use, iterators are released after every evaluation.
+        for extra_valid_index in range(init_extra_valid_metadata()):
+            extra_valid_data_itr = build_extra_valid_data_iterators(
+                extra_valid_dataset_provider, extra_valid_index, model
             )
-        if getattr(args, "do_extra_valid", False):
-            prefix = f'iteration {iteration} on extra validation set'
-            for extra_valid_index, extra_valid_data_itr in enumerate(extra_valid_data_iterator):
+            if getattr(args, "do_extra_valid", False):
                 extra_evaluate_and_print_results(
                     extra_valid_index,
                     prefix,
@@ -1155,6 +1158,7 @@ def pretrain(
                     write_to_tensorboard=not args.skip_train,
                     non_loss_data_func=non_loss_data_func
                 )
+            del extra_valid_data_itr
 
     wandb_writer = get_wandb_writer()
     if wandb_writer:
@@ -1612,6 +1616,7 @@ def train_step(forward_step_func, data_iterator, model, optimizer, opt_param_sch
         gc.collect()
         torch.cuda.empty_cache()
 
+    step_timeline = get_step_timeline()
     rerun_state_machine = get_rerun_state_machine()
     while rerun_state_machine.should_run_forward_backward(data_iterator):
         # Set grad to zero.
@@ -1629,6 +1634,10 @@ def train_step(forward_step_func, data_iterator, model, optimizer, opt_param_sch
 
         # Forward pass.
         forward_backward_func = get_forward_backward_func()
+        ########## FlagScale Begin ##########
+        if step_timeline is not None:
+            forward_backward_func = step_timeline.wrap("forward-backward", forward_backward_func)
+        ########## FlagScale End ##########
         losses_reduced = forward_backward_func(
             forward_step_func=forward_step_func,
             data_iterator=data_iterator,
@@ -1645,15 +1654,14 @@ def train_step(forward_step_func, data_iterator, model, optimizer, opt_param_sch
         return {}, True, should_checkpoint, should_exit, exit_code, None, None
 
     ########## FlagScale Begin ##########
+    loss_reduced = None
     if args.auto_skip_spiky_loss and (args.consumed_train_samples > args.lr_warmup_samples and args.curr_iteration > args.lr_warmup_iters):
-        spiky_loss_detector = get_spiky_loss_detector()
-        loss_ = spiky_loss_detector.reduce_losses(losses_reduced)
-        is_spiky_loss = spiky_loss_detector.is_spkiy_loss(loss_)
-        is_spiky_loss_tensor = torch.tensor(is_spiky_loss, dtype=torch.int, device="cuda")
-        torch.distributed.all_reduce(is_spiky_loss_tensor, op=torch.distributed.ReduceOp.MAX)
-        is_spiky_loss = is_spiky_loss_tensor.item()
-        if is_spiky_loss > 0:
-            return {}, True, should_checkpoint, should_exit, exit_code, None, None
+        # The losses are reduced once here and reused for logging below, the optimizer
+        # shares the decision across the ranks and skips the update like on inf/nan grads.
+        loss_reduced = average_losses_across_microbatches(
+            losses_reduced, average_across_data_parallel=True
+        )
+        optimizer.skip_step_if(get_spiky_loss_detector().skip_flag(loss_reduced.get("lm loss")))
     ########## FlagScale End ##########
 
     # Empty unused memory.
@@ -1668,7 +1676,12 @@ def train_step(forward_step_func, data_iterator, model, optimizer, opt_param_sch
     # Update parameters.
 
     timers('optimizer', log_level=1).start(barrier=args.barrier_with_L1_time)
-    update_successful, grad_norm, num_zeros_in_grad = optimizer.step()
+    ########## FlagScale Begin ##########
+    optimizer_step = optimizer.step
+    if step_timeline is not None:
+        optimizer_step = step_timeline.wrap("optimizer", optimizer_step)
+    update_successful, grad_norm, num_zeros_in_grad = optimizer_step()
+    ########## FlagScale End ##########
     timers('optimizer').stop()
 
     # when freezing sub-models we may have a mixture of successful and unsucessful ranks,
@@ -1704,24 +1717,8 @@ def train_step(forward_step_func, data_iterator, model, optimizer, opt_param_sch
 
     if mpu.is_pipeline_last_stage(ignore_virtual=True):
         # Average loss across microbatches.
-        loss_reduced = {}
-        for key in losses_reduced[0].keys():
-            val = [x[key].view(-1) for x in losses_reduced]
-            if val[0].numel() == 2:
-                # there is one dict per microbatch. in new reporting, we average
-                # over the total number of tokens across the global batch.
-                val = torch.vstack(val).sum(dim=0)
-                torch.distributed.all_reduce(
-                    val,
-                    group=mpu.get_data_parallel_group(with_context_parallel=True)
-                )
-                loss_reduced[key] = val[0] / val[1]
-            elif val[0].numel() == 1:
-                # legacy behavior, we average over the number of microbatches
-                val = torch.cat(val).mean()
-                loss_reduced[key] = val
-            else:
-                raise ValueError(f"Invalid value shape: {val[0].shape} for key {key}")
+        if loss_reduced is None:
+            loss_reduced = average_losses_across_microbatches(losses_reduced)
         return (
             loss_reduced,
             skipped_iter,
@@ -1906,6 +1903,18 @@ def training_log(
                     {"mem-allocated-count": mem_stats["allocation.all.current"]}, iteration
                 )
 
+    ########## FlagScale Begin ##########
+    step_timeline = get_step_timeline()
+    if step_timeline is not None and iteration % step_timeline.interval == 0:
+        # Every rank takes part in the gather.
+        timeline_report = step_timeline.report(
+            iteration, pipeline_rank=mpu.get_pipeline_model_parallel_rank()
+        )
+        if timeline_report is not None and is_last_rank():
+            step_timeline.write(timeline_report, writer, wandb_writer)
+            print_rank_last(step_timeline.format_report(timeline_report))
+    ########## FlagScale End ##########
+
     if args.num_experts is not None:
         moe_loss_scale = 1 / get_num_microbatches()
         track_names = []
@@ -2294,6 +2303,7 @@ def train(
     checkpointing_context,
     non_loss_data_func,
     extra_valid_dataset_provider=None,
+    async_evaluator=None,
 ):
     """Training function: run train_step desired number of times, run validation, checkpoint."""
     args = get_args()
@@ -2364,6 +2374,11 @@ def train(
         if len(model) == 1:
             config.param_sync_func = config.param_sync_func[0]
     config.finalize_model_grads_func = finalize_model_grads
+    ########## FlagScale Begin ##########
+    step_timeline = get_step_timeline()
+    if step_timeline is not None:
+        config.finalize_model_grads_func = step_timeline.wrap("grads-sync", finalize_model_grads)
+    ########## FlagScale End ##########
 
     timers('interval-time', log_level=0).start(barrier=True)
     print_datetime('before the start of training step')
@@ -2555,6 +2570,10 @@ def train(
         ########## FlagScale end ##########
 
         ft_integration.on_training_step_start()
+        ########## FlagScale Begin ##########
+        if step_timeline is not None:
+            step_timeline.start_step()
+        ########## FlagScale End ##########
         (
             loss_dict,
             skipped_iter,
@@ -2567,6 +2586,20 @@ def train(
             forward_step_func, train_data_iterator, model, optimizer, opt_param_scheduler, config
         )
         ft_integration.on_training_step_end()
+        ########## FlagScale Begin ##########
+        if step_timeline is not None:
+            step_batch_size = (
+                mpu.get_data_parallel_world_size() * args.micro_batch_size * get_num_microbatches()
+            )
+            step_timeline.end_step(
+                num_floating_point_operations_fs(args, step_batch_size),
+                bubble_fraction=pipeline_bubble_fraction(
+                    mpu.get_pipeline_model_parallel_world_size(),
+                    get_num_microbatches(),
+                    mpu.get_virtual_pipeline_model_parallel_world_size(),
+                ),
+            )
+        ########## FlagScale End ##########
         if should_checkpoint:
             save_checkpoint_and_time(
                 iteration,
@@ -2645,8 +2678,27 @@ def train(
             num_zeros_in_grad,
         )
 
+        ########## FlagScale Begin ##########
+        if async_evaluator is not None:
+            if args.eval_interval and iteration % args.eval_interval == 0:
+                if should_disable_forward_pre_hook(args):
+                    disable_forward_pre_hook(model)
+                    pre_hook_enabled = False
+                submit_async_evaluation(async_evaluator, model, iteration)
+                if should_disable_forward_pre_hook(args):
+                    enable_forward_pre_hook(model)
+                    pre_hook_enabled = True
+            if iteration % args.log_interval == 0:
+                print_async_evaluation_results(async_evaluator)
+        ########## FlagScale End ##########
+
         # Evaluation.
-        if args.eval_interval and iteration % args.eval_interval == 0 and args.do_valid:
+        if (
+            args.eval_interval
+            and iteration % args.eval_interval == 0
+            and args.do_valid
+            and async_evaluator is None
+        ):
             timers('interval-time').stop()
             if should_disable_forward_pre_hook(args):
                 disable_forward_pre_hook(model)
@@ -2684,22 +2736,17 @@ def train(
 
         # Extra Evaluation =====================================================================
         if args.extra_eval_interval and iteration % args.extra_eval_interval == 0:
-            # NOTE(zhaoyinglia): Must rebuild the dataloaders for extra validation here,
-            # to guarantee extra validation start from extra_iter=0 every time,
-            # but we don't need to rebuild the datasets.
-            if args.virtual_pipeline_model_parallel_size is not None:
-                extra_valid_data_iterator = []
-                for i in range(len(model)):
-                    mpu.set_virtual_pipeline_model_parallel_rank(i)
-                    extra_iterators = build_extra_valid_data_iterators(extra_valid_dataset_provider)
-                    extra_valid_data_iterator.append(extra_iterators)
-            else:
-                extra_valid_data_iterator = (
-                    build_extra_valid_data_iterators(extra_valid_dataset_provider)
-                )
             timers('interval-time').stop()
+            # The datasets are built lazily on the first extra evaluation, and one iterator
+            # at a time is alive, it is released before evaluating the next dataset.
+            num_extra_valid_datasets = init_extra_valid_metadata()
             # do_extra_valid flag is used to indicate that we are doing extra validation
             # and is set in the build_extra_valid_data_iterators function
+            extra_valid_data_itr = None
+            if num_extra_valid_datasets > 0:
+                extra_valid_data_itr = build_extra_valid_data_iterators(
+                    extra_valid_dataset_provider, 0, model
+                )
             if getattr(args, "do_extra_valid", False):
                 if should_disable_forward_pre_hook(args):
                     disable_forward_pre_hook(model)
@@ -2708,7 +2755,11 @@ def train(
                     # Collect all objects.
                     gc.collect()
                 prefix = 'iteration {}'.format(iteration)
-                for extra_valid_index, extra_valid_data_itr in enumerate(extra_valid_data_iterator):
+                for extra_valid_index in range(num_extra_valid_datasets):
+                    if extra_valid_index > 0:
+                        extra_valid_data_itr = build_extra_valid_data_iterators(
+                            extra_valid_dataset_provider, extra_valid_index, model
+                        )
                     timers('extra-eval-time', log_level=0).start(barrier=True)
                     extra_eval_iters = args.extra_eval_iters_list[extra_valid_index]
                     extra_evaluate_and_print_results(
@@ -2727,6 +2778,7 @@ def train(
                     extra_eval_duration += timers('extra-eval-time').elapsed()
                     extra_eval_iterations += extra_eval_iters
                     timers('extra-eval-time').stop()
+                    extra_valid_data_itr = None
                 one_logger_utils.track_e2e_metrics()
 
                 if args.manual_gc and args.manual_gc_eval:
@@ -2764,6 +2816,12 @@ def train(
 
     one_logger_utils.track_e2e_metrics()
 
+    ########## FlagScale Begin ##########
+    if async_evaluator is not None:
+        print_async_evaluation_results(async_evaluator, wait=True)
+        async_evaluator.shutdown()
+    ########## FlagScale End ##########
+
     # Flush TensorBoard, WandB writers and one-logger.
     writer = get_tensorboard_writer()
     if writer:
@@ -2936,6 +2994,77 @@ def evaluate(
     return total_loss_dict, collected_non_loss_data, False
 
 
+########## FlagScale Begin ##########
+def evaluate_local(forward_step_func, data_iterator, model):
+    """Evaluation without communication, returns the local sum and count of every loss.
+
+    Runs in the thread of the AsyncEvaluator, where the batches are read without the tensor
+    parallel broadcast and the timers and straggler detector of the training are skipped.
+    The rerun state machine is disabled for the whole run, as checked by --async-eval.
+    """
+    args = get_args()
+    eval_num_microbatches = args.global_batch_size // (args.micro_batch_size * args.data_parallel_size)
+    forward_backward_func = get_forward_backward_func()
+
+    total_loss_dict = {}
+    with torch.no_grad():
+        for _ in range(args.eval_iters):
+            loss_dicts = forward_backward_func(
+                forward_step_func=forward_step_func,
+                data_iterator=data_iterator,
+                model=model,
+                num_microbatches=eval_num_microbatches,
+                seq_length=args.seq_length,
+                micro_batch_size=args.micro_batch_size,
+                decoder_seq_length=args.decoder_seq_length,
+                forward_only=True,
+            )
+            for key in loss_dicts[0].keys():
+                val = [x[key].view(-1) for x in loss_dicts]
+                if val[0].numel() == 2:
+                    val = torch.vstack(val).sum(dim=0)
+                elif val[0].numel() == 1:
+                    val = torch.cat(val).sum()
+                    val = torch.stack([val, torch.full_like(val, len(loss_dicts))])
+                else:
+                    raise ValueError(f"Invalid value shape: {val[0].shape} for key {key}")
+                if key not in total_loss_dict:
+                    total_loss_dict[key] = torch.zeros_like(val, dtype=torch.float)
+                total_loss_dict[key] += val
+    return total_loss_dict
+
+
+def build_async_evaluator(model_provider, model_type, forward_step_func, data_iterator):
+    """Build the evaluator validating a snapshot of the weights while the training goes on."""
+    print_rank_0('building the eval model of the async evaluation ...')
+    eval_model = get_model(model_provider, model_type, wrap_with_ddp=False)
+    for model_module in eval_model:
+        model_module.eval()
+    return AsyncEvaluator(
+        eval_model,
+        functools.partial(evaluate_local, forward_step_func, data_iterator),
+        group=mpu.get_data_parallel_group(with_context_parallel=True),
+        unwrap_func=unwrap_model,
+    )
+
+
+def submit_async_evaluation(async_evaluator, model, iteration):
+    """Snapshot the weights of model for the validation at iteration."""
+    args = get_args()
+    async_evaluator.submit(iteration, model, context=args.consumed_train_samples)
+    args.consumed_valid_samples += args.eval_iters * args.global_batch_size
+
+
+def print_async_evaluation_results(async_evaluator, wait=False):
+    """Dump the results of the completed async validations against their iterations."""
+    writer = get_tensorboard_writer()
+    for iteration, consumed_train_samples, total_loss_dict in async_evaluator.poll(wait=wait):
+        print_validation_results(
+            f'iteration {iteration}', total_loss_dict, iteration, consumed_train_samples, writer
+        )
+########## FlagScale End ##########
+
+
 def evaluate_and_print_results(
     prefix,
     forward_step_func,
@@ -2955,8 +3084,6 @@ def evaluate_and_print_results(
     else:
         writer = None
 
-    wandb_writer = get_wandb_writer()
-
     total_loss_dict, collected_non_loss_data, timelimit = evaluate(
         forward_step_func,
         data_iterator,
@@ -2969,6 +3096,16 @@ def evaluate_and_print_results(
     # Timelimit hit during evaluation
     if timelimit:
         return
+    print_validation_results(prefix, total_loss_dict, iteration, args.consumed_train_samples, writer)
+
+    if process_non_loss_data_func is not None and writer and is_last_rank():
+        process_non_loss_data_func(collected_non_loss_data, iteration, writer)
+
+
+def print_validation_results(prefix, total_loss_dict, iteration, consumed_train_samples, writer):
+    """Dump the validation losses on screen and to the writers."""
+    args = get_args()
+    wandb_writer = get_wandb_writer()
     string = f' validation loss at {prefix} | '
     for key in total_loss_dict:
         string += '{} value: {:.6E} | '.format(key, total_loss_dict[key].item())
@@ -2979,24 +3116,21 @@ def evaluate_and_print_results(
             writer.add_scalar(
                 '{} validation vs samples'.format(key),
                 total_loss_dict[key].item(),
-                args.consumed_train_samples,
+                consumed_train_samples,
             )
             if args.log_validation_ppl_to_tensorboard:
                 writer.add_scalar('{} validation ppl'.format(key), ppl, iteration)
                 writer.add_scalar(
-                    '{} validation ppl vs samples'.format(key), ppl, args.consumed_train_samples
+                    '{} validation ppl vs samples'.format(key), ppl, consumed_train_samples
                 )
             if wandb_writer and is_last_rank():
                 wandb_writer.log(
                     {'{} validation'.format(key): total_loss_dict[key].item()}, iteration
                 )
                 wandb_writer.log({
-                    '{} validation vs samples'.format(key): args.consumed_train_samples},
+                    '{} validation vs samples'.format(key): consumed_train_samples},
                     iteration)
 
-    if process_non_loss_data_func is not None and writer and is_last_rank():
-        process_non_loss_data_func(collected_non_loss_data, iteration, writer)
-
     length = len(string) + 1
     print_rank_last('-' * length)
     print_rank_last(string)
@@ -3107,23 +3241,33 @@ def build_train_valid_test_data_iterators(build_train_valid_test_datasets_provid
     dl_type = args.dataloader_type
     assert dl_type in ['single', 'cyclic', 'external']
 
-    def _get_iterator(dataloader_type, dataloader):
+    def _get_iterator(dataloader_type, dataloader, time_data=None):
         """Return dataset iterator."""
+        ########## FlagScale Begin ##########
+        if time_data is None:
+            time_data = lambda iterator: iterator
         if dataloader_type == "single":
-            return RerunDataIterator(iter(dataloader))
+            return RerunDataIterator(time_data(iter(dataloader)))
         elif dataloader_type == "cyclic":
-            return RerunDataIterator(iter(cyclic_iter(dataloader)))
+            return RerunDataIterator(time_data(iter(cyclic_iter(dataloader))))
         elif dataloader_type == "external":
             # External dataloader is passed through. User is expected to define how to iterate.
             if isinstance(dataloader, list):
-                return [RerunDataIterator(d) for d in dataloader]
+                return [RerunDataIterator(time_data(d)) for d in dataloader]
             else:
-                return RerunDataIterator(dataloader)
+                return RerunDataIterator(time_data(dataloader))
         else:
             raise RuntimeError("unexpected dataloader type")
+        ########## FlagScale End ##########
 
     if train_dataloader is not None:
-        train_data_iterator = _get_iterator(dl_type, train_dataloader)
+        ########## FlagScale Begin ##########
+        # Time the waits for the training data in the step timeline.
+        step_timeline = get_step_timeline()
+        train_data_iterator = _get_iterator(
+            dl_type, train_dataloader, step_timeline.time_data if step_timeline else None
+        )
+        ########## FlagScale End ##########
     else:
         train_data_iterator = None
 
@@ -7,7 +7,7 @@ from typing import List, Optional, Tuple, Union
 
 import torch
 
-from megatron.core import mpu
+from megatron.core import mpu, tensor_parallel
 from megatron.core.datasets.blended_megatron_dataset_builder import BlendedMegatronDatasetBuilder
 from megatron.core.datasets.gpt_dataset import GPTDataset, GPTDatasetConfig, MockGPTDataset
 from megatron.core.enums import ModelType
@@ -45,7 +45,11 @@ try:
 except ImportError:
     has_nvidia_modelopt = False
 
-from flagscale.train.datasets.sft_dataset import SFTDatasetConfig, SFTDataset
+from flagscale.train.datasets.sft_dataset import (
+    SFTDataset,
+    SFTDatasetConfig,
+    get_packed_seq_params,
+)
 from flagscale.train.extra_valid import extra_valid_datasets_provider
 from flagscale.train.train import pretrain
 from flagscale.train.global_vars import get_parallel_context
@@ -146,10 +150,26 @@ def model_provider(pre_process=True, post_process=True) -> Union[GPTModel, megat
 
 def get_batch(data_iterator):
     """Generate a batch."""
+    args = get_args()
+    if args.sft_sequence_packing:
+        assert not args.use_legacy_models, "Sequence packing requires the mcore models"
+        assert args.context_parallel_size == 1, "Sequence packing does not support context parallel"
+        # the intermediate stages have no data to read the document boundaries from
+        assert (
+            args.pipeline_model_parallel_size <= 2
+        ), "Sequence packing supports at most two pipeline stages"
 
     # TODO: this is pretty hacky, find a better way
     if (not mpu.is_pipeline_first_stage()) and (not mpu.is_pipeline_last_stage()):
-        return None, None, None, None, None
+        return None, None, None, None, None, None
+
+    cu_seqlens = None
+    if args.sft_sequence_packing:
+        # get_batch_on_this_tp_rank drops cu_seqlens, so the sample is read here first
+        if mpu.get_tensor_model_parallel_rank() == 0:
+            data = next(data_iterator)
+            cu_seqlens = data["cu_seqlens"]
+            data_iterator = iter([data])
 
     # get batches based on the TP rank you are on
     batch = get_batch_on_this_tp_rank(data_iterator)
@@ -157,7 +177,18 @@ def get_batch(data_iterator):
     # slice batch along sequence dimension for context parallelism
     batch = get_batch_on_this_cp_rank(batch)
 
-    return batch.values()
+    packed_seq_params = None
+    if args.sft_sequence_packing:
+        # packed conversations must not attend across their boundaries
+        if mpu.get_tensor_model_parallel_world_size() > 1:
+            cu_seqlens = tensor_parallel.broadcast_data(
+                ["cu_seqlens"], {"cu_seqlens": cu_seqlens}, torch.int32
+            )["cu_seqlens"]
+        else:
+            cu_seqlens = cu_seqlens.cuda(non_blocking=True)
+        packed_seq_params = get_packed_seq_params(cu_seqlens)
+
+    return (*batch.values(), packed_seq_params)
 
 
 # define spiky loss as a loss that's 10x the max loss observed
@@ -246,13 +277,17 @@ def forward_step(data_iterator, model: GPTModel):
     timers('batch-generator', log_level=2).start()
     global stimer
     with stimer(bdata=True):
-        tokens, labels, loss_mask, attention_mask, position_ids = get_batch(
+        tokens, labels, loss_mask, attention_mask, position_ids, packed_seq_params = get_batch(
             data_iterator)
     timers('batch-generator').stop()
 
     with stimer:
-        output_tensor = model(tokens, position_ids, attention_mask,
-                              labels=labels)
+        if args.use_legacy_models:
+            output_tensor = model(tokens, position_ids, attention_mask,
+                                  labels=labels)
+        else:
+            output_tensor = model(tokens, position_ids, attention_mask,
+                                  labels=labels, packed_seq_params=packed_seq_params)
 
     return output_tensor, partial(loss_func, loss_mask)
 
@@ -313,6 +348,7 @@ def core_sft_dataset_config_from_args(args):
         eod_mask_loss=args.eod_mask_loss,
         create_attention_mask=args.create_attention_mask_in_dataloader,
         apply_sft_dataset_separated_loss_mask_if_existed=args.apply_sft_dataset_separated_loss_mask_if_existed,
+        sft_sequence_packing=args.sft_sequence_packing,
     )
 
 
@@ -7,7 +7,7 @@ from typing import List, Optional, Tuple, Union
 
 import torch
 
-from megatron.core import parallel_state
+from megatron.core import parallel_state, tensor_parallel
 from megatron.core.datasets.blended_megatron_dataset_builder import BlendedMegatronDatasetBuilder
 from megatron.core.datasets.gpt_dataset import GPTDataset, GPTDatasetConfig, MockGPTDataset
 from megatron.core.enums import ModelType
@@ -46,7 +46,11 @@ try:
 except ImportError:
     has_nvidia_modelopt = False
 
-from flagscale.train.datasets.sft_dataset import SFTDatasetConfig, SFTDataset
+from flagscale.train.datasets.sft_dataset import (
+    SFTDataset,
+    SFTDatasetConfig,
+    get_packed_seq_params,
+)
 from flagscale.train.extra_valid import extra_valid_datasets_provider
 from flagscale.train.train import pretrain
 from flagscale.train.global_vars import get_parallel_context
@@ -179,12 +183,28 @@ def model_provider(
 
 def get_batch(data_iterator):
     """Generate a batch."""
+    args = get_args()
+    if args.sft_sequence_packing:
+        assert not args.use_legacy_models, "Sequence packing requires the mcore models"
+        assert args.context_parallel_size == 1, "Sequence packing does not support context parallel"
+        # the intermediate stages have no data to read the document boundaries from
+        assert (
+            args.pipeline_model_parallel_size <= 2
+        ), "Sequence packing supports at most two pipeline stages"
 
     # TODO: this is pretty hacky, find a better way
     if (not parallel_state.is_pipeline_first_stage(ignore_virtual=True)) and (
         not parallel_state.is_pipeline_last_stage(ignore_virtual=True)
     ):
-        return None, None, None, None, None
+        return None, None, None, None, None, None
+
+    cu_seqlens = None
+    if args.sft_sequence_packing:
+        # get_batch_on_this_tp_rank drops cu_seqlens, so the sample is read here first
+        if parallel_state.get_tensor_model_parallel_rank() == 0:
+            data = next(data_iterator)
+            cu_seqlens = data["cu_seqlens"]
+            data_iterator = iter([data])
 
     # get batches based on the TP rank you are on
     batch = get_batch_on_this_tp_rank(data_iterator)
@@ -192,7 +212,18 @@ def get_batch(data_iterator):
     # slice batch along sequence dimension for context parallelism
     batch = get_batch_on_this_cp_rank(batch)
 
-    return batch.values()
+    packed_seq_params = None
+    if args.sft_sequence_packing:
+        # packed conversations must not attend across their boundaries
+        if parallel_state.get_tensor_model_parallel_world_size() > 1:
+            cu_seqlens = tensor_parallel.broadcast_data(
+                ["cu_seqlens"], {"cu_seqlens": cu_seqlens}, torch.int32
+            )["cu_seqlens"]
+        else:
+            cu_seqlens = cu_seqlens.cuda(non_blocking=True)
+        packed_seq_params = get_packed_seq_params(cu_seqlens)
+
+    return (*batch.values(), packed_seq_params)
 
 
 # define spiky loss as a loss that's 10x the max loss observed
@@ -275,7 +306,9 @@ def forward_step(data_iterator, model: GPTModel):
     timers('batch-generator', log_level=2).start()
     global stimer
     with stimer(bdata=True):
-        tokens, labels, loss_mask, attention_mask, position_ids = get_batch(data_iterator)
+        tokens, labels, loss_mask, attention_mask, position_ids, packed_seq_params = get_batch(
+            data_iterator
+        )
     timers('batch-generator').stop()
 
     with stimer:
@@ -283,7 +316,12 @@ def forward_step(data_iterator, model: GPTModel):
             output_tensor = model(tokens, position_ids, attention_mask, labels=labels)
         else:
             output_tensor = model(
-                tokens, position_ids, attention_mask, labels=labels, loss_mask=loss_mask
+                tokens,
+                position_ids,
+                attention_mask,
+                labels=labels,
+                loss_mask=loss_mask,
+                packed_seq_params=packed_seq_params,
             )
 
     # [ModelOpt]: model is needed to access ModelOpt distillation losses
@@ -347,6 +385,7 @@ def core_sft_dataset_config_from_args(args):
         eod_mask_loss=args.eod_mask_loss,
         create_attention_mask=args.create_attention_mask_in_dataloader,
         apply_sft_dataset_separated_loss_mask_if_existed=args.apply_sft_dataset_separated_loss_mask_if_existed,
+        sft_sequence_packing=args.sft_sequence_packing,
     )
 
 
@@ -34,6 +34,7 @@ from megatron.core.datasets.blended_megatron_dataset_builder import BlendedMegat
 from megatron.core.datasets.gpt_dataset import GPTDataset, GPTDatasetConfig, MockGPTDataset
 from megatron.training.checkpointing import get_checkpoint_name # for dataloder
 from megatron.core.enums import ModelType
+from megatron.core.packed_seq_params import PackedSeqParams
 from megatron.core.models.gpt import GPTModel
 from megatron.core.models.gpt.gpt_layer_specs import (
     get_gpt_decoder_block_spec,
@@ -132,7 +133,12 @@ def model_provider(
 
     print_rank_0("building Qwen2-5-VL model in TE...")
     # Layer Specs of vit, llm and projector
-    transformer_layer_spec = get_gpt_layer_with_transformer_engine_spec(args.qk_layernorm)
+    if args.packing_buffer_size is not None:
+        assert args.micro_batch_size == 1, "Sample packing requires --micro-batch-size 1"
+        assert args.context_parallel_size == 1, "Sample packing does not support context parallel"
+    transformer_layer_spec = get_gpt_layer_with_transformer_engine_spec(
+        args.qk_layernorm, packed_seq=args.packing_buffer_size is not None
+    )
     vision_model_spec = get_qwen2vl_vision_model_spec()
     vision_projector_spec = get_mlp_module_spec(add_norm=False).submodules
     if args.enable_variable_seq_lengths:
@@ -358,6 +364,42 @@ def get_rope_index(
 
         return position_ids, mrope_position_deltas
 
+def get_packed_rope_index(
+    input_ids,
+    cu_seqlens,
+    image_grid_thw,
+    video_grid_thw,
+    second_per_grid_ts,
+    pad_token,
+):
+    """Calculate the 3D rope index of every sample packed into input_ids [1, seqlen],
+    restarting the positions at each boundary of cu_seqlens."""
+    tokenizer = get_tokenizer()
+    position_ids = torch.zeros(
+        3, 1, input_ids.shape[1], dtype=input_ids.dtype, device=input_ids.device
+    )
+    image_index, video_index = 0, 0
+    for beg, end in zip(cu_seqlens[:-1].tolist(), cu_seqlens[1:].tolist()):
+        if beg == end:
+            continue
+        segment = input_ids[:, beg:end]
+        # each vision input starts with <|vision_start|> followed by its pad token
+        vision_start_indices = torch.argwhere(segment[0] == tokenizer.vision_start_token_id).squeeze(1)
+        vision_start_indices = vision_start_indices[vision_start_indices + 1 < segment.shape[1]]
+        vision_tokens = segment[0, vision_start_indices + 1]
+        image_nums = (vision_tokens == tokenizer.image_token_id).sum().item()
+        video_nums = (vision_tokens == tokenizer.video_token_id).sum().item()
+        position_ids[:, :, beg:end], _ = get_rope_index(
+            input_ids=segment,
+            image_grid_thw=image_grid_thw[image_index : image_index + image_nums],
+            video_grid_thw=video_grid_thw[video_index : video_index + video_nums],
+            second_per_grid_ts=second_per_grid_ts[video_index : video_index + video_nums],
+            attention_mask=segment != pad_token,
+        )
+        image_index += image_nums
+        video_index += video_nums
+    return position_ids
+
 def get_ltor_masks_and_position_ids(
         input_ids,
         image_thw_grids,
@@ -365,17 +407,23 @@ def get_ltor_masks_and_position_ids(
         target,
         pad_token,
         second_per_grid_ts,
-        ignore_index=None
+        ignore_index=None,
+        cu_seqlens=None
     ):
     """Build masks and position id for left to right model."""
     # Position ids. [3 X bs X seqlen]
-    position_ids, _ = get_rope_index(
-        input_ids=input_ids,
-        image_grid_thw=image_thw_grids,
-        video_grid_thw=video_thw_grids,
-        second_per_grid_ts=second_per_grid_ts,
-        attention_mask=input_ids != pad_token
-    )
+    if cu_seqlens is not None:
+        position_ids = get_packed_rope_index(
+            input_ids, cu_seqlens, image_thw_grids, video_thw_grids, second_per_grid_ts, pad_token
+        )
+    else:
+        position_ids, _ = get_rope_index(
+            input_ids=input_ids,
+            image_grid_thw=image_thw_grids,
+            video_grid_thw=video_thw_grids,
+            second_per_grid_ts=second_per_grid_ts,
+            attention_mask=input_ids != pad_token
+        )
 
     # Loss mask.
     loss_mask = torch.ones(target.size(), dtype=torch.float, device=input_ids.device)
@@ -431,7 +479,8 @@ def get_batch(data_iterator):
     #     torch.cuda.empty_cache()
     #     LAST_LARGE_IMG = True
     args = get_args()
-    if data_text.shape[-1] == args.max_padding_length and get_pipeline_model_parallel_rank() == 0:
+    # NOTE: packed sequences always have max_padding_length tokens, the fixed shape needs no cache clearing
+    if data_text.shape[-1] == args.max_padding_length and get_pipeline_model_parallel_rank() == 0 and args.packing_buffer_size is None:
         torch.cuda.empty_cache()
     # shape: n_video_samples
     video_thw_grids = broadcast_data(["video_thw_grids"], data, torch.long)["video_thw_grids"]
@@ -441,6 +490,9 @@ def get_batch(data_iterator):
 
     image_input_mask = broadcast_data(["image_input_mask"], data, torch.bool)["image_input_mask"]
     video_input_mask = broadcast_data(["video_input_mask"], data, torch.bool)["video_input_mask"]
+    cu_seqlens = None
+    if args.packing_buffer_size is not None:
+        cu_seqlens = broadcast_data(["cu_seqlens"], data, torch.int32)["cu_seqlens"][0]
     torch.cuda.nvtx.range_pop()
 
     torch.cuda.nvtx.range_push("index tokens")
@@ -452,11 +504,22 @@ def get_batch(data_iterator):
     assert tokens.shape == labels.shape, f"tokens: {tokens.shape} != labels: {labels.shape}"
     torch.cuda.nvtx.range_pop()
 
-    # NOTE: no sequence packing in LLM inputs
     torch.cuda.nvtx.range_push("get_ltor_masks_and_position_ids")
     attention_mask, loss_mask, position_ids = get_ltor_masks_and_position_ids(
-        tokens, image_thw_grids, video_thw_grids, labels, IGNORE_IDX, second_per_grid_ts
+        tokens, image_thw_grids, video_thw_grids, labels, IGNORE_IDX, second_per_grid_ts,
+        cu_seqlens=cu_seqlens
     )
+    packed_seq_params = None
+    if cu_seqlens is not None:
+        # samples packed in a sequence neither attend to each other nor share positions
+        max_seqlen = (cu_seqlens[1:] - cu_seqlens[:-1]).max().item()
+        packed_seq_params = PackedSeqParams(
+            qkv_format="thd",
+            cu_seqlens_q=cu_seqlens,
+            cu_seqlens_kv=cu_seqlens,
+            max_seqlen_q=max_seqlen,
+            max_seqlen_kv=max_seqlen,
+        )
     torch.cuda.nvtx.range_pop()
 
     return (
@@ -470,7 +533,8 @@ def get_batch(data_iterator):
         image_thw_grids,
         video_thw_grids,
         image_input_mask,
-        video_input_mask
+        video_input_mask,
+        packed_seq_params
     )
 
 # define spiky loss as a loss that's 10x the max loss observed
@@ -564,7 +628,8 @@ def forward_step(data_iterator, model: Qwen2_5VLModel):
             image_thw_grids,
             video_thw_grids,
             image_input_mask,
-            video_input_mask
+            video_input_mask,
+            packed_seq_params
         ) = get_batch(data_iterator)
     timers('batch-generator').stop()
     vision_data = torch.cat([imgs, videos], dim=0)
@@ -579,7 +644,8 @@ def forward_step(data_iterator, model: Qwen2_5VLModel):
             image_input_mask = image_input_mask,
             video_input_mask = video_input_mask,
             attention_mask = attention_mask,
-            labels = labels
+            labels = labels,
+            packed_seq_params = packed_seq_params
         )
 
     return output_tensor, partial(loss_func, loss_mask, model=model)
@@ -607,6 +673,7 @@ def datasets_provider(worker_config=None):
         batch_size=args.micro_batch_size,
         task_encoder=TaskEncoder(),
         worker_config=worker_config,
+        packing_buffer_size=args.packing_buffer_size,
         virtual_epoch_length=0,
         max_samples_per_sequence=args.max_samples_per_sequence, # sequential shuffle in a tar
         shuffle_buffer_size=args.shuffle_buffer_size, # shuffle in a sequential
@@ -762,6 +829,8 @@ def add_multimodal_extra_args(parser):
     group.add_argument("--vision-root", type=str, default = None, help="The vision dirctory root path.")
     group.add_argument("--max-samples-per-sequence", type=int, default=2**31-1, help="max sequencial seqence samples in a slice")
     group.add_argument("--shuffle-buffer-size", type=int, default=0, help="the buffer size to shuffle the samples in a seqence")
+    group.add_argument("--packing-buffer-size", type=int, default=None, help="the number of samples buffered to pack several samples into one sequence of max-padding-length tokens. None is disable.")
+    group.add_argument("--length-bucket-size", type=int, default=0, help="the token length width of the buckets grouping samples of similar length into a batch. 0 is disable.")
     # learning rate
     group.add_argument("--vision-ration", type=float, default=0.1, help="the learning rate ration of vision(inlude merger) compared with llm")
     group.add_argument("--image-max-pixels", type=int, default=768*768, help="the maximum pixels of a single image")
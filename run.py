@@ -98,6 +98,8 @@ def main(config: DictConfig) -> None:
             runner.run()
         elif config.action == "dryrun":
             runner.run(dryrun=True)
+        elif config.action == "resume":
+            runner.run(resume=True)
         elif config.action == "stop":
             runner.stop()
         else:
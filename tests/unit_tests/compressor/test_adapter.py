@@ -2,9 +2,20 @@ import os
 
 import torch
 
-from transformers import AutoImageProcessor, AutoModel, AutoModelForCausalLM, AutoTokenizer
+from accelerate import init_empty_weights
+from llmcompressor.modifiers.utils.layer_compressor import LayerCompressor
+from transformers import (
+    AutoImageProcessor,
+    AutoModel,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    LlamaConfig,
+    LlamaForCausalLM,
+)
 
+from flagscale.compress import adapter as adapter_module
 from flagscale.compress.adapter import LLMCompressorAdapter
+from flagscale.compress.calib_cache import CalibrationCache
 from flagscale.inference.processing_emu3 import (
     CachedPrefixConstrainedLogitsProcessor,
     Emu3Processor,
@@ -70,3 +81,103 @@ def test_llmcompressor_adpter_with_dataset():
     adapter = LLMCompressorAdapter(model=model, **quant_args)
     adapter.model.save_pretrained("test_output", save_compressed=True)
     os.remove("test_output")
+
+
+def _quantize_tiny_llama(empty_weights=False, **kwargs):
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    model = LlamaForCausalLM(config).eval()
+    if empty_weights:
+        # the weights are streamed from the checkpoint at kwargs["model_path"]
+        model.save_pretrained(kwargs["model_path"])
+        with init_empty_weights():
+            model = LlamaForCausalLM(config).eval()
+    dataset = [{"input_ids": torch.randint(0, 64, (1, 16))} for _ in range(4)]
+    quant_args = {
+        "targets": ["Linear"],
+        "scheme": "W4A16",
+        "ignore": ["lm_head"],
+        "algo": {"gptq": {"blocksize": 16, "percdamp": 0.01}},
+        "dataset": dataset,
+        "device": "cpu",
+    }
+    adapter = LLMCompressorAdapter(model=model, **quant_args, **kwargs)
+    return adapter.model.state_dict()
+
+
+def _assert_layers_equal(state_dict, reference, layers):
+    prefixes = tuple(f"model.layers.{idx}." for idx in layers)
+    keys = [key for key in reference if key.startswith(prefixes)]
+    assert any(key.endswith("weight_scale") for key in keys)
+    for key in keys:
+        torch.testing.assert_close(state_dict[key], reference[key], rtol=0, atol=0, msg=key)
+
+
+def test_llmcompressor_adapter_concurrent_compression_on_cpu():
+    sequential = _quantize_tiny_llama()
+
+    # quantizing the sublayers of a layer concurrently gives the sequential weights
+    _assert_layers_equal(_quantize_tiny_llama(num_workers=4), sequential, range(3))
+
+    # pipelining calibrates every layer on full precision inputs: the first layer matches
+    # the sequential path, and the other layers do not depend on the number of workers
+    pipelined = _quantize_tiny_llama(pipeline=True, num_workers=4)
+    _assert_layers_equal(pipelined, sequential, range(1))
+    _assert_layers_equal(pipelined, _quantize_tiny_llama(pipeline=True), range(3))
+
+
+def test_llmcompressor_adapter_pipeline_runs_one_forward_per_layer(monkeypatch):
+    calibrate_layer = LayerCompressor.calibrate_layer
+    num_forwards = 0
+
+    def counting_calibrate_layer(self, intermediates):
+        nonlocal num_forwards
+        num_forwards += 1
+        return calibrate_layer(self, intermediates)
+
+    monkeypatch.setattr(LayerCompressor, "calibrate_layer", counting_calibrate_layer)
+    _quantize_tiny_llama()
+    assert num_forwards == 2 * 3
+
+    # the pipelined path skips the quantized forward of every layer
+    num_forwards = 0
+    _quantize_tiny_llama(pipeline=True)
+    assert num_forwards == 3
+
+
+def test_llmcompressor_adapter_offloaded_calibration_on_cpu(tmp_path):
+    sequential = _quantize_tiny_llama()
+
+    # streaming the layers and spilling the activations gives the in-memory weights
+    offloaded = _quantize_tiny_llama(offload_dir=str(tmp_path / "offload"))
+    _assert_layers_equal(offloaded, sequential, range(3))
+    assert (tmp_path / "offload" / "layers").is_dir()
+
+    # the same with the weights read layer by layer from a checkpoint
+    offloaded = _quantize_tiny_llama(
+        empty_weights=True,
+        model_path=str(tmp_path / "model"),
+        offload_dir=str(tmp_path / "offload_empty"),
+    )
+    _assert_layers_equal(offloaded, sequential, range(3))
+
+
+def test_llmcompressor_adapter_reuses_cached_layer_inputs(tmp_path, monkeypatch):
+    cache = CalibrationCache(str(tmp_path), "tiny-llama", "random", 4, 16)
+    first = _quantize_tiny_llama(calib_cache=cache)
+    assert cache.load_layer_inputs() is not None
+
+    # the second run reads the first layer inputs back instead of running the model
+    def run_calibration_forward(*args, **kwargs):
+        raise AssertionError("the cached layer inputs were not used")
+
+    monkeypatch.setattr(adapter_module, "run_calibration_forward", run_calibration_forward)
+    second = _quantize_tiny_llama(calib_cache=cache)
+    _assert_layers_equal(second, first, range(3))
@@ -0,0 +1,31 @@
+import torch
+
+from flagscale.compress.calib_cache import CalibrationCache
+
+
+def test_batches_are_cached(tmp_path):
+    dataset = [{"input_ids": torch.arange(4) + i} for i in range(8)]
+    cache = CalibrationCache(str(tmp_path), "model", "data", 8, 4)
+    assert len(cache.batches(dataset, 3)) == 3
+
+    cache = CalibrationCache(str(tmp_path), "model", "data", 8, 4)
+    batches = cache.batches([], 3)
+    assert len(batches) == 3
+    assert torch.equal(batches[2]["input_ids"], dataset[2]["input_ids"])
+
+    other = CalibrationCache(str(tmp_path), "model", "data", 8, 8)
+    assert other.cache_dir != cache.cache_dir
+
+
+def test_layer_inputs_are_cached(tmp_path):
+    cache = CalibrationCache(str(tmp_path), "model", "data", 8, 4)
+    assert cache.load_layer_inputs() is None
+
+    spill = cache.new_layer_inputs()
+    spill.append(((torch.ones(2, 4),), {}))
+    assert cache.load_layer_inputs() is None
+    cache.commit_layer_inputs(spill)
+
+    cached = cache.load_layer_inputs()
+    cached.cleanup()
+    assert len(cache.load_layer_inputs()) == 1
@@ -0,0 +1,36 @@
+import torch
+
+from flagscale.compress.checkpoint import CompressCheckpoint
+from flagscale.compress.offload import ActivationSpill
+
+
+def test_save_and_restore_in_memory(tmp_path):
+    checkpoint = CompressCheckpoint(str(tmp_path / "ckpt"))
+    assert checkpoint.last_completed_layer() == -1
+
+    layer = torch.nn.Linear(4, 4)
+    intermediates = [((torch.randn(2, 4),), {"mask": None})]
+    checkpoint.save(0, "model.layers.0", intermediates, module=layer)
+
+    resumed = CompressCheckpoint(str(tmp_path / "ckpt"), resume=True)
+    assert resumed.last_completed_layer() == 0
+    restored = torch.nn.Linear(4, 4)
+    resumed.restore_layer("model.layers.0", restored)
+    assert torch.equal(restored.weight, layer.weight)
+    ((args, kwargs),) = resumed.load_intermediates()
+    assert torch.equal(args[0], intermediates[0][0][0])
+
+    fresh = CompressCheckpoint(str(tmp_path / "ckpt"), resume=False)
+    assert fresh.last_completed_layer() == -1
+
+
+def test_save_spilled_intermediates(tmp_path):
+    checkpoint = CompressCheckpoint(str(tmp_path / "ckpt"))
+    spill = ActivationSpill(str(tmp_path / "activations_0"))
+    spill.append(((torch.ones(2, 4),), {}))
+    checkpoint.save(0, "model.layers.0", spill, module=torch.nn.Linear(4, 4))
+
+    reopened = CompressCheckpoint(str(tmp_path / "ckpt")).load_intermediates()
+    assert isinstance(reopened, ActivationSpill)
+    assert len(reopened) == 1
+    assert torch.equal(reopened[0][0][0], torch.ones(2, 4))
@@ -0,0 +1,50 @@
+import torch
+
+from accelerate import init_empty_weights
+from safetensors.torch import save_file
+
+from flagscale.compress.offload import ActivationSpill, SafetensorsWeightLoader, offload_module
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(8, 4)
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(4, 4) for _ in range(2)])
+
+
+def test_activation_spill(tmp_path):
+    spill = ActivationSpill(str(tmp_path / "spill"))
+    for i in range(3):
+        spill.append(((torch.full((2, 4), float(i)),), {"mask": None, "pos": torch.arange(4)}))
+    assert len(spill) == 3
+    for i, (args, kwargs) in enumerate(spill):
+        assert torch.equal(args[0], torch.full((2, 4), float(i)))
+        assert kwargs["mask"] is None
+    spill.cleanup()
+    assert len(spill) == 0
+    assert not (tmp_path / "spill").exists()
+
+
+def test_load_layer_by_layer(tmp_path):
+    reference = TinyModel()
+    save_file(reference.state_dict(), str(tmp_path / "model.safetensors"))
+
+    with init_empty_weights():
+        model = TinyModel()
+    model.layers[0].register_parameter(
+        "weight_scale", torch.nn.Parameter(torch.empty(4, 1, device="meta"))
+    )
+    loader = SafetensorsWeightLoader(str(tmp_path))
+
+    loader.load_module(model, "", "cpu", skip_prefixes=["layers.0", "layers.1"])
+    assert torch.equal(model.embed.weight, reference.embed.weight)
+    assert all(p.is_meta for p in model.layers.parameters())
+
+    loader.load_module(model.layers[0], "layers.0", "cpu")
+    assert torch.equal(model.layers[0].weight, reference.layers[0].weight)
+    assert not model.layers[0].weight_scale.is_meta
+    assert model.layers[1].weight.is_meta
+
+    offload_module(model.layers[0], str(tmp_path / "layers.0.pt"))
+    assert torch.equal(model.layers[0].bias, reference.layers[0].bias)
@@ -0,0 +1,88 @@
+import torch
+
+from compressed_tensors.quantization import disable_quantization
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from flagscale.compress.adapter import LLMCompressorAdapter
+from flagscale.compress.algo.smooth import SmoothQuantALGO
+
+
+class TinyDecoderLayer(torch.nn.Module):
+    def __init__(self, hidden=8):
+        super().__init__()
+        self.input_layernorm = torch.nn.LayerNorm(hidden)
+        self.self_attn = torch.nn.Module()
+        self.self_attn.q_proj = torch.nn.Linear(hidden, hidden)
+        self.self_attn.k_proj = torch.nn.Linear(hidden, hidden)
+        self.self_attn.v_proj = torch.nn.Linear(hidden, hidden)
+
+    def forward(self, x):
+        x = self.input_layernorm(x)
+        return self.self_attn.q_proj(x) + self.self_attn.k_proj(x) + self.self_attn.v_proj(x)
+
+
+class TinyModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([TinyDecoderLayer() for _ in range(2)])
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+
+@torch.no_grad()
+def test_smoothing_preserves_outputs():
+    torch.manual_seed(0)
+    model = TinyModel()
+    for layer in model.layers:
+        torch.nn.init.normal_(layer.input_layernorm.weight)
+        torch.nn.init.normal_(layer.input_layernorm.bias)
+    batches = [torch.randn(2, 4, 8) * torch.linspace(0.1, 20, 8) for _ in range(3)]
+    reference = [model(batch) for batch in batches]
+
+    for statistic in ["max", "mean"]:
+        algo = SmoothQuantALGO(alpha=0.5, statistic=statistic)
+        algo.preprocess_weight(model)
+        assert len(algo.groups) == 2
+        for batch in batches:
+            model(batch)
+        algo.compress()
+        assert not algo._handles
+        for batch, expected in zip(batches, reference):
+            torch.testing.assert_close(model(batch), expected, rtol=1e-4, atol=1e-4)
+
+
+@torch.no_grad()
+def test_adapter_with_smoothquant_recipe():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+    )
+    model = LlamaForCausalLM(config).eval()
+    dataset = [{"input_ids": torch.randint(0, 64, (1, 8))} for _ in range(4)]
+    reference = [model(**batch).logits for batch in dataset]
+
+    quant_args = {
+        "targets": ["Linear"],
+        "scheme": "W8A16",
+        "ignore": ["lm_head"],
+        "algo": {"smoothquant": {"alpha": 0.5}},
+        "dataset": dataset,
+        "device": "cpu",
+    }
+    adapter = LLMCompressorAdapter(model=model, **quant_args)
+    ### attention and mlp inputs of both decoder layers
+    assert len(adapter.smoother.groups) == 4
+    assert hasattr(model.model.layers[0].self_attn.q_proj, "quantization_scheme")
+    assert not hasattr(model.lm_head, "quantization_scheme")
+
+    model.apply(disable_quantization)
+    for batch, expected in zip(dataset, reference):
+        torch.testing.assert_close(model(**batch).logits, expected, rtol=1e-4, atol=1e-4)
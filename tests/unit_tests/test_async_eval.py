@@ -0,0 +1,162 @@
+import functools
+import threading
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from megatron.core import parallel_state
+from megatron.core.timers import Timers
+from megatron.training import utils as training_utils
+
+from flagscale.train import train, train_gpt
+from flagscale.train.async_eval import AsyncEvaluator, in_async_eval
+
+
+def test_async_evaluator(tmp_path):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{tmp_path / 'store'}", rank=0, world_size=1
+    )
+    try:
+        torch.manual_seed(0)
+        model = [torch.nn.Linear(4, 1)]
+        eval_model = [torch.nn.Linear(4, 1)]
+        inputs, targets = torch.randn(8, 4), torch.randn(8, 1)
+        started, release = threading.Event(), threading.Event()
+
+        def evaluate_func(eval_model):
+            started.set()
+            release.wait()
+            with torch.no_grad():
+                loss = torch.nn.functional.mse_loss(eval_model[0](inputs), targets, reduction="sum")
+            return {"lm loss": torch.stack([loss, torch.tensor(float(targets.numel()))])}
+
+        def expected_loss():
+            with torch.no_grad():
+                return torch.nn.functional.mse_loss(model[0](inputs), targets).item()
+
+        evaluator = AsyncEvaluator(eval_model, evaluate_func, use_cuda=False)
+        assert evaluator.poll() == []
+        expected = expected_loss()
+        evaluator.submit(10, model, context=320)
+        started.wait()
+        # the training goes on while the snapshot is validated
+        with torch.no_grad():
+            model[0].weight.add_(1.0)
+        assert evaluator.poll() == []
+
+        release.set()
+        ((iteration, context, losses),) = evaluator.poll(wait=True)
+        assert iteration == 10 and context == 320
+        assert losses["lm loss"].item() == pytest.approx(expected)
+
+        # losses of the new weights, in the order of the submits
+        evaluator.submit(20, model)
+        evaluator.submit(30, model)
+        results = evaluator.poll(wait=True)
+        assert [iteration for iteration, _, _ in results] == [20, 30]
+        assert results[0][2]["lm loss"].item() == pytest.approx(expected_loss())
+        evaluator.shutdown()
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+class TinyGPT(torch.nn.Module):
+    def __init__(self, vocab_size=16, hidden_size=8):
+        super().__init__()
+        self.embedding = torch.nn.Embedding(vocab_size, hidden_size)
+        self.output_layer = torch.nn.Linear(hidden_size, vocab_size)
+
+    def forward(self, tokens, position_ids, attention_mask, labels=None, **kwargs):
+        logits = self.output_layer(self.embedding(tokens))
+        return torch.nn.functional.cross_entropy(
+            logits.transpose(1, 2), labels, reduction="none"
+        )
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="get_batch moves the batch to the GPU")
+def test_evaluate_local_with_forward_step(tmp_path, monkeypatch):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{tmp_path / 'store'}", rank=0, world_size=1
+    )
+    try:
+        args = SimpleNamespace(
+            global_batch_size=4,
+            micro_batch_size=2,
+            data_parallel_size=1,
+            eval_iters=3,
+            seq_length=8,
+            decoder_seq_length=None,
+            use_legacy_models=False,
+            sft_sequence_packing=False,
+            context_parallel_size=1,
+            pipeline_model_parallel_size=1,
+            mtp_num_layers=None,
+            create_attention_mask_in_dataloader=False,
+            check_for_nan_in_loss_and_grad=True,
+            check_for_spiky_loss=False,
+        )
+        timers = Timers(log_level=2, log_option="minmax")
+        for module in [train, train_gpt, training_utils]:
+            monkeypatch.setattr(module, "get_args", lambda: args)
+        monkeypatch.setattr(train_gpt, "get_timers", lambda: timers)
+        monkeypatch.setattr(train_gpt, "has_nvidia_modelopt", False)
+        monkeypatch.setattr(parallel_state, "is_pipeline_first_stage", lambda **kwargs: True)
+        monkeypatch.setattr(parallel_state, "is_pipeline_last_stage", lambda **kwargs: True)
+        monkeypatch.setattr(parallel_state, "get_tensor_model_parallel_rank", lambda: 0)
+        monkeypatch.setattr(parallel_state, "get_tensor_model_parallel_world_size", lambda: 1)
+        monkeypatch.setattr(parallel_state, "get_context_parallel_world_size", lambda: 1)
+        for name in ["broadcast", "all_reduce", "all_gather"]:
+
+            def no_communication(*a, collective=getattr(torch.distributed, name), **k):
+                assert not in_async_eval(), "the async evaluation must not communicate"
+                return collective(*a, **k)
+
+            monkeypatch.setattr(torch.distributed, name, no_communication)
+
+        def forward_backward_func(
+            forward_step_func, data_iterator, model, num_microbatches, forward_only, **kwargs
+        ):
+            assert forward_only
+            loss_dicts = []
+            for _ in range(num_microbatches):
+                output_tensor, loss_func = forward_step_func(data_iterator, model[0])
+                loss_dicts.append(loss_func(output_tensor)[2])
+            return loss_dicts
+
+        monkeypatch.setattr(train, "get_forward_backward_func", lambda: forward_backward_func)
+
+        torch.manual_seed(0)
+        model = [TinyGPT().cuda()]
+        eval_model = [TinyGPT().cuda().eval()]
+        batches = [
+            {
+                "tokens": torch.randint(0, 16, (2, 8)),
+                "labels": torch.randint(0, 16, (2, 8)),
+                "loss_mask": torch.ones(2, 8),
+                "position_ids": torch.arange(8).repeat(2, 1),
+            }
+            for _ in range(6)
+        ]
+        with torch.no_grad():
+            losses = [
+                model[0](b["tokens"].cuda(), None, None, labels=b["labels"].cuda()) for b in batches
+            ]
+            expected = torch.cat(losses).mean().item()
+
+        evaluator = AsyncEvaluator(
+            eval_model,
+            functools.partial(train.evaluate_local, train_gpt.forward_step, iter(batches)),
+        )
+        # the training holds its timers while the validation runs
+        timers("batch-generator", log_level=2).start()
+        evaluator.submit(10, model)
+        ((iteration, _, total_loss_dict),) = evaluator.poll(wait=True)
+        timers("batch-generator").stop()
+        evaluator.shutdown()
+
+        assert iteration == 10
+        assert total_loss_dict["lm loss"].item() == pytest.approx(expected, rel=1e-5)
+    finally:
+        torch.distributed.destroy_process_group()
@@ -0,0 +1,54 @@
+import numpy
+
+from flagscale.train.datasets.concated_indexed_dataset import ConcatedIndexedDataset
+
+
+class FakeIndexedDataset:
+    def __init__(self, path_prefix, sequences):
+        self.path_prefix = path_prefix
+        self.sequences = [numpy.array(s, dtype=numpy.int32) for s in sequences]
+        self.sequence_lengths = numpy.array([len(s) for s in sequences], dtype=numpy.int32)
+        self.document_indices = numpy.arange(len(sequences) + 1, dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def __getitem__(self, idx):
+        return self.sequences[idx]
+
+    def get(self, idx, offset=0, length=None):
+        end = None if length is None else offset + length
+        return self.sequences[idx][offset:end]
+
+
+def build_datasets():
+    return [
+        FakeIndexedDataset("a", [[1, 2], [3]]),
+        FakeIndexedDataset("b", []),
+        FakeIndexedDataset("c", [[4, 5, 6], [7], [8, 9]]),
+    ]
+
+
+def test_lookup():
+    datasets = build_datasets()
+    dataset = ConcatedIndexedDataset(datasets)
+    flat = [s for d in datasets for s in d.sequences]
+    assert len(dataset) == 5
+    for i, expected in enumerate(flat):
+        assert numpy.array_equal(dataset[i], expected)
+        assert numpy.array_equal(dataset.get(i, offset=1), expected[1:])
+    assert numpy.array_equal(dataset[-1], flat[-1])
+    assert [s.tolist() for s in dataset[1:4]] == [[3], [4, 5, 6], [7]]
+    assert [s.tolist() for s in dataset.get_many([4, 0, 2, 2])] == [
+        [8, 9],
+        [1, 2],
+        [4, 5, 6],
+        [4, 5, 6],
+    ]
+
+
+def test_metadata():
+    dataset = ConcatedIndexedDataset(build_datasets())
+    assert dataset.sequence_lengths.tolist() == [2, 1, 3, 1, 2]
+    assert dataset.document_indices.tolist() == [0, 1, 2, 3, 4, 5]
+    assert dataset.sequence_lengths is dataset.sequence_lengths
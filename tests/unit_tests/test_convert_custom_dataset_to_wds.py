@@ -0,0 +1,52 @@
+import json
+import os
+import tarfile
+
+from tools.datasets.qwenvl.convert_custom_dataset_to_wds_chatml_str import convert
+
+
+def write_dataset(dataset_dir, prefix, num_entries):
+    entries = [
+        {
+            "id": f"{prefix}-{i}",
+            "images": f"{prefix}-{i}.jpg",
+            "conversations": [{"from": "human", "value": f"<image> sample {i} of {prefix}"}],
+        }
+        for i in range(num_entries)
+    ]
+    with open(os.path.join(dataset_dir, "dataset.json"), "w") as f:
+        json.dump(entries, f)
+
+
+def shard_keys(output):
+    keys = {}
+    for name in sorted(os.listdir(output)):
+        if name.endswith(".tar"):
+            with tarfile.open(os.path.join(output, name)) as tar:
+                keys[name] = sorted({member.name.split(".")[0] for member in tar.getmembers()})
+    return keys
+
+
+def test_resume_keeps_completed_shards(tmp_path):
+    write_dataset(tmp_path, "old", 6)
+    output = convert(str(tmp_path), str(tmp_path / "out"), "dataset.json", max_count=2)
+    assert list(shard_keys(output)) == ["pretrain-0.tar", "pretrain-1.tar", "pretrain-2.tar"]
+
+    # an interrupted run lost its last shard
+    os.remove(os.path.join(output, "pretrain-2.tar"))
+    mtime = os.stat(os.path.join(output, "pretrain-0.tar")).st_mtime_ns
+    convert(str(tmp_path), str(tmp_path / "out"), "dataset.json", max_count=2, resume=True)
+    assert os.stat(os.path.join(output, "pretrain-0.tar")).st_mtime_ns == mtime
+    assert shard_keys(output)["pretrain-2.tar"] == ["old-4", "old-5"]
+
+
+def test_resume_drops_shards_of_changed_source(tmp_path):
+    write_dataset(tmp_path, "old", 6)
+    output = convert(str(tmp_path), str(tmp_path / "out"), "dataset.json", max_count=2)
+
+    write_dataset(tmp_path, "new", 3)
+    convert(str(tmp_path), str(tmp_path / "out"), "dataset.json", max_count=2, resume=True)
+    assert shard_keys(output) == {
+        "pretrain-0.tar": ["new-0", "new-1"],
+        "pretrain-1.tar": ["new-2"],
+    }
@@ -0,0 +1,73 @@
+import random
+
+from flagscale.train.hetero.parallel_context import iter_inter_mesh_group_ranks
+
+
+def _backtrack_reference(groups_per_mesh, connections):
+    # the exhaustive search formerly used by ParallelContext.build_global_process_groups
+    results = []
+
+    def _backtrack(mesh_index, path):
+        if mesh_index == len(groups_per_mesh):
+            results.append([rank for ranks in path for rank in ranks])
+            return
+        for ranks in groups_per_mesh[mesh_index]:
+            connected = any(
+                (prev_rank, ranks[0]) in connections for prev in path for prev_rank in prev
+            )
+            if not path or connected:
+                path.append(ranks)
+                _backtrack(mesh_index + 1, path)
+                path.pop()
+
+    _backtrack(0, [])
+    return results
+
+
+def _random_meshes(seed):
+    rng = random.Random(seed)
+    groups_per_mesh, connections = [], {}
+    next_rank = 0
+    for m in range(rng.randint(1, 4)):
+        num_groups, group_size = rng.randint(1, 4), rng.randint(1, 3)
+        groups = [list(range(next_rank + g * group_size, next_rank + (g + 1) * group_size)) for g in range(num_groups)]
+        next_rank += num_groups * group_size
+        if groups_per_mesh:
+            # connect the last rank of a previous group to the first rank of at least one group
+            for prev in groups_per_mesh[-1]:
+                for ranks in rng.sample(groups, rng.randint(1, num_groups)):
+                    connections[(prev[-1], ranks[0])] = True
+        groups_per_mesh.append(groups)
+    return groups_per_mesh, connections, next_rank
+
+
+def test_iter_inter_mesh_group_ranks_two_meshes():
+    # mesh 0 has dp 2 with 2 stages, mesh 1 has dp 4 with a single stage
+    groups_per_mesh = [[[0, 2], [1, 3]], [[4], [5], [6], [7]]]
+    connections = {(2, 4): True, (2, 5): True, (3, 6): True, (3, 7): True}
+
+    assert list(iter_inter_mesh_group_ranks(groups_per_mesh, connections)) == [
+        [0, 2, 4],
+        [0, 2, 5],
+        [1, 3, 6],
+        [1, 3, 7],
+    ]
+    assert list(iter_inter_mesh_group_ranks(groups_per_mesh, connections, rank=3)) == [
+        [1, 3, 6],
+        [1, 3, 7],
+    ]
+    assert list(iter_inter_mesh_group_ranks(groups_per_mesh, connections, rank=5)) == [[0, 2, 5]]
+    assert next(iter_inter_mesh_group_ranks(groups_per_mesh, connections, reverse=True)) == [1, 3, 7]
+
+
+def test_iter_inter_mesh_group_ranks_matches_backtrack():
+    for seed in range(200):
+        groups_per_mesh, connections, world_size = _random_meshes(seed)
+        expected = _backtrack_reference(groups_per_mesh, connections)
+
+        assert list(iter_inter_mesh_group_ranks(groups_per_mesh, connections)) == expected
+        assert list(iter_inter_mesh_group_ranks(groups_per_mesh, connections, reverse=True)) == expected[::-1]
+        for rank in range(world_size):
+            assert list(iter_inter_mesh_group_ranks(groups_per_mesh, connections, rank=rank)) == [
+                ranks for ranks in expected if rank in ranks
+            ]
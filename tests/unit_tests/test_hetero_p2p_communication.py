@@ -0,0 +1,154 @@
+import os
+import socket
+
+from types import SimpleNamespace
+
+import torch
+import torch.multiprocessing as mp
+
+import flagscale.train.hetero.p2p_communication as p2p_communication
+
+from flagscale.train.hetero.p2p_communication import (
+    _exchange_inter_mesh_slices,
+    all_reduce_across_global_groups,
+)
+
+SEQ_LEN, BATCH_SIZE, HIDDEN_SIZE = 4, 2, 3
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _exchange(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+    # rank 0 is the last stage of a mesh without tp, ranks 1 and 2 are the first stage of a
+    # mesh splitting the sequence in two, rank 3 receives the second sample of the batch only
+    groups = {peer: torch.distributed.new_group([0, peer]) for peer in (1, 2, 3)}
+    config = SimpleNamespace(batch_p2p_comm=True, batch_p2p_sync=True)
+    full = torch.arange(SEQ_LEN * BATCH_SIZE * HIDDEN_SIZE, dtype=torch.float32).view(
+        SEQ_LEN, BATCH_SIZE, HIDDEN_SIZE
+    )
+    all_batch = slice(0, BATCH_SIZE)
+    regions = {
+        1: (slice(0, 2), all_batch),
+        2: (slice(2, 4), all_batch),
+        # not contiguous in the sender and the receiver
+        3: (slice(1, 3), slice(1, 2)),
+    }
+
+    if rank == 0:
+        send_plan = [(peer, groups[peer], regions[peer]) for peer in (1, 2, 3)]
+        output_grad = torch.zeros_like(full)
+        _exchange_inter_mesh_slices(
+            config, tensor_send=full, send_plan=send_plan, tensor_recv=output_grad, recv_plan=send_plan
+        )
+        for peer in (1, 2, 3):
+            sp, dp = regions[peer]
+            assert torch.equal(output_grad[sp, dp], -full[sp, dp])
+    else:
+        sp, dp = regions[rank]
+        recv_plan = [(0, groups[rank], (sp, dp))]
+        input_tensor = torch.zeros_like(full)
+        input_grad = -full
+        _exchange_inter_mesh_slices(
+            config,
+            tensor_send=input_grad,
+            send_plan=recv_plan,
+            tensor_recv=input_tensor,
+            recv_plan=recv_plan,
+        )
+        expected = torch.zeros_like(full)
+        expected[sp, dp] = full[sp, dp]
+        assert torch.equal(input_tensor, expected)
+    torch.distributed.destroy_process_group()
+
+
+def test_exchange_inter_mesh_slices_gloo():
+    world_size = 4
+    mp.spawn(_exchange, args=(world_size, _free_port()), nprocs=world_size, join=True)
+
+
+def _reduce(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    # cpu communication, as with hetero_use_cpu_communication
+    torch.distributed.init_process_group("cpu:gloo", rank=rank, world_size=world_size)
+    # mesh 0 holds ranks 0 and 1 (dp 2), mesh 1 holds ranks 2 to 5 (dp 4), so the model
+    # parallel groups are [0, 2], [0, 3], [1, 4] and [1, 5]
+    paths = [[0, 2], [0, 3], [1, 4], [1, 5]]
+    groups = [torch.distributed.new_group(ranks, backend="cpu:gloo") for ranks in paths]
+    mp_groups = [group for group, ranks in zip(groups, paths) if rank in ranks]
+    weight = 1 / 2 if rank < 2 else 1 / 4
+    p2p_communication.get_parallel_context = lambda: SimpleNamespace(
+        get_global_group_replica_weight=lambda groups: weight
+    )
+    # the values are replicated across the data parallel ranks of a mesh
+    norm_2 = torch.tensor([3.0 if rank < 2 else 5.0])
+
+    # same result as reducing over every model parallel group in turn
+    reduced = all_reduce_across_global_groups([(norm_2, mp_groups)])
+    assert torch.allclose(reduced, torch.tensor([8.0]))
+    reduced = all_reduce_across_global_groups(
+        [(norm_2, mp_groups), (torch.ones(1), mp_groups)]
+    )
+    assert torch.allclose(reduced, torch.tensor([10.0]))
+    reduced = all_reduce_across_global_groups(
+        [(norm_2, mp_groups)], op=torch.distributed.ReduceOp.MAX
+    )
+    assert torch.equal(reduced, torch.tensor([5.0]))
+    torch.distributed.destroy_process_group()
+
+
+def test_all_reduce_across_global_groups_gloo():
+    world_size = 6
+    mp.spawn(_reduce, args=(world_size, _free_port()), nprocs=world_size, join=True)
+
+
+def _warm_up(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.distributed.init_process_group("cpu:gloo", rank=rank, world_size=world_size)
+    # a pipeline over the ranks 0, 1 and 2 and over the ranks 0, 1 and 3, each stage holds
+    # the tensor parallel group [0, 1] or [2, 3], the ranks 2 and 3 are data parallel replicas
+    all_groups = {
+        "global-pp": [[0, 1, 2], [0, 1, 3]],
+        "tp": [[0, 1], [2, 3]],
+        "dp": [[2, 3]],
+    }
+    groups = []
+    for group_name, ranks_list in all_groups.items():
+        for ranks in ranks_list:
+            group = torch.distributed.new_group(ranks, backend="cpu:gloo")
+            if rank in ranks:
+                groups.append((group_name, group))
+    # groups of a single rank are skipped
+    singles = [torch.distributed.new_group([r], backend="cpu:gloo") for r in range(world_size)]
+    groups.append(("single", singles[rank]))
+
+    for depth in range(4):
+        p2p_communication._COMM_GROUPS_WARMED_UP = False
+        p2p_communication.get_parallel_context = lambda: SimpleNamespace(
+            _args=SimpleNamespace(hetero_comm_warmup_depth=depth),
+            get_all_process_groups=lambda: groups,
+        )
+        latencies = p2p_communication.warm_up_comm_group_hetero()
+        expected = [
+            name
+            for name, group in groups
+            if name != "single" and p2p_communication._warm_up_depth(name) <= depth
+        ]
+        assert len(latencies) == len(expected)
+        assert all(ms >= 0.0 for ms in latencies.values())
+        # only once
+        assert p2p_communication.warm_up_comm_group_hetero() == {}
+    torch.distributed.destroy_process_group()
+
+
+def test_warm_up_comm_group_hetero_gloo():
+    world_size = 4
+    mp.spawn(_warm_up, args=(world_size, _free_port()), nprocs=world_size, join=True)
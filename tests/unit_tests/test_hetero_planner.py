@@ -0,0 +1,44 @@
+from flagscale.train.hetero.planner import (
+    build_planner_args,
+    estimate_layer_split,
+    plan_hetero_topology,
+)
+
+
+def test_estimate_layer_split():
+    # the second device type is twice slower
+    assert estimate_layer_split([1.0, 1.0, 2.0], 10) == [4, 4, 2]
+    assert estimate_layer_split([1.0, 1.0], 3) == [2, 1]
+    # every stage keeps at least one layer
+    assert estimate_layer_split([1.0, 100.0], 4) == [3, 1]
+
+
+def test_plan_hetero_topology():
+    args = build_planner_args(
+        hetero_process_meshes=[2, 1, 1, 4, 1, 2, 1, 1, 2, 2],
+        hetero_device_types=["A800", "BI150"],
+        num_layers=12,
+        hidden_size=1024,
+        seq_length=512,
+        micro_batch_size=1,
+        hetero_pipeline_layer_split=[4, 4, 4],
+    )
+    report = plan_hetero_topology(
+        args, device_tflops={"A800": 300.0, "BI150": 100.0}, global_batch_size=32
+    )
+
+    assert report["world_size"] == 16
+    assert [mesh["micro_batch_size"] for mesh in report["meshes"]] == [1, 2]
+    assert report["global_group_counts"] == {"tp-pp": 4, "pp": 8, "exp_tp-ep-pp": 4}
+
+    (link,) = report["inter_mesh"]
+    # every last stage rank of mesh 0 sends its whole tensor to one first stage rank of mesh 1
+    assert link["local_tensor_shape"] == [256, 1, 1024]
+    assert link["num_links"] == 8 and link["max_fan_out"] == 1 and link["max_fan_in"] == 2
+    assert link["max_link_bytes"] == 256 * 1 * 1024 * 2
+    assert link["total_bytes_per_microbatch"] == 8 * 256 * 1024 * 2
+
+    estimated = report["estimated_layer_split"]
+    assert sum(estimated["layer_split"]) == 12
+    assert estimated["layer_split"][0] > estimated["layer_split"][1]
+    assert estimated["bottleneck_ms"] <= report["layer_split"]["bottleneck_ms"]
@@ -0,0 +1,58 @@
+import os
+import socket
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.multiprocessing as mp
+
+from flagscale.train.hetero.parallel_context import RankMapper
+
+DEVICE_TYPES = ["A800", "BI150"]
+# the device type of every physical rank
+RANK_DEVICE_TYPES = ["BI150", "A800", "BI150", "A800"]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _build_rank_mapper(rank, world_size, port):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    torch.distributed.init_process_group("gloo", rank=rank, world_size=world_size)
+    args = SimpleNamespace(
+        hetero_device_types=DEVICE_TYPES, hetero_current_device_type=RANK_DEVICE_TYPES[rank]
+    )
+    rank_mapper = RankMapper(args)
+    assert rank_mapper.to_physical_ranks([0, 1, 2, 3]) == [1, 3, 0, 2]
+    assert rank_mapper.to_logical_ranks([0, 1, 2, 3]) == [2, 0, 3, 1]
+    # the mapping is only gathered once
+    def _no_gather(*args, **kwargs):
+        raise AssertionError("the rank mapping should not be gathered again")
+
+    torch.distributed.all_gather_into_tensor = _no_gather
+    assert RankMapper(args).to_physical_ranks([0, 1, 2, 3]) == [1, 3, 0, 2]
+    torch.distributed.destroy_process_group()
+
+
+def test_rank_mapper_gloo():
+    world_size = len(RANK_DEVICE_TYPES)
+    mp.spawn(_build_rank_mapper, args=(world_size, _free_port()), nprocs=world_size, join=True)
+
+
+def test_rank_mapper_from_rank_infos():
+    args = SimpleNamespace(hetero_device_types=DEVICE_TYPES, hetero_current_device_type=None)
+    rank_infos = [
+        {"rank": rank, "device_type": device_type}
+        for rank, device_type in enumerate(RANK_DEVICE_TYPES)
+    ]
+    rank_mapper = RankMapper(args, rank_infos=rank_infos)
+    assert rank_mapper.to_physical_ranks([0, 1, 2, 3]) == [1, 3, 0, 2]
+
+    rank_infos[0]["device_type"] = "H100"
+    with pytest.raises(ValueError):
+        RankMapper(args, rank_infos=rank_infos)
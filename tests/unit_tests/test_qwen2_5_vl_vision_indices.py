@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from torch import nn
+from torch.nn import functional as F
+
+from flagscale.train.models.qwen2_5_vl.vit_model import Qwen2_5VisionModel
+
+NUM_LAYERS = 8
+FULLATT_BLOCK_INDEXES = [3, 7]
+
+
+def _vision_model():
+    # only the attributes the index builders read, the transformer layers are not needed
+    model = Qwen2_5VisionModel.__new__(Qwen2_5VisionModel)
+    nn.Module.__init__(model)
+    model.spatial_merge_size = 2
+    model.spatial_merge_unit = 4
+    model.patch_size = 14
+    model.window_size = 112
+    model.fullatt_block_indexes = FULLATT_BLOCK_INDEXES
+    model.decoder = SimpleNamespace(layers=[None] * NUM_LAYERS)
+    model.index_cache_size = 32
+    model._index_cache = OrderedDict()
+    model._grid_index_cache = OrderedDict()
+    return model
+
+
+def _reference_cu_window_seqlens(model, grid_thw):
+    """cu_window_seqlens as built by get_window_index before the vision indices were cached"""
+    cu_window_seqlens = [0]
+    vit_merger_window_size = model.window_size // model.spatial_merge_size // model.patch_size
+    for grid_t, grid_h, grid_w in grid_thw.tolist():
+        llm_grid_h = grid_h // model.spatial_merge_size
+        llm_grid_w = grid_w // model.spatial_merge_size
+        index = torch.arange(grid_t * llm_grid_h * llm_grid_w).reshape(
+            grid_t, llm_grid_h, llm_grid_w
+        )
+        pad_h = vit_merger_window_size - llm_grid_h % vit_merger_window_size
+        pad_w = vit_merger_window_size - llm_grid_w % vit_merger_window_size
+        num_windows_h = (llm_grid_h + pad_h) // vit_merger_window_size
+        num_windows_w = (llm_grid_w + pad_w) // vit_merger_window_size
+        index_padded = F.pad(index, (0, pad_w, 0, pad_h), "constant", -100)
+        index_padded = index_padded.reshape(
+            grid_t, num_windows_h, vit_merger_window_size, num_windows_w, vit_merger_window_size
+        )
+        index_padded = index_padded.permute(0, 1, 3, 2, 4).reshape(
+            grid_t, num_windows_h * num_windows_w, vit_merger_window_size, vit_merger_window_size
+        )
+        seqlens = (index_padded != -100).sum([2, 3]).reshape(-1)
+        cu_seqlens_tmp = seqlens.cumsum(0) * model.spatial_merge_unit + cu_window_seqlens[-1]
+        cu_window_seqlens.extend(cu_seqlens_tmp.tolist())
+    return torch.unique_consecutive(torch.tensor(cu_window_seqlens, dtype=torch.int32))
+
+
+@pytest.mark.parametrize(
+    "grids",
+    [
+        [(1, 4, 6)],
+        [(2, 8, 8), (1, 16, 12)],
+        [(1, 4, 6), (3, 10, 18), (1, 16, 16), (2, 6, 4)],
+    ],
+)
+def test_vision_indices_packed_seq_params(grids):
+    model = _vision_model()
+    grid_thw = torch.tensor(grids)
+    vision_indices = model.get_vision_indices(grid_thw)
+
+    # full attention: each frame is a sequence
+    full = vision_indices.packed_seq_params_full
+    seqlens = torch.repeat_interleave(grid_thw[:, 1] * grid_thw[:, 2], grid_thw[:, 0])
+    cu_seqlens = F.pad(seqlens.cumsum(dim=0), (1, 0), value=0).int()
+    assert full.qkv_format == "thd"
+    assert torch.equal(full.cu_seqlens_q, cu_seqlens)
+    assert torch.equal(full.cu_seqlens_kv, cu_seqlens)
+    assert full.max_seqlen_q == full.max_seqlen_kv == seqlens.max().item()
+    assert isinstance(full.max_seqlen_q, int)
+
+    # window attention
+    window = vision_indices.packed_seq_params
+    cu_window_seqlens = _reference_cu_window_seqlens(model, grid_thw)
+    assert window.qkv_format == "thd"
+    assert torch.equal(window.cu_seqlens_q, cu_window_seqlens)
+    assert torch.equal(window.cu_seqlens_kv, cu_window_seqlens)
+    max_window_seqlen = (cu_window_seqlens[1:] - cu_window_seqlens[:-1]).max().item()
+    assert window.max_seqlen_q == window.max_seqlen_kv == max_window_seqlen
+    assert isinstance(window.max_seqlen_q, int)
+
+    # the full attention params go exactly to the fullatt_block_indexes layers
+    assert len(vision_indices.layer_packed_seq_params) == NUM_LAYERS
+    for index, packed_seq_params in enumerate(vision_indices.layer_packed_seq_params):
+        if index in FULLATT_BLOCK_INDEXES:
+            assert packed_seq_params is full
+        else:
+            assert packed_seq_params is window
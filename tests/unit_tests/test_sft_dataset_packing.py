@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+
+import numpy
+import torch
+
+from flagscale.train import train_gpt
+from flagscale.train.datasets.sft_dataset import _build_packing_plan, get_packed_seq_params
+
+
+def test_build_packing_plan_best_fit_decreasing():
+    order, offsets = _build_packing_plan(numpy.array([3, 5, 2, 4, 1]), 6)
+
+    bins = [order[offsets[i] : offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
+    assert bins == [[1, 4], [3, 2], [0]]
+
+
+def test_build_packing_plan_respects_capacity():
+    lengths = numpy.random.RandomState(1234).randint(1, 129, size=1000)
+    order, offsets = _build_packing_plan(lengths, 128)
+
+    assert sorted(order.tolist()) == list(range(len(lengths)))
+    assert offsets[0] == 0 and offsets[-1] == len(lengths)
+    for i in range(len(offsets) - 1):
+        assert lengths[order[offsets[i] : offsets[i + 1]]].sum() <= 128
+    # Best fit decreasing stays close to the lower bound on the number of bins
+    assert len(offsets) - 1 <= 1.1 * lengths.sum() / 128 + 1
+
+
+def test_build_packing_plan_empty():
+    order, offsets = _build_packing_plan(numpy.array([], dtype=numpy.int64), 16)
+
+    assert len(order) == 0
+    assert offsets.tolist() == [0]
+
+
+def test_get_packed_seq_params_trims_padding():
+    # Two documents, an empty one and a padding tail, padded to sequence_length + 1
+    cu_seqlens = torch.tensor([[0, 3, 5, 5, 7, 8, 8, 8, 8]], dtype=torch.int32)
+    packed_seq_params = get_packed_seq_params(cu_seqlens)
+
+    assert packed_seq_params.qkv_format == "thd"
+    assert packed_seq_params.cu_seqlens_q.tolist() == [0, 3, 5, 7, 8]
+    assert packed_seq_params.cu_seqlens_kv.tolist() == [0, 3, 5, 7, 8]
+    assert packed_seq_params.max_seqlen_q == packed_seq_params.max_seqlen_kv == 3
+
+
+def test_forward_step_passes_packed_boundaries(monkeypatch):
+    sequence_length = 8
+    sample = {
+        "tokens": torch.arange(sequence_length).unsqueeze(0),
+        "labels": torch.arange(1, sequence_length + 1).unsqueeze(0),
+        "loss_mask": torch.ones(1, sequence_length),
+        "position_ids": torch.tensor([[0, 1, 2, 0, 1, 0, 1, 2]]),
+        "cu_seqlens": torch.tensor([[0, 3, 5, 8, 8, 8, 8, 8, 8]], dtype=torch.int32),
+    }
+
+    def get_batch_on_this_tp_rank(data_iterator):
+        data = next(data_iterator)
+        keys = ["tokens", "labels", "loss_mask", "attention_mask", "position_ids"]
+        return {key: data.get(key) for key in keys}
+
+    args = SimpleNamespace(
+        sft_sequence_packing=True,
+        use_legacy_models=False,
+        context_parallel_size=1,
+        pipeline_model_parallel_size=1,
+    )
+    timer = SimpleNamespace(start=lambda: None, stop=lambda: None)
+    monkeypatch.setattr(train_gpt, "get_args", lambda: args)
+    monkeypatch.setattr(train_gpt, "get_timers", lambda: lambda *a, **k: timer)
+    monkeypatch.setattr(train_gpt, "has_nvidia_modelopt", False)
+    monkeypatch.setattr(train_gpt.parallel_state, "is_pipeline_first_stage", lambda **k: True)
+    monkeypatch.setattr(train_gpt.parallel_state, "is_pipeline_last_stage", lambda **k: True)
+    monkeypatch.setattr(train_gpt.parallel_state, "get_tensor_model_parallel_rank", lambda: 0)
+    monkeypatch.setattr(train_gpt.parallel_state, "get_tensor_model_parallel_world_size", lambda: 2)
+    monkeypatch.setattr(train_gpt, "get_batch_on_this_tp_rank", get_batch_on_this_tp_rank)
+    monkeypatch.setattr(train_gpt, "get_batch_on_this_cp_rank", lambda batch: batch)
+    monkeypatch.setattr(
+        train_gpt.tensor_parallel,
+        "broadcast_data",
+        lambda keys, data, datatype: {key: data[key] for key in keys},
+    )
+
+    calls = []
+
+    def model(tokens, position_ids, attention_mask, **kwargs):
+        calls.append(kwargs)
+        return torch.zeros(1, sequence_length)
+
+    data_iterator = iter([sample])
+    train_gpt.forward_step(data_iterator, model)
+
+    assert len(calls) == 1
+    packed_seq_params = calls[0]["packed_seq_params"]
+    assert packed_seq_params.qkv_format == "thd"
+    assert packed_seq_params.cu_seqlens_q.tolist() == [0, 3, 5, 8]
+    assert packed_seq_params.max_seqlen_q == 3
+    # The sample was read once and forwarded to get_batch_on_this_tp_rank
+    assert next(data_iterator, None) is None
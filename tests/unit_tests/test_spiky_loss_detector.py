@@ -1,5 +1,7 @@
 import torch
 
+from megatron.core.optimizer import OptimizerConfig
+from megatron.core.optimizer.optimizer import ChainedOptimizer, FP32Optimizer
 from tests.unit_tests.test_utilities import Utils
 
 from flagscale.train.spiky_loss import SpikyLossDetector
@@ -35,3 +37,79 @@ def test_spiky_loss_detector(pp_size=2, threshold=0.2):
     assert is_spiky_loss == 1, f"Expected 1, got {is_spiky_loss}"
 
     Utils.destroy_model_parallel()
+
+
+def test_spiky_loss_detector_statistics():
+    detector = SpikyLossDetector(threshold=0.05, zscore=4.0, min_samples=10)
+
+    # noisy but stationary losses are never spiky
+    losses = 2.0 + 0.02 * torch.randn(100, generator=torch.Generator().manual_seed(1234))
+    assert not any(detector.detect(loss).item() for loss in losses)
+    mean, var = detector.mean.clone(), detector.var.clone()
+
+    # a jump far above the moving statistics is spiky and does not update them
+    assert detector.detect(torch.tensor(3.0)).item()
+    assert torch.equal(detector.mean, mean) and torch.equal(detector.var, var)
+
+    # inf is always spiky, nan never is, neither updates the statistics
+    assert detector.detect(torch.tensor(float("inf"))).item()
+    assert not detector.detect(torch.tensor(float("nan"))).item()
+    assert torch.equal(detector.mean, mean) and torch.equal(detector.var, var)
+
+    # a relative jump within the noise is not spiky once the statistics are warmed up
+    noisy = SpikyLossDetector(threshold=0.05, zscore=4.0, min_samples=10)
+    for loss in 2.0 + 0.5 * torch.randn(100, generator=torch.Generator().manual_seed(1234)):
+        noisy.detect(loss)
+    assert not noisy.detect(noisy.mean * 1.1).item()
+
+
+def test_spiky_loss_skips_optimizer_step(monkeypatch):
+    Utils.initialize_model_parallel(tensor_model_parallel_size=1, pipeline_model_parallel_size=1)
+
+    model = torch.nn.Linear(4, 4, device="cuda")
+    config = OptimizerConfig(optimizer="sgd", lr=0.1, clip_grad=1.0)
+    optimizer = ChainedOptimizer(
+        [FP32Optimizer(torch.optim.SGD(model.parameters(), lr=0.1), config, lambda x: None)]
+    )
+    detector = SpikyLossDetector(threshold=0.2, loss=10.0)
+
+    all_reduce = torch.distributed.all_reduce
+    num_all_reduce = 0
+
+    def counting_all_reduce(*args, **kwargs):
+        nonlocal num_all_reduce
+        num_all_reduce += 1
+        return all_reduce(*args, **kwargs)
+
+    monkeypatch.setattr(torch.distributed, "all_reduce", counting_all_reduce)
+
+    def step(loss=None):
+        nonlocal num_all_reduce
+        for param in model.parameters():
+            param.grad = torch.ones_like(param)
+        if loss is not None:
+            optimizer.skip_step_if(detector.skip_flag(torch.tensor(loss, device="cuda")))
+        num_all_reduce = 0
+        weight = model.weight.detach().clone()
+        update_successful, grad_norm, _ = optimizer.step()
+        return update_successful, grad_norm, not torch.equal(weight, model.weight), num_all_reduce
+
+    # without a flag
+    update_successful, grad_norm, updated, baseline_all_reduce = step()
+    assert update_successful and grad_norm is not None and updated
+
+    # the flag is reduced with the grad norm, without any extra collective
+    update_successful, grad_norm, updated, num_all_reduce = step(10.3)
+    assert update_successful and grad_norm is not None and updated
+    assert num_all_reduce == baseline_all_reduce
+
+    # a spiky loss skips the update like inf/nan grads
+    update_successful, grad_norm, updated, num_all_reduce = step(14.3)
+    assert not update_successful and grad_norm is None and not updated
+    assert num_all_reduce == baseline_all_reduce
+
+    # the flag only applies to the next step
+    update_successful, _, updated, _ = step()
+    assert update_successful and updated
+
+    Utils.destroy_model_parallel()
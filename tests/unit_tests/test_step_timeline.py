@@ -0,0 +1,93 @@
+import time
+
+import pytest
+import torch
+
+from flagscale.train.step_timeline import PHASES, StepTimeline, pipeline_bubble_fraction
+
+
+def test_pipeline_bubble_fraction():
+    assert pipeline_bubble_fraction(1, 8) == 0.0
+    assert pipeline_bubble_fraction(4, 8) == pytest.approx(3 / 11)
+    assert pipeline_bubble_fraction(4, 8, virtual_pipeline_size=2) == pytest.approx(3 / 19)
+
+
+def _row(pipeline_rank, num_steps, data_wait, compute, flops=8e12):
+    # 10 ms of pipeline bubble, 20 ms of grads sync, 30 ms of optimizer and 0 ms of other
+    phase_ms = [data_wait, compute, 10.0, 20.0, 30.0, 0.0]
+    step_ms = sum(phase_ms)
+    return [pipeline_rank, num_steps, num_steps * step_ms, num_steps * flops] + [
+        num_steps * ms for ms in phase_ms
+    ]
+
+
+def test_summarize():
+    timeline = StepTimeline(interval=10, peak_tflops=100.0, straggler_threshold=1.2)
+    rows = [
+        _row(0, 10, 0.0, 40.0),
+        _row(0, 10, 0.0, 40.0),
+        # slow data loader
+        _row(0, 10, 20.0, 40.0),
+        # the last stage holds more layers than the first one
+        _row(1, 10, 0.0, 60.0),
+        _row(1, 10, 0.0, 60.0),
+        # no step completed yet
+        _row(1, 0, 0.0, 0.0),
+    ]
+    report = timeline.summarize(100, rows)
+
+    assert report["steps"] == 10
+    assert sum(report["phases_ms"].values()) == pytest.approx(report["step_ms"])
+    assert report["phases_ms"]["data-wait"] == pytest.approx(4.0)
+    # 8 TFLOP per step shared by the 6 ranks
+    assert report["tflops"] == pytest.approx(8 / (report["step_ms"] / 1000) / 6)
+    # the MFU lost to every phase adds up to the MFU of the compute alone
+    compute_mfu = report["compute_tflops"] / 100.0
+    assert report["mfu"] + sum(report["lost_mfu"].values()) == pytest.approx(compute_mfu)
+
+    (straggler,) = report["stragglers"]
+    assert straggler["rank"] == 2 and straggler["ratio"] == pytest.approx(1.5)
+
+    assert StepTimeline(interval=10).summarize(100, [_row(0, 0, 0.0, 0.0)]) is None
+
+
+def test_step_timeline_host_clock(tmp_path):
+    torch.distributed.init_process_group(
+        "gloo", init_method=f"file://{tmp_path / 'store'}", rank=0, world_size=1
+    )
+    try:
+        path = tmp_path / "timeline.jsonl"
+        timeline = StepTimeline(interval=2, path=str(path), use_cuda=False)
+
+        def _slow(seconds):
+            time.sleep(seconds)
+            return seconds
+
+        data = timeline.time_data(_slow(0.02) for _ in range(2))
+        forward_backward = timeline.wrap("forward-backward", lambda: [next(data), _slow(0.01)])
+        optimizer_step = timeline.wrap("optimizer", lambda: _slow(0.01))
+        for _ in range(2):
+            timeline.start_step()
+            forward_backward()
+            optimizer_step()
+            timeline.end_step(1e9, bubble_fraction=0.5)
+        # not timed outside of a step
+        optimizer_step()
+
+        report = timeline.report(2)
+        phases_ms = report["phases_ms"]
+        assert report["steps"] == 2
+        assert set(phases_ms) == set(PHASES)
+        assert sum(phases_ms.values()) == pytest.approx(report["step_ms"])
+        assert phases_ms["data-wait"] >= 20.0
+        assert phases_ms["optimizer"] >= 10.0
+        assert phases_ms["compute"] == pytest.approx(phases_ms["pipeline-bubble"])
+        assert phases_ms["grads-sync"] == 0.0
+
+        timeline.write(report)
+        assert path.read_text().count("\n") == 1
+        assert "data-wait" in StepTimeline.format_report(report)
+        # the window restarts after every report
+        assert timeline.report(4) is None
+    finally:
+        torch.distributed.destroy_process_group()
@@ -1,8 +1,10 @@
 # Copied from https://github.com/alibaba/Pai-Megatron-Patch/blob/8949a6647cbf6b39837ad3dd911fa4aa0726895b/toolkits/multimodal_data_preprocessing/build_llava_frame_dataset.py
 import glob
+import hashlib
 import json
 import multiprocessing.pool as mpp
 import os
+import shutil
 import tarfile
 
 from argparse import ArgumentParser
@@ -34,57 +36,153 @@ def istarmap(self, func, iterable, chunksize=1):
 mpp.Pool.istarmap = istarmap
 
 
-def find_json_files(dataset_root):
+def find_json_files(dataset_root, exclude=()):
     root_path = Path(dataset_root).resolve()
     json_files = list(root_path.rglob("*.json"))
     jsonl_files = list(root_path.rglob("*.jsonl"))
 
     all_files = json_files + jsonl_files
     relative_paths = [p.relative_to(root_path) for p in all_files]
-    return [str(p) for p in relative_paths]
-
-
-def extract_video_frames(dataset_root: str, video_paths: list, time_interval: float = 1.0):
-    for rel_path in video_paths:
-        input_path = os.path.join(dataset_root, rel_path)
-        output_subdir, _ = os.path.splitext(input_path)
-        os.makedirs(output_subdir, exist_ok=True)
-
-        cap = cv2.VideoCapture(input_path)
-        if not cap.isOpened():
-            print(f"Video not opened: {input_path}")
-            continue
-
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-        interval_frames = max(1, int(fps * time_interval))
-        current_frame = 0
+    # skip the hidden folders (e.g. the frame cache) and the outputs of a previous run
+    return [
+        str(p)
+        for p in relative_paths
+        if not any(part.startswith(".") for part in p.parts) and str(p) not in exclude
+    ]
+
+
+def frame_cache_key(input_path: str, time_interval: float, chunk_size: int = 1 << 23):
+    """The cache key of the frames of a video: a hash of its content and the time interval"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(input_path, "rb") as f:
         while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return f"{digest.hexdigest()}-{time_interval:g}"
+
+
+def probe_video(dataset_root: str, rel_path: str, time_interval: float = 1.0):
+    """
+    Return the cache key of a video, or None if its frames were already extracted from the
+    same file by a previous run.
+    """
+    input_path = os.path.join(dataset_root, rel_path)
+    output_subdir, _ = os.path.splitext(input_path)
+    if not os.path.exists(input_path):
+        print(f"Video not found: {input_path}")
+        return rel_path, None
+
+    stat = os.stat(input_path)
+    if os.path.isdir(output_subdir) and os.path.exists(output_subdir + ".json"):
+        with open(output_subdir + ".json", "r") as f:
+            meta = json.load(f)
+        source = meta.get("source", {})
+        if (
+            source.get("size") == stat.st_size
+            and source.get("mtime") == stat.st_mtime
+            and source.get("time_interval") == time_interval
+        ):
+            return rel_path, None
+    return rel_path, frame_cache_key(input_path, time_interval)
+
+
+def decode_video_frames(input_path: str, frame_dir: str, time_interval: float = 1.0):
+    """Decode the frames of a video every time_interval seconds into frame_dir, return the fps"""
+    cap = cv2.VideoCapture(input_path)
+    if not cap.isOpened():
+        print(f"Video not opened: {input_path}")
+        return None
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    interval_frames = max(1, int(fps * time_interval))
+    current_frame = 0
+    while True:
+        # only decode the frames that are kept
+        if current_frame % interval_frames == 0:
             ret, frame = cap.read()
             if not ret:
                 break
-
-            if current_frame % interval_frames == 0:
-                filename = f"frame_{current_frame:06}.jpg"
-                save_path = os.path.join(output_subdir, filename)
-                cv2.imwrite(save_path, frame)
-
-            current_frame += 1
-
+            filename = f"frame_{current_frame:06}.jpg"
+            cv2.imwrite(os.path.join(frame_dir, filename), frame)
+        elif not cap.grab():
+            break
+        current_frame += 1
+    cap.release()
+    return fps / interval_frames
+
+
+def extract_video_frames(
+    dataset_root: str, cache_dir: str, key: str, video_paths: list, time_interval: float = 1.0
+):
+    """
+    Decode a video once into the frame cache and link its frames next to every video file
+    sharing its content.
+    """
+    cache_subdir = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(cache_subdir, "meta.json")):
+        tmp_subdir = f"{cache_subdir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_subdir, ignore_errors=True)
+        os.makedirs(tmp_subdir)
+        fps = decode_video_frames(
+            os.path.join(dataset_root, video_paths[0]), tmp_subdir, time_interval
+        )
+        if fps is None:
+            shutil.rmtree(tmp_subdir, ignore_errors=True)
+            return
+        with open(os.path.join(tmp_subdir, "meta.json"), "w") as f:
+            json.dump({"fps": str(fps)}, f)
+        shutil.rmtree(cache_subdir, ignore_errors=True)
+        os.rename(tmp_subdir, cache_subdir)
+
+    with open(os.path.join(cache_subdir, "meta.json"), "r") as f:
+        fps = json.load(f)["fps"]
+    frames = sorted(f for f in os.listdir(cache_subdir) if f.endswith(".jpg"))
+    for rel_path in video_paths:
+        input_path = os.path.join(dataset_root, rel_path)
+        output_subdir, _ = os.path.splitext(input_path)
+        os.makedirs(output_subdir, exist_ok=True)
+        # remove the frames of a previous extraction
+        for name in glob.glob(os.path.join(output_subdir, "frame_*.jpg")):
+            os.remove(name)
+        for frame in frames:
+            src, dst = os.path.join(cache_subdir, frame), os.path.join(output_subdir, frame)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+
+        stat = os.stat(input_path)
+        source = {"size": stat.st_size, "mtime": stat.st_mtime, "time_interval": time_interval}
         with open(output_subdir + ".json", "w") as f:
-            json.dump({"fps": str(fps / interval_frames)}, f)
-
-
-def process(dataset_root, output_file, interval=1.0, num_workers: int = 32, video_token="<image>"):
-    json_or_jsonl = glob.glob(os.path.join(dataset_root, "*.json")) + glob.glob(
-        os.path.join(dataset_root, "*.jsonl")
-    )
+            json.dump({"fps": fps, "source": source}, f)
+
+
+def process(
+    dataset_root,
+    output_file,
+    interval=1.0,
+    num_workers: int = 32,
+    video_token="<image>",
+    cache_dir=None,
+):
+    """
+    Merge the annotations of dataset_root and extract the frames of every video.
+
+    Every video file is decoded at most once, by at most num_workers processes, whatever the
+    number of samples referencing it. Frames are cached in cache_dir by content hash, so a
+    rerun skips the videos already extracted and identical video files are decoded once.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(dataset_root, ".frame_cache")
+    os.makedirs(cache_dir, exist_ok=True)
 
     full_data = []
 
-    args_list = []
-    for file in find_json_files(dataset_root):
+    # the unique videos referenced by the samples, in order
+    video_paths = {}
+    for file in find_json_files(dataset_root, exclude=(output_file,)):
         rel_to_dir, _ = os.path.split(file)
         file = os.path.join(dataset_root, file)
         try:
@@ -94,6 +192,9 @@ def process(dataset_root, output_file, interval=1.0, num_workers: int = 32, vide
             with open(file, "r") as f:
                 data = [json.loads(l) for l in f.readlines()]
 
+        if isinstance(data, dict):
+            # the fps of the frames extracted from a video
+            continue
         print(f"processing {file}")
         for d in tqdm(data):
             if isinstance(d, list):
@@ -104,16 +205,31 @@ def process(dataset_root, output_file, interval=1.0, num_workers: int = 32, vide
             if "video" in d:
                 d["videos"] = [os.path.join(rel_to_dir, d.pop("video"))]
                 for v in d["videos"]:
-                    args_list.append((dataset_root, [v], interval))
+                    video_paths[v] = None
 
             for c in d["conversations"]:
                 c["value"] = c["value"].replace(video_token, "<video>")
             full_data.append(d)
 
-    pool = Pool(32)
-    it = pool.istarmap(extract_video_frames, args_list)
-    for _ in tqdm(it, total=len(args_list)):
-        pass
+    with Pool(num_workers) as pool:
+        # group the videos to extract by content
+        videos_by_key = {}
+        args_list = [(dataset_root, v, interval) for v in video_paths]
+        it = pool.istarmap(probe_video, args_list)
+        for rel_path, key in tqdm(it, total=len(args_list), desc="hashing videos"):
+            if key is not None:
+                videos_by_key.setdefault(key, []).append(rel_path)
+        print(
+            f"{len(video_paths)} videos referenced, {len(video_paths) - sum(map(len, videos_by_key.values()))} "
+            f"up to date, {len(videos_by_key)} unique videos to extract"
+        )
+
+        args_list = [
+            (dataset_root, cache_dir, key, paths, interval) for key, paths in videos_by_key.items()
+        ]
+        it = pool.istarmap(extract_video_frames, args_list)
+        for _ in tqdm(it, total=len(args_list), desc="extracting frames"):
+            pass
 
     with open(os.path.join(dataset_root, output_file), "w") as f:
         json.dump(full_data, f)
@@ -151,6 +267,15 @@ if __name__ == "__main__":
         help="Filename of the merged json dataset",
     )
     argparser.add_argument("--skip-extraction", action="store_true")
+    argparser.add_argument(
+        "--num-workers", type=int, default=32, help="The number of videos decoded concurrently"
+    )
+    argparser.add_argument(
+        "--frame-cache-dir",
+        type=str,
+        default=None,
+        help="The cache of extracted frames keyed by video content, <dataset-root>/.frame_cache by default",
+    )
     argparser.add_argument(
         "--video-token",
         type=str,
@@ -168,5 +293,7 @@ if __name__ == "__main__":
         args.dataset_root,
         args.output_json,
         interval=args.time_interval,
+        num_workers=args.num_workers,
         video_token=args.video_token,
+        cache_dir=args.frame_cache_dir,
     )
@@ -1,8 +1,10 @@
 # Adopted from https://github.com/alibaba/Pai-Megatron-Patch/blob/8949a6647cbf6b39837ad3dd911fa4aa0726895b/toolkits/multimodal_data_preprocessing/convert_custom_dataset_to_wds_chatml.py
 # We must store the path of vision data, not the real data.
 
+import codecs
 import json
 import math
+import multiprocessing
 import os
 import pickle
 
@@ -10,6 +12,7 @@ from argparse import ArgumentParser
 from typing import List, Union
 
 import cv2
+import numpy as np
 import webdataset as wds
 import yaml
 
@@ -20,6 +23,166 @@ from megatron.energon.epathlib import EPath
 from megatron.energon.flavors import BaseWebdatasetFactory
 
 
+INDEX_NAME = ".convert-index.npy"
+PROGRESS_NAME = ".convert-progress.json"
+
+
+def register_handlers():
+    # custom webdataset ShardWriter Encoder
+    # "jpgs": the key when saving the image, see write_shard
+    # "videos": the key when saving the video, see write_shard
+    add_handlers(default_handlers, 'jpgs', lambda data: pickle.dumps(data))
+    add_handlers(default_handlers, 'videos', lambda data: pickle.dumps(data))
+
+
+def iter_entry_offsets(json_file, chunk_size=1 << 24):
+    """
+    Stream a json (a list of entries) or jsonl annotation file and yield the
+    (start, end) byte offsets and the parsed value of every entry, in constant memory.
+    """
+    with open(json_file, "rb") as f:
+        head = f.read(chunk_size)
+        stripped = head.lstrip()
+        if not stripped.startswith(b"["):
+            # jsonl
+            f.seek(0)
+            offset = 0
+            for line in f:
+                if line.strip():
+                    yield offset, offset + len(line), json.loads(line)
+                offset += len(line)
+            return
+
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buffer = utf8.decode(head[len(head) - len(stripped) + 1 :])
+        # buffer[base] is at the byte offset base_offset of the file
+        base, base_offset = 0, len(head) - len(stripped) + 1
+        eof = False
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                if pos == len(buffer):
+                    raise json.JSONDecodeError("Need more data", buffer, pos)
+                entry, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                # drop the consumed prefix, keeping the byte offsets in sync
+                base_offset += len(buffer[base:pos].encode("utf-8"))
+                buffer = buffer[pos:] + utf8.decode(chunk, final=eof)
+                base = pos = 0
+                continue
+            start_offset = base_offset + len(buffer[base:pos].encode("utf-8"))
+            end_offset = start_offset + len(buffer[pos:end].encode("utf-8"))
+            yield start_offset, end_offset, entry
+            base, base_offset = end, end_offset
+            pos = end
+
+
+def output_order(num_entries, dp_size, drop_last, start, stop):
+    """
+    The data ids written at output positions [start, stop). Samples are interleaved so that
+    rank r of dp_size gets the data ids r, r + dp_size, ... (see the sequential loop it replaces).
+    """
+    positions = np.arange(start, stop, dtype=np.int64)
+    if drop_last:
+        num_per_rank = num_entries // dp_size
+        ranks, ids = np.divmod(positions, max(num_per_rank, 1))
+        # the left data is appended in order
+        return np.where(positions < num_per_rank * dp_size, ids * dp_size + ranks, positions)
+    counts = (num_entries - np.arange(dp_size) + dp_size - 1) // dp_size
+    starts = np.cumsum(counts) - counts
+    ranks = np.searchsorted(starts, positions, side="right") - 1
+    return (positions - starts[ranks]) * dp_size + ranks
+
+
+def build_sample(entry, data_id, vision_dir, image_key, video_key, sort_function):
+    # NOTE: read a dataset in sharegpt format
+    image_datas: List[str] = []
+    # NOTE: we support both list and str for image path.
+    image_paths = entry.get(image_key, [])
+    if isinstance(image_paths, str):
+        image_paths = [image_paths]
+    image_datas = image_paths
+
+    video_datas: List[List[str]] = []
+    second_per_grid_ts = []
+
+    for video in entry.pop(video_key, []):
+        video_noext, _ = os.path.splitext(video)
+        frame_folder = os.path.join(vision_dir, video_noext)
+        # NOTE: we implicitly require a `${frame_folder}.json`` file containing fps rates of each video
+        # otherwise fps will be regarded as `1` by default.
+        if os.path.exists(frame_folder + ".json"):
+            with open(frame_folder + ".json", "r") as f:
+                fps = float(json.load(f)["fps"])
+        else:
+            fps = 2.0
+
+        frames: List[str] = []
+        for frame in sort_function(os.listdir(frame_folder)):
+            # get relative path（remove "vision_dir"）
+            relative_path = os.path.relpath(os.path.join(frame_folder, frame), start=vision_dir)
+            frames.append(relative_path)
+
+        if len(frames) % 2 == 1:
+            frames = frames[:-1]
+        video_datas.append(frames)
+        second_per_grid_ts.append(1 / fps)
+
+    return {
+        "__key__": entry.pop("id", str(data_id)),
+        "jpgs": image_datas,
+        "videos": video_datas,
+        "json": json.dumps(
+            {"conversations": entry["conversations"], "second_per_grid_ts": second_per_grid_ts}
+        ).encode("utf-8"),
+    }
+
+
+def write_shard(task):
+    """
+    Write the shard `shard_idx` covering the output positions [start, stop). The entries are
+    read by seeking to their offsets, the shard is written to a temporary file and renamed,
+    so that an existing shard is always complete.
+    """
+    shard_idx, start, stop, config = task
+    shard_path = os.path.join(config["output"], f"pretrain-{shard_idx}.tar")
+    offsets = np.load(os.path.join(config["output"], INDEX_NAME), mmap_mode="r")
+    data_ids = output_order(
+        config["num_entries"], config["dp_size"], config["drop_last"], start, stop
+    )
+
+    has_idx = None
+    with open(config["json_file"], "rb") as f, wds.TarWriter(f"{shard_path}.tmp") as writer:
+        for data_id in data_ids:
+            begin, end = offsets[data_id]
+            f.seek(begin)
+            entry = json.loads(f.read(end - begin))
+            if has_idx is None:
+                has_idx = "id" in entry
+            assert has_idx == ("id" in entry), "All entries should either all contain idx or not."
+            writer.write(
+                build_sample(
+                    entry,
+                    data_id,
+                    config["vision_dir"],
+                    config["image_key"],
+                    config["video_key"],
+                    config["sort_function"],
+                )
+            )
+    os.replace(f"{shard_path}.tmp", shard_path)
+    return shard_idx, has_idx
+
+
 def convert(
     dataset_dir,
     output_dir,
@@ -31,9 +194,17 @@ def convert(
     vision_dir=None,
     dp_size=1,
     drop_last=False,
+    num_workers=1,
+    resume=False,
 ):
     """
     Here we provide an example to convert llava-pretrain dataset to ChatMLSample
+
+    The annotation file is streamed once to index the byte offsets of its entries, then
+    shards of at most max_count samples are written in parallel by num_workers processes.
+    Shards are only split further so that every worker gets one. With resume, the shards
+    completed by an interrupted run are kept, unless the source file or the options changed.
+    Otherwise the existing shards are removed.
     """
     if vision_dir is None:
         vision_dir = dataset_dir
@@ -42,105 +213,86 @@ def convert(
     output = os.path.join(output_dir, f"wds-{dp_size}")
     os.makedirs(output, exist_ok=True)
 
-    # support both json and jsonl
-    try:
-        with open(json_file, "r") as f:
-            data = json.load(f)
-    except:
-        with open(json_file, "r") as f:
-            data = [json.loads(l) for l in f.readlines()]
-    data_len = len(data)
-    print(f"Loaded {data_len} entries")
+    stat = os.stat(json_file)
+    source = {"json_file": os.path.abspath(json_file), "size": stat.st_size, "mtime": stat.st_mtime}
+    progress_file = os.path.join(output, PROGRESS_NAME)
+    index_file = os.path.join(output, INDEX_NAME)
+    progress = None
+    if resume and os.path.exists(progress_file) and os.path.exists(index_file):
+        with open(progress_file, "r") as f:
+            progress = json.load(f)
+        if (
+            progress["source"] != source
+            or progress["dp_size"] != dp_size
+            or progress["drop_last"] != drop_last
+        ):
+            print(f"Warning: {json_file} or the conversion options changed, restart the conversion")
+            progress = None
 
-    print(f"The fisrt entry in the dataset is {data[0]}")
-    if image_key not in data[0]:
-        print(f"Warning: {image_key} not found in the first entry")
-    if video_key not in data[0]:
-        print(f"Warning: {video_key} not found in the first entry")
+    if progress is None:
+        # the shards of a previous conversion must neither be reused nor mixed with the new ones
+        for name in os.listdir(output):
+            if name.startswith("pretrain-") and (name.endswith(".tar") or name.endswith(".tar.tmp")):
+                os.remove(os.path.join(output, name))
 
-    # custom webdataset ShardWriter Encoder
-    # "jpgs": the key when saving the image, see line 93
-    # "videos": the key when saving the video, see line 92
-    add_handlers(default_handlers, 'jpgs', lambda data: pickle.dumps(data))
-    add_handlers(default_handlers, 'videos', lambda data: pickle.dumps(data))
+        # support both json and jsonl
+        data_len = 0
+        with open(f"{index_file}.tmp", "wb") as index:
+            for data_len, (start, end, entry) in enumerate(iter_entry_offsets(json_file), 1):
+                if data_len == 1:
+                    print(f"The fisrt entry in the dataset is {entry}")
+                    if image_key not in entry:
+                        print(f"Warning: {image_key} not found in the first entry")
+                    if video_key not in entry:
+                        print(f"Warning: {video_key} not found in the first entry")
+                index.write(np.array([start, end], dtype=np.int64).tobytes())
+        offsets = np.fromfile(f"{index_file}.tmp", dtype=np.int64).reshape(-1, 2)
+        np.save(index_file, offsets)
+        del offsets
+        os.remove(f"{index_file}.tmp")
 
-    def write_sample(entry, vision_dir, has_idx=None, idx=0):
-        # NOTE: read a dataset in sharegpt format
-        image_datas: List[str] = []
-        # NOTE: we support both list and str for image path.
-        image_paths = entry.get(image_key, [])
-        if isinstance(image_paths, str):
-            image_paths = [image_paths]
-        image_datas = image_paths
-
-        video_datas: List[List[str]] = []
-        second_per_grid_ts = []
-
-        for video in entry.pop(video_key, []):
-            video_noext, _ = os.path.splitext(video)
-            frame_folder = os.path.join(vision_dir, video_noext)
-            # NOTE: we implicitly require a `${frame_folder}.json`` file containing fps rates of each video
-            # otherwise fps will be regarded as `1` by default.
-            if os.path.exists(frame_folder + ".json"):
-                with open(frame_folder + ".json", "r") as f:
-                    fps = float(json.load(f)["fps"])
-            else:
-                fps = 2.0
-
-            frames: List[str] = []
-            for frame in sort_function(os.listdir(frame_folder)):
-                # get relative path（remove "vision_dir"）
-                relative_path = os.path.relpath(os.path.join(frame_folder, frame), start=vision_dir)
-                frames.appen(relative_path)
-
-            if len(frames) % 2 == 1:
-                frames = frames[:-1]
-            video_datas.append(frames)
-            second_per_grid_ts.append(1 / fps)
-
-        if has_idx is None:
-            has_idx = "id" in entry
-        assert has_idx == ("id" in entry), "All entries should either all contain idx or not."
-
-        sample = {
-            "__key__": entry.pop("id", str(idx)),
-            "jpgs": image_datas,
-            "videos": video_datas,
-            "json": json.dumps(
-                {"conversations": entry["conversations"], "second_per_grid_ts": second_per_grid_ts}
-            ).encode("utf-8"),
+        progress = {
+            "source": source,
+            "dp_size": dp_size,
+            "drop_last": drop_last,
+            "num_entries": data_len,
+            "samples_per_shard": max(1, min(int(max_count), math.ceil(data_len / num_workers))),
         }
-        shard_writer.write(sample)
+        with open(progress_file, "w") as f:
+            json.dump(progress, f)
+    data_len = progress["num_entries"]
+    samples_per_shard = progress["samples_per_shard"]
+    print(f"Loaded {data_len} entries")
 
-    has_idx = None
-    if drop_last:
-        num_per_rank = data_len // dp_size
-        left_data_count = data_len % dp_size
-        with wds.ShardWriter(
-            os.path.join(output, "pretrain-%d.tar"), maxcount=max_count, maxsize=9e9
-        ) as shard_writer:
-            for rank in tqdm(range(dp_size)):
-                for id in tqdm(range(num_per_rank)):
-                    data_id = id * dp_size + rank
-                    entry = data[data_id]
-                    write_sample(entry, vision_dir, has_idx=has_idx, idx=data_id)
-            if left_data_count > 0:
-                for idx, entry in enumerate(data[data_len - left_data_count :]):
-                    write_sample(
-                        entry, vision_dir, has_idx=has_idx, idx=data_len - left_data_count + idx
-                    )
+    config = {
+        "output": output,
+        "json_file": json_file,
+        "num_entries": data_len,
+        "dp_size": dp_size,
+        "drop_last": drop_last,
+        "vision_dir": vision_dir,
+        "image_key": image_key,
+        "video_key": video_key,
+        "sort_function": sort_function,
+    }
+    tasks = []
+    for shard_idx, start in enumerate(range(0, data_len, samples_per_shard)):
+        if resume and os.path.exists(os.path.join(output, f"pretrain-{shard_idx}.tar")):
+            continue
+        tasks.append((shard_idx, start, min(start + samples_per_shard, data_len), config))
+    num_shards = math.ceil(data_len / samples_per_shard)
+    print(f"Writing {len(tasks)} of {num_shards} shards with {num_workers} workers")
+
+    register_handlers()
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(
+            min(num_workers, len(tasks)), initializer=register_handlers
+        ) as pool:
+            results = list(tqdm(pool.imap_unordered(write_shard, tasks), total=len(tasks)))
     else:
-        num_per_rank = math.ceil(data_len / dp_size)
-        with wds.ShardWriter(
-            os.path.join(output, "pretrain-%d.tar"), maxcount=max_count, maxsize=9e9
-        ) as shard_writer:
-            for rank in tqdm(range(dp_size)):
-                for id in tqdm(range(num_per_rank)):
-                    data_id = id * dp_size + rank
-                    if data_id >= data_len:
-                        break
-                    entry = data[data_id]
-                    write_sample(entry, vision_dir, has_idx=has_idx, idx=data_id)
+        results = [write_shard(task) for task in tqdm(tasks)]
+    has_idx = {has for _, has in results if has is not None}
+    assert len(has_idx) <= 1, "All entries should either all contain idx or not."
 
     print(f"Dataset successfully converted to wds")
     return output
@@ -191,7 +343,15 @@ if __name__ == "__main__":
     argparser.add_argument("--val-split", default=0, type=float)
     argparser.add_argument("--test-split", default=0, type=float)
     argparser.add_argument("--shuffle-tars", action="store_true")
-    argparser.add_argument("--num-workers", default=1, type=int)
+    argparser.add_argument(
+        "--num-workers",
+        default=1,
+        type=int,
+        help="The number of processes writing shards and preparing the dataset",
+    )
+    argparser.add_argument(
+        "--resume", action="store_true", help="Keep the shards written by an interrupted run"
+    )
     argparser.add_argument("--dp-size", default=1, type=int)
     argparser.add_argument("--drop-last", action="store_true")
     args = argparser.parse_args()
@@ -206,6 +366,8 @@ if __name__ == "__main__":
         vision_dir=args.vision_root,
         dp_size=args.dp_size,
         drop_last=args.drop_last,
+        num_workers=args.num_workers,
+        resume=args.resume,
     )
     print(f"Generating Configurations")
     # NOTE: split_ratio: train/val/test
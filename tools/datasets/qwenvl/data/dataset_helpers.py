@@ -62,6 +62,9 @@ class ImageTaskSample:
     text: np.ndarray
     target: np.ndarray
 
+    # (n_packed + 1, ), boundaries of the samples packed into text, None if not packed
+    cu_seqlens: Optional[np.ndarray] = None
+
 
 # Typing for the resulting batch data after encode_batch()
 @dataclass
@@ -81,6 +84,8 @@ class VQATaskBatch(Batch):
     text: torch.Tensor
     # (n, seq_len)
     target: torch.Tensor
+    # (n, max_n_packed + 2), boundaries of the packed samples and of the padding in each row
+    cu_seqlens: torch.Tensor
 
 
 class InternalWarning(Warning): ...
@@ -144,6 +149,10 @@ class TaskEncoder(
         self.vision_root = self.args.vision_root
         assert self.vision_root is not None, "Please give the vision root."
 
+        # NOTE: packing is enabled by passing packing_buffer_size to the energon loader
+        self.packing = getattr(self.args, "packing_buffer_size", None) is not None
+        self.length_bucket_size = getattr(self.args, "length_bucket_size", 0)
+
     def encode_sample(self, sample: Union[VQASample, ChatMLSample]):
         if isinstance(sample, VQASample):
             is_llava_training = (
@@ -557,6 +566,77 @@ class TaskEncoder(
             target=target,
         )
 
+    def batch_group_criterion(self, sample: ImageTaskSample) -> Tuple[Optional[int], None]:
+        """Group samples of similar token length into the same batch with --length-bucket-size,
+        otherwise every sample goes to the single default group."""
+        if self.length_bucket_size > 0:
+            return min(len(sample.text), self.seq_len) // self.length_bucket_size, None
+        return super().batch_group_criterion(sample)
+
+    def select_samples_to_pack(self, samples: List[ImageTaskSample]) -> List[List[ImageTaskSample]]:
+        """
+        Select the samples packed into each sequence with first-fit-decreasing on the token
+        length (text and vision tokens), using max_padding_length as the token budget.
+        Samples longer than the budget are kept alone and truncated in batch().
+        """
+        bins, bin_lengths = [], []
+        for sample in sorted(samples, key=lambda s: len(s.text), reverse=True):
+            length = len(sample.text)
+            for i, bin_length in enumerate(bin_lengths):
+                if bin_length + length <= self.seq_len:
+                    bins[i].append(sample)
+                    bin_lengths[i] += length
+                    break
+            else:
+                bins.append([sample])
+                bin_lengths.append(length)
+        return bins
+
+    def pack_selected_samples(self, samples: List[ImageTaskSample]) -> ImageTaskSample:
+        """
+        Concatenate the samples into one sequence. Each target is already shifted within its
+        own sample, so no label crosses a sample boundary. The visual inputs and grids are
+        concatenated in the same order as their placeholder tokens, each image/video keeps
+        its own attention segment in the ViT.
+        """
+
+        def concat_visuals(visuals):
+            visuals = [
+                np.concatenate(v) if isinstance(v, list) else np.asarray(v)
+                for v in visuals
+                if len(v) > 0
+            ]
+            return np.concatenate(visuals) if len(visuals) > 0 else []
+
+        def concat_grids(grids):
+            return np.concatenate([np.asarray(g, dtype=np.int64).reshape(-1, 3) for g in grids])
+
+        def concat_input_masks(masks, samples):
+            return np.concatenate(
+                [
+                    np.zeros(len(s.text), dtype=bool) if m is None else np.asarray(m)
+                    for m, s in zip(masks, samples)
+                ]
+            )
+
+        lengths = [len(s.text) for s in samples]
+        return ImageTaskSample(
+            __key__=",".join(s.__key__ for s in samples),
+            __subflavors__=samples[0].__subflavors__,
+            imgs=concat_visuals([s.imgs for s in samples]),
+            videos=concat_visuals([s.videos for s in samples]),
+            image_thw_grids=concat_grids([s.image_thw_grids for s in samples]),
+            video_thw_grids=concat_grids([s.video_thw_grids for s in samples]),
+            image_input_mask=concat_input_masks([s.image_input_mask for s in samples], samples),
+            video_input_mask=concat_input_masks([s.video_input_mask for s in samples], samples),
+            second_per_grid_ts=np.concatenate(
+                [np.asarray(s.second_per_grid_ts, dtype=np.float32) for s in samples]
+            ),
+            text=np.concatenate([np.asarray(s.text) for s in samples]),
+            target=np.concatenate([np.asarray(s.target) for s in samples]),
+            cu_seqlens=np.cumsum([0] + lengths, dtype=np.int32),
+        )
+
     def batch(self, samples: List[ImageTaskSample]) -> VQATaskBatch:
         # Stack images to [num_tiles, c, h, w]. If there are no images (text-only), then use a dummy image.
         # imgs = [img for s in samples for img in s.imgs]
@@ -618,7 +698,8 @@ class TaskEncoder(
             MAX_IMG_THRESHHOLD = image_thw_grids.prod(axis=-1).sum() // 4
             FIRST_MAX_PADDING_FLAG = True
 
-        if not self.args.enable_variable_seq_lengths:
+        if not self.args.enable_variable_seq_lengths or self.packing:
+            # NOTE: packed sequences are close to the budget, a fixed shape avoids fragmentation
             max_seq_len = self.seq_len
         else:
             # NOTE: this is a hack to get the max padding length for the first batch to avoid OOM because of cached memory in torch
@@ -652,6 +733,18 @@ class TaskEncoder(
                 video_input_masks[i, :text_len] = np.array(s.video_input_mask)[:text_len]
             target_mat[i, :target_len] = np.array(s.target)[:target_len]
 
+        # The padding of every row is a segment of its own, so the last boundary is max_seq_len.
+        # Rows are padded to the same number of boundaries by repeating max_seq_len.
+        cu_seqlens = []
+        for s in samples:
+            cu = s.cu_seqlens if s.cu_seqlens is not None else np.array([0, len(s.text)])
+            cu_seqlens.append(np.append(cu[cu < max_seq_len], max_seq_len))
+        cu_seqlens_mat = np.full(
+            (len(samples), max(len(cu) for cu in cu_seqlens)), max_seq_len, dtype=np.int32
+        )
+        for i, cu in enumerate(cu_seqlens):
+            cu_seqlens_mat[i, : len(cu)] = cu
+
         batch = VQATaskBatch(
             __keys__=[s.__key__ for s in samples],
             __subflavors__=[s.__subflavors__ for s in samples],
@@ -664,6 +757,7 @@ class TaskEncoder(
             video_input_mask=torch.from_numpy(video_input_masks),
             text=torch.from_numpy(text_mat),
             target=torch.from_numpy(target_mat),
+            cu_seqlens=torch.from_numpy(cu_seqlens_mat),
         )
 
         return batch